@@ -0,0 +1,21 @@
+import { AmplifyApiRestResourceStackTemplate, AmplifyProjectInfo } from '@aws-amplify/cli-extensibility-helper';
+
+export function override(resources: AmplifyApiRestResourceStackTemplate, amplifyProjectInfo: AmplifyProjectInfo) {
+  // productspublic and navpublic gzip larger bodies for clients that send Accept-Encoding: gzip and
+  // return them base64 encoded, which the API only decodes for binary media types. Only the JSON the
+  // functions send is one. JSON request bodies then arrive base64 encoded (see read_body).
+  resources.restApi.binaryMediaTypes = ['application/json'];
+
+  // The CORS preflight of every path is a mock integration, which only works on text payloads
+  const paths = resources.restApi.body?.paths || {};
+  for (const path of Object.keys(paths)) {
+    const integration = paths[path].options?.['x-amazon-apigateway-integration'];
+    if (!integration) {
+      continue;
+    }
+    integration.contentHandling = 'CONVERT_TO_TEXT';
+    for (const response of Object.values<any>(integration.responses || {})) {
+      response.contentHandling = 'CONVERT_TO_TEXT';
+    }
+  }
+}
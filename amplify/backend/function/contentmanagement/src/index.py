@@ -1,33 +1,32 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.conditions import Attr
+from decimal import Decimal
 import hashlib
 import os
-from decimal import Decimal
+from tezbuild.aws import dynamodb_resource, s3_client
+from tezbuild.catalog import (
+    SNAPSHOT_DIR, bump_catalog_version, get_catalog_meta, is_current, record_facilities, record_snapshot, snapshot_key,
+    upload_cutoff_key
+)
+from tezbuild.geo import FACILITY_ITEM_TYPE, GEO_HEADER, IP_REGIONS_KEY, read_ip_regions_header
+from tezbuild.history import SERIES_ATTRIBUTES, get_series_history, get_sku_history, series_values
+from tezbuild.keys import facility_sort_key, query_facility_items
+from tezbuild.offers import canonical_key, delete_offers, record_offers
+from tezbuild.repository import batch_write_items, query_products_by_category, scan_all
+from tezbuild.responses import decimal_default, send_response
+from tezbuild.snapshot import CatalogSnapshot, build_snapshot
+from tezbuild.static import publish_static_catalog, withdraw_static_catalog
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = dynamodb_resource()
 table = dynamodb.Table(os.environ['STORAGE_TEZBUILDDATA_NAME'])
+s3 = s3_client()
+bucket_name = os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME']
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
-
-def send_response(statusCode, body):
-    if isinstance(body, list):
-        for item in body:
-            if 'Costs' in item:
-                del item['Costs']
-
-    return {
-        'statusCode': statusCode,
-        'headers': {
-            'Access-Control-Allow-Headers': '*',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-        },
-        'body': json.dumps(body, default=decimal_default)
-    }
+# item types that make up the public catalog
+PUBLIC_ITEM_TYPES = ['P', 'PG', 'N', FACILITY_ITEM_TYPE]
+
+# where stale supplier products are copied before they are deleted
+ARCHIVE_PREFIX = 'admin/archive/products/'
 
 def create_product_groups_by_variants(event):
     category = event.get('Category')
@@ -49,43 +48,30 @@ def create_product_groups_by_variants(event):
 
     # Prepare expression attribute names to handle reserved keywords
     expression_attribute_names = {f"#{key}": key for key in key_attrs}
-    filter_expression = Key('ItemType').eq('P') & Key('Category').eq(category)
+    query_kwargs = {}
+    filter_expression = None
     for key, value in filter_attr.items():
-        filter_expression &= Attr(key).eq(value)
-    
-    # Initialize the ExclusiveStartKey to None for the first scan
-    exclusive_start_key = None
+        if filter_expression is None:
+            filter_expression = Attr(key).eq(value)
+        else:
+            filter_expression &= Attr(key).eq(value)
+    if filter_expression is not None:
+        query_kwargs['FilterExpression'] = filter_expression
     
     if key_attrs:
-        while True:
-            # Perform a scan operation with a filter expression to get items of the given category and item type
-            if exclusive_start_key:
-                response = table.scan(
-                    IndexName='Category',
-                    FilterExpression=filter_expression,
-                    ProjectionExpression=','.join(f"#{key}" for key in key_attrs),
-                    ExpressionAttributeNames=expression_attribute_names,
-                    ExclusiveStartKey=exclusive_start_key
-                )
-            else:
-                response = table.scan(
-                    IndexName='Category',
-                    FilterExpression=filter_expression,
-                    ProjectionExpression=','.join(f"#{key}" for key in key_attrs),
-                    ExpressionAttributeNames=expression_attribute_names
-                )
-            
-            # Extract unique combinations of the key_attrs attributes
-            for item in response['Items']:
-                variant = {key: item[key] for key in key_attrs if key in item}
-                if len(variant) == len(key_attrs):  # Ensure all key attributes are present
-                    variants.add(tuple(sorted(variant.items())))
-            
-            # Check if there are more items to retrieve
-            if 'LastEvaluatedKey' in response:
-                exclusive_start_key = response['LastEvaluatedKey']
-            else:
-                break
+        # Query the Category index for the given category, reading only the key attributes
+        items = query_products_by_category(
+            table, category,
+            ProjectionExpression=','.join(f"#{key}" for key in key_attrs),
+            ExpressionAttributeNames=expression_attribute_names,
+            **query_kwargs
+        )
+
+        # Extract unique combinations of the key_attrs attributes
+        for item in items:
+            variant = {key: item[key] for key in key_attrs if key in item}
+            if len(variant) == len(key_attrs):  # Ensure all key attributes are present
+                variants.add(tuple(sorted(variant.items())))
     else:
         # Create a single product group with the given category and filter attributes
         variants.add(tuple(sorted(filter_attr.items())))
@@ -128,11 +114,243 @@ def create_product_groups_by_variants(event):
             batch.put_item(Item=item)
             ids.append(hashed_id)
 
+    withdraw_static_catalog(s3, bucket_name, bump_catalog_version(table))
+
     return send_response(200, {
         "message": 'Product groups created successfully',
         "ids": ids
     })
 
+def publish_catalog(event):
+    # Export the public catalog to a binary snapshot that the public functions load at cold start
+    meta = get_catalog_meta(table)
+    version = int(meta.get('Version', 0))
+    upload_cutoffs = meta.get('UploadCutoffs', {})
+
+    items = [
+        item for item in scan_all(table, FilterExpression=Attr('ItemType').is_in(PUBLIC_ITEM_TYPES))
+        if item['ItemType'] != 'P' or is_current(item, upload_cutoffs)
+    ]
+
+    data = build_snapshot(items, version)
+    key = snapshot_key(version)
+    s3.put_object(Bucket=bucket_name, Key=key, Body=data)
+    print(f"Wrote {len(items)} items ({len(data)} bytes) to {key}")
+
+    try:
+        record_snapshot(table, version, key)
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return send_response(409, 'Catalog changed while publishing, publish again')
+
+    # render the static copy from the snapshot itself, so it matches what the public functions serve
+    path = os.path.join(SNAPSHOT_DIR, f"publish-{os.path.basename(key)}")
+    with open(path, 'wb') as f:
+        f.write(data)
+    snapshot = CatalogSnapshot(path)
+    try:
+        static_objects, static_uploads, static_deletes = publish_static_catalog(s3, bucket_name, snapshot)
+    finally:
+        snapshot.close()
+        os.remove(path)
+    print(f"Static catalog has {static_objects} objects, uploaded {static_uploads}, deleted {static_deletes}")
+
+    # a write since the snapshot was recorded withdrew the static copy, which this publish just restored
+    latest = int(get_catalog_meta(table).get('Version', 0))
+    if latest != version:
+        withdraw_static_catalog(s3, bucket_name, latest)
+
+    return send_response(200, {
+        "message": 'Catalog published successfully',
+        "version": version,
+        "key": key,
+        "items": len(items),
+        "staticObjects": static_objects,
+        "staticUploads": static_uploads,
+        "staticDeletes": static_deletes
+    })
+
+def stamp_sort_keys(items):
+    # returns how many of the items were stamped; items without a FacilityId or Category cannot be
+    updated = 0
+    for item in items:
+        if 'FacilityId' not in item or 'Category' not in item:
+            continue
+        table.update_item(
+            Key={'ItemType': item['ItemType'], 'UniqueId': item['UniqueId']},
+            UpdateExpression='SET FacilitySortKey = :key',
+            ExpressionAttributeValues={':key': facility_sort_key(item)}
+        )
+        updated += 1
+    return updated
+
+def backfill_sort_keys(event):
+    # Stamp FacilitySortKey on products uploaded before the FacilitySortKey index existed, and record the
+    # facilities of products uploaded before the catalog meta item listed them
+    items = scan_all(
+        table,
+        FilterExpression=Attr('ItemType').eq('P'),
+        ProjectionExpression='ItemType, UniqueId, FacilityId, Category, FacilitySortKey, #profile, #length, PanelType, Thickness',
+        ExpressionAttributeNames={'#profile': 'Profile', '#length': 'Length'}
+    )
+    updated = stamp_sort_keys([item for item in items if 'FacilitySortKey' not in item])
+    facilities = {item['FacilityId'] for item in items if 'FacilityId' in item}
+    record_facilities(table, facilities)
+
+    return send_response(200, {
+        "message": 'Sort keys backfilled successfully',
+        "updated": updated,
+        "facilities": sorted(facilities)
+    })
+
+def backfill_offers(event):
+    # Stamp CanonicalKey on products uploaded before offers existed, or after the key's normalization
+    # changed, and write their offers
+    items = scan_all(table, FilterExpression=Attr('ItemType').eq('P'))
+    changed = []
+    for item in items:
+        if 'FacilityId' not in item or 'Category' not in item:
+            continue
+        key = canonical_key(item)
+        if item.get('CanonicalKey') != key:
+            table.update_item(
+                Key={'ItemType': item['ItemType'], 'UniqueId': item['UniqueId']},
+                UpdateExpression='SET CanonicalKey = :key',
+                ExpressionAttributeValues={':key': key}
+            )
+            item['CanonicalKey'] = key
+            changed.append(item)
+    record_offers(table, changed)
+    if changed:
+        withdraw_static_catalog(s3, bucket_name, bump_catalog_version(table))
+
+    return send_response(200, {
+        "message": 'Offers backfilled successfully',
+        "updated": len(changed)
+    })
+
+def archive_stale_items(event):
+    # Copy products hidden by a newer upload of their supplier category to S3, then delete them and
+    # their offers. This runs outside of uploads, so retiring products costs no write capacity during
+    # an upload. It replaces the delete that clearCategory/clearSupplier used to do during the upload.
+    upload_cutoffs = get_catalog_meta(table).get('UploadCutoffs', {})
+    stale_items = {}
+    for cutoff_key, cutoff in upload_cutoffs.items():
+        facility_id, category = cutoff_key.split('#', 1)
+        stale_items[cutoff_key] = query_facility_items(
+            table, facility_id, category,
+            FilterExpression=Attr('LastSeenUploadId').not_exists() | Attr('LastSeenUploadId').lt(cutoff)
+        )
+
+    # products uploaded before FacilitySortKey existed are not in its index: the stale ones are archived
+    # with the rest, and the others are stamped so that the index has them from now on
+    unindexed = scan_all(table, FilterExpression=Attr('ItemType').eq('P') & Attr('FacilitySortKey').not_exists())
+    for item in unindexed:
+        if not is_current(item, upload_cutoffs):
+            stale_items[upload_cutoff_key(item['FacilityId'], item['Category'])].append(item)
+    stamped = stamp_sort_keys([item for item in unindexed if is_current(item, upload_cutoffs)])
+
+    archived = {}
+    offers = 0
+    for cutoff_key, items in stale_items.items():
+        if not items:
+            continue
+        facility_id, category = cutoff_key.split('#', 1)
+        key = f"{ARCHIVE_PREFIX}{facility_id}/{category}/{upload_cutoffs[cutoff_key]}.jsonl"
+        body = '\n'.join(json.dumps(item, default=decimal_default) for item in items)
+        s3.put_object(Bucket=bucket_name, Key=key, Body=body.encode('utf-8'))
+
+        offers += delete_offers(table, items)
+        batch_write_items(table, deletes=items)
+
+        print(f"Archived {len(items)} items to {key}")
+        archived[cutoff_key] = len(items)
+
+    return send_response(200, {
+        "message": 'Stale items archived successfully',
+        "archived": archived,
+        "offersDeleted": offers,
+        "sortKeysStamped": stamped
+    })
+
+def put_facility(event):
+    # e.g. {"FacilityId": "GS_PSK", "Latitude": 28.79, "Longitude": -82.13, "Name": "Great Southern, Panasofkee"}
+    facility_id = event.get('FacilityId')
+    if not isinstance(facility_id, str) or not facility_id:
+        return send_response(400, 'Missing FacilityId in request')
+    latitude, longitude = event.get('Latitude'), event.get('Longitude')
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (latitude, longitude)):
+        return send_response(400, 'Missing Latitude or Longitude in request')
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        return send_response(400, 'Invalid Latitude or Longitude in request')
+
+    item = {
+        'ItemType': FACILITY_ITEM_TYPE,
+        'UniqueId': facility_id,
+        'Latitude': Decimal(str(latitude)),
+        'Longitude': Decimal(str(longitude)),
+    }
+    if isinstance(event.get('Name'), str):
+        item['Name'] = event['Name']
+    table.put_item(Item=item)
+    version = bump_catalog_version(table)
+    withdraw_static_catalog(s3, bucket_name, version)
+
+    return send_response(200, {
+        "message": 'Facility saved successfully',
+        "version": version
+    })
+
+def import_ip_regions(event):
+    # Put an IP regions database in the bucket into place for the public functions to locate callers with.
+    # The database is compiled offline (see geo.main), so only its header is read here and the object is
+    # copied within S3. Containers that already loaded a database keep it until they are recycled.
+    key = event.get('key')
+    if not key:
+        return send_response(400, 'Missing key in request')
+
+    header = s3.get_object(Bucket=bucket_name, Key=key, Range=f'bytes=0-{GEO_HEADER.size - 1}')['Body'].read()
+    try:
+        ipv4_count, ipv6_count, region_count = read_ip_regions_header(header)
+    except ValueError as e:
+        return send_response(400, f'{key} is not an IP regions database: {e}')
+    s3.copy_object(Bucket=bucket_name, Key=IP_REGIONS_KEY, CopySource={'Bucket': bucket_name, 'Key': key})
+    print(f"Copied IP regions from {key} to {IP_REGIONS_KEY}")
+
+    return send_response(200, {
+        "message": 'IP regions imported successfully',
+        "key": IP_REGIONS_KEY,
+        "ipv4Ranges": ipv4_count,
+        "ipv6Ranges": ipv6_count,
+        "regions": region_count
+    })
+
+def get_price_history(event):
+    sku = event.get('sku')
+    if not sku:
+        return send_response(400, 'Missing sku in request')
+
+    return send_response(200, get_sku_history(table, sku))
+
+def get_dimension_price_history(event):
+    # e.g. {"Category": "lumber", "Profile": "2x4", "Length": 96, "Species": "Southern Yellow Pine", "Year": 2024}
+    category = event.get('Category')
+    if category not in SERIES_ATTRIBUTES:
+        return send_response(400, 'Missing or invalid category in request')
+    if 'Year' not in event:
+        return send_response(400, 'Missing year in request')
+    try:
+        year = int(event['Year'])
+    except (TypeError, ValueError):
+        return send_response(400, 'Invalid year in request')
+
+    # leading attributes can be given alone to widen the slice, e.g. only Profile
+    try:
+        attributes = series_values(category, event)
+    except ValueError as e:
+        return send_response(400, str(e))
+
+    return send_response(200, get_series_history(table, category, attributes, year))
+
 def handler(event, context):
     print('received event:')
     print(event)
@@ -145,5 +363,21 @@ def handler(event, context):
 
     if body['action'] == 'createGroupsByVariants':
         return create_product_groups_by_variants(body)
+    if body['action'] == 'publishCatalog':
+        return publish_catalog(body)
+    if body['action'] == 'backfillSortKeys':
+        return backfill_sort_keys(body)
+    if body['action'] == 'backfillOffers':
+        return backfill_offers(body)
+    if body['action'] == 'archiveStaleItems':
+        return archive_stale_items(body)
+    if body['action'] == 'putFacility':
+        return put_facility(body)
+    if body['action'] == 'importIpRegions':
+        return import_ip_regions(body)
+    if body['action'] == 'getPriceHistory':
+        return get_price_history(body)
+    if body['action'] == 'getDimensionPriceHistory':
+        return get_dimension_price_history(body)
 
     return send_response(400, 'Invalid action in request')
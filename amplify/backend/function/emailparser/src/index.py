@@ -1,11 +1,11 @@
 import json
-import boto3
 from email import policy
 from email.parser import BytesParser
 from bs4 import BeautifulSoup
+from tezbuild.aws import s3_client
  
 # Initialize the S3 client
-s3 = boto3.client('s3')
+s3 = s3_client()
  
 def handler(event, context):
     # Extract S3 bucket name and file key from the event
@@ -1,106 +1,165 @@
 import json
-import boto3
-from boto3.dynamodb.conditions import Attr, Key
 import os
-from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+from tezbuild.aws import dynamodb_resource, s3_client
+from tezbuild.cache import MISSING, NEGATIVE_TTL, LRUCache
+from tezbuild.catalog import SnapshotLoader
+from tezbuild.pagination import DEFAULT_PAGE_SIZE
+from tezbuild.products import load_product_group, load_products_by_skus
+from tezbuild.render import page_cards, page_items_from_snapshot
+from tezbuild.repository import QUERY_WORKERS, BatchGetError, batch_get_items, get_item, query_products_by_skus
+from tezbuild.responses import encode_body, negotiate_response, read_body, send_encoded_response, send_response
+from tezbuild.singleflight import SingleFlight
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = dynamodb_resource()
 table_name = os.environ['STORAGE_TEZBUILDDATA_NAME']
 table = dynamodb.Table(table_name)
+s3 = s3_client()
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
-
-def send_response(statusCode, body):
-    return {
-        'statusCode': statusCode,
-        'headers': {
-            'Access-Control-Allow-Headers': '*',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-        },
-        'body': json.dumps(body, default=decimal_default)
-    }
+# public reads are served from the published catalog snapshot while it matches the catalog version
+catalog = SnapshotLoader(table, s3, os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME'])
 
-def get_page_cards(body):
-    id = body.get('id')
-    if not id:
-        return send_response(400, 'Missing id in request')
-    
-    response = table.query(
-        KeyConditionExpression=Key('ItemType').eq('N') & Key('UniqueId').eq(id)
-    )
+# concurrent requests for the same page share one load, and pages that do not exist are remembered briefly
+flights = SingleFlight()
+missing_pages = LRUCache(max_entries=1024, max_bytes=1024 * 1024, ttl=NEGATIVE_TTL)
 
-    if not response['Items']:
-        return send_response(404, 'Item not found')
+# getPageBundle depth 0 is the page's cards, depth 1 adds the first page of each group card and the
+# products of each product card, which is everything the page shows before the user picks a card
+MAX_BUNDLE_DEPTH = 1
+BUNDLE_PAGE_SIZE = DEFAULT_PAGE_SIZE
+
+def get_page_items(id):
+    navigation_item = get_item(table, 'N', id)
+    if navigation_item is None:
+        return None
 
-    navigation_item = response['Items'][0]
-    title = navigation_item.get('Title', 'No Title')
     pgids = navigation_item.get('PGIDs', [])
     pids = navigation_item.get('PIDs', [])
 
     # Prepare keys for batch_get_item
     keys_pg = [{'ItemType': 'PG', 'UniqueId': pgid} for pgid in pgids]
 
-    # Retrieve group items
-    response_pg = dynamodb.batch_get_item(
-        RequestItems={
-            table_name: {
-                'Keys': keys_pg,
-                'ProjectionExpression': 'Heading, Subheading, UniqueId, Image'
-            }
-        }
-    )
-    pg_items = response_pg['Responses'].get(table_name, [])
+    # Retrieve group items and product items from GSI "SKU" at the same time, so the page
+    # costs about one round trip however many cards it has
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pg_future = executor.submit(
+            batch_get_items, table, keys_pg,
+            ProjectionExpression='ItemType, UniqueId, Heading, Subheading, Image'
+        )
+        pid_future = executor.submit(
+            query_products_by_skus, table, pids,
+            ProjectionExpression='Heading, Subheading, SKU, Image, FacilityId, Category, LastSeenUploadId'
+        )
 
-    # Retrieve product items from GSI "SKU"
+    # group items come back in PGIDs order, product items are put in PIDs order below
+    pg_items = pg_future.result()
+
+    pid_responses = pid_future.result()
     pid_items = []
     for pid in pids:
-        pid_response = table.query(
-            IndexName='SKU',
-            KeyConditionExpression=Key('ItemType').eq("P") & Key('SKU').eq(pid),
-            ProjectionExpression='Heading, Subheading, SKU, Image'
-        )
-        if pid_response['Items']:
-            pid_items.append(pid_response['Items'][0])  # Assuming we take the first match
-
-    # Construct the cards list
-    cards = []
-    for item in pg_items:
-        cards.append({
-            'heading': item.get('Heading', ''),
-            'subheading': item.get('Subheading', ''),
-            'id': item['UniqueId'],
-            'image': item.get('Image', ''),
-            'type': 'group'
-        })
-    for item in pid_items:
-        cards.append({
-            'heading': item.get('Heading', ''),
-            'subheading': item.get('Subheading', ''),
-            'id': item['SKU'],
-            'image': item.get('Image', ''),
-            'type': 'product'
-        })
-
-    return send_response(200, {
-        'title': title,
-        'cards': cards
-    })
+        current = catalog.current_items(pid_responses[pid])
+        if current:
+            pid_items.append(current[0])  # Assuming we take the first match
+
+    return navigation_item, pg_items, pid_items
+
+def load_page(id):
+    # (navigation item, group items, product items), or None if the page does not exist
+    snapshot = catalog.current()
+    missing_pages.sync(catalog.catalog_version)
+    if missing_pages.get(id) is not MISSING:
+        return None
+
+    if snapshot:
+        page = page_items_from_snapshot(snapshot, id)
+    else:
+        page = flights.do(id, lambda: get_page_items(id))
+
+    if page is None:
+        missing_pages.put(id, True, len(id))
+    return page
+
+def get_page_cards(body):
+    id = body.get('id')
+    if not id:
+        return send_response(400, 'Missing id in request')
+
+    try:
+        page = load_page(id)
+    except BatchGetError as e:
+        # some group cards could not be read, so fail rather than render a page with cards missing
+        print(e)
+        return send_response(503, 'Page could not be loaded, please try again')
+
+    if page is None:
+        return send_response(404, 'Item not found')
+
+    return send_response(200, page_cards(*page))
+
+def get_page_bundle(body):
+    # A page's cards and what its cards open, in one response, so a page view is one round trip
+    # instead of one for the cards and one per card. Groups hold the same body getProductsByPGID
+    # returns for a first page, so their NextCursor continues through productspublic.
+    id = body.get('id')
+    if not id:
+        return send_response(400, 'Missing id in request')
+
+    depth = body.get('depth', MAX_BUNDLE_DEPTH)
+    if not isinstance(depth, int) or isinstance(depth, bool) or depth < 0:
+        return send_response(400, 'Invalid depth in request')
+    depth = min(depth, MAX_BUNDLE_DEPTH)
+
+    try:
+        page = load_page(id)
+    except BatchGetError as e:
+        print(e)
+        return send_response(503, 'Page could not be loaded, please try again')
+
+    if page is None:
+        return send_response(404, 'Item not found')
+
+    cards = page_cards(*page)
+    if depth == 0:
+        return send_encoded_response(200, f'{{"Page": {encode_body(cards)}, "Groups": {{}}, "Products": {{}}}}')
+
+    pgids = [card['id'] for card in cards['cards'] if card['type'] == 'group']
+    skus = [card['id'] for card in cards['cards'] if card['type'] == 'product']
+
+    with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+        group_futures = [
+            (pgid, executor.submit(load_product_group, table, catalog, pgid, BUNDLE_PAGE_SIZE))
+            for pgid in pgids
+        ]
+        products_future = executor.submit(load_products_by_skus, table, catalog, skus)
+
+    # group pages are already encoded, so they are placed in the bundle as they are; a group that
+    # cannot be loaded is left out and the client loads it on its own when it is opened
+    groups = []
+    for pgid, future in group_futures:
+        statusCode, encoded_body = future.result()
+        if statusCode == 200:
+            groups.append(f'{json.dumps(pgid)}: {encoded_body}')
+        else:
+            print(f"Group {pgid} left out of bundle {id}: {statusCode}")
+
+    products = encode_body(products_future.result())
+    return send_encoded_response(
+        200, f'{{"Page": {encode_body(cards)}, "Groups": {{{", ".join(groups)}}}, "Products": {products}}}'
+    )
 
 def handler(event, context):
     print('received event:')
     print(event)
 
-    body = json.loads(event['body'])
+    body = read_body(event)
 
     if 'action' not in body:
         print('Missing action in request')
         return send_response(400, 'Missing action in request')
   
     if body['action'] == 'getPageCardsByNavID':
-        return get_page_cards(body)
+        return negotiate_response(event, get_page_cards(body))
+    if body['action'] == 'getPageBundle':
+        return negotiate_response(event, get_page_bundle(body))
 
     return send_response(400, 'Invalid action in request')
\ No newline at end of file
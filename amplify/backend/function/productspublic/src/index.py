@@ -1,32 +1,96 @@
-import json
-import boto3
-from boto3.dynamodb.conditions import Attr, Key
 import os
-from decimal import Decimal
+from tezbuild.aws import dynamodb_resource, s3_client
+from tezbuild.cache import MISSING, NEGATIVE_TTL, LRUCache
+from tezbuild.catalog import SnapshotLoader
+from tezbuild.cutlist import DEFAULT_KERF, cut_list_key, normalize_cut_list, optimize_cut_list
+from tezbuild.facets import normalize_filters
+from tezbuild.geo import DEFAULT_NEAREST_FACILITIES, MAX_NEAREST_FACILITIES, IpRegionsLoader, load_facility_index
+from tezbuild.loads import cart_key, plan_loads
+from tezbuild.manifest import PUBLIC_ATTRIBUTES
+from tezbuild.offers import public_offer, query_offers, rank_offers
+from tezbuild.ordering import SORT_FIELDS
+from tezbuild.pagination import DEFAULT_PAGE_SIZE, decode_cursor, page_limit
+from tezbuild.products import (
+    GROUP_SCOPE, PRODUCT_SCOPE, filter_scope, load_filtered_products, load_lumber_stock, load_product_group,
+    load_products_by_sku, load_products_by_skus, load_sorted_product_group, sorted_group_scope
+)
+from tezbuild.quotes import MAX_CART_LINES, compile_tiers, quote_cart
+from tezbuild.ranges import normalize_ranges
+from tezbuild.render import search_cards
+from tezbuild.responses import encode_body, negotiate_response, read_body, send_encoded_response, send_response
+from tezbuild.search import DEFAULT_SEARCH_RESULTS, MAX_SEARCH_RESULTS, normalize_tokens
+from tezbuild.singleflight import SingleFlight
+from tezbuild.suggest import DEFAULT_SUGGESTIONS, MAX_SUGGESTIONS, suggest_tokens
 
-dynamodb = boto3.resource('dynamodb')
+dynamodb = dynamodb_resource()
 table = dynamodb.Table(os.environ['STORAGE_TEZBUILDDATA_NAME'])
+s3 = s3_client()
 
-def decimal_default(obj):
-    if isinstance(obj, Decimal):
-        return float(obj)
-    raise TypeError
-
-def send_response(statusCode, body):
-    if isinstance(body, list):
-        for item in body:
-            if 'Costs' in item:
-                del item['Costs']
-
-    return {
-        'statusCode': statusCode,
-        'headers': {
-            'Access-Control-Allow-Headers': '*',
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'OPTIONS,POST,GET'
-        },
-        'body': json.dumps(body, default=decimal_default)
-    }
+# public reads are served from the published catalog snapshot while it matches the catalog version
+catalog = SnapshotLoader(table, s3, os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME'])
+
+# SKUs a single getProductsByIds request may ask for
+MAX_IDS_PER_REQUEST = 500
+
+# longer search queries are not typed by shoppers
+MAX_QUERY_LENGTH = 200
+
+# encoded response bodies of recent lookups, dropped whenever the catalog version changes
+response_cache = LRUCache(max_entries=2048, max_bytes=16 * 1024 * 1024, ttl=300)
+
+# concurrent misses for the same key share one load
+flights = SingleFlight()
+
+# callers are located from an offline IP range database, downloaded once per container
+ip_regions = IpRegionsLoader(s3, os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME'])
+
+# the spatial index of facility locations, rebuilt whenever the catalog version changes
+facility_indexes = LRUCache(max_entries=1, max_bytes=1024 * 1024, ttl=3600)
+
+# compiled price tiers of the products of recently quoted SKUs, by SKU, so that a repeat SKU costs no read
+tier_tables = LRUCache(max_entries=8192, max_bytes=8 * 1024 * 1024, ttl=300)
+
+def cached_response(key, load):
+    # load returns (statusCode, encoded_body). Successful responses are cached until the catalog
+    # version changes, 404s for NEGATIVE_TTL seconds, and other errors are not cached.
+    catalog.check()
+    response_cache.sync(catalog.catalog_version)
+
+    cached = response_cache.get(key)
+    if cached is not MISSING:
+        statusCode, encoded_body = cached
+        headers = {'X-Cache': 'Hit'}
+    else:
+        statusCode, encoded_body = flights.do(key, lambda: load_into_cache(key, load))
+        headers = {'X-Cache': 'Miss'}
+
+    return send_encoded_response(statusCode, encoded_body, headers)
+
+def load_into_cache(key, load):
+    statusCode, encoded_body = load()
+    if statusCode == 200:
+        response_cache.put(key, (statusCode, encoded_body), len(encoded_body))
+    elif statusCode == 404:
+        response_cache.put(key, (statusCode, encoded_body), len(encoded_body), ttl=NEGATIVE_TTL)
+    return statusCode, encoded_body
+
+def read_page(event, scope):
+    # returns (limit, cursor state, error); limit is None for an unpaginated request
+    limit = None
+    if 'limit' in event:
+        limit = page_limit(event['limit'])
+        if limit is None:
+            return None, None, 'Invalid limit in request'
+
+    cursor = None
+    if event.get('cursor'):
+        cursor = decode_cursor(event['cursor'], scope)
+        if cursor is None:
+            return None, None, 'Invalid cursor in request'
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+
+    return limit, cursor, None
 
 def get_products_by_id(event):
     print('getProductById')
@@ -34,15 +98,34 @@ def get_products_by_id(event):
         return send_response(400, 'Missing id in request')
 
     id = event['id']
-   
-    response = table.query(
-        IndexName='SKU',
-        KeyConditionExpression=Key('ItemType').eq('P') & Key('SKU').eq(id)
-    )
+    scope = (PRODUCT_SCOPE, id)
+    limit, cursor, error = read_page(event, scope)
+    if error:
+        return send_response(400, error)
+
+    return cached_response(scope + (limit, event.get('cursor')), lambda: load_products_by_id(id, limit, cursor))
+
+def load_products_by_id(id, limit=None, cursor=None):
+    return load_products_by_sku(table, catalog, id, limit, cursor)
 
-    items = response.get('Items', [])
 
-    return send_response(200, items)
+def get_products_by_ids(event):
+    print('getProductsByIds')
+    ids = event.get('ids')
+    if not isinstance(ids, list) or not ids:
+        return send_response(400, 'Missing ids in request')
+    if not all(isinstance(id, str) for id in ids):
+        return send_response(400, 'Invalid ids in request')
+
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_IDS_PER_REQUEST:
+        return send_response(400, f'At most {MAX_IDS_PER_REQUEST} ids per request')
+
+    return cached_response(('getProductsByIds',) + tuple(ids), lambda: load_products_by_ids(ids))
+
+def load_products_by_ids(ids):
+    # every requested SKU is a key of Products, with an empty list if it has no products
+    return 200, encode_body({'Products': load_products_by_skus(table, catalog, ids)})
 
 
 def get_products_by_pgid(event):
@@ -52,83 +135,323 @@ def get_products_by_pgid(event):
         return send_response(400, 'Missing pgid in request')
 
     pgid = event['pgid']
-    response = table.query(
-        KeyConditionExpression=Key('ItemType').eq('PG') & Key('UniqueId').eq(pgid)
+    if 'sort' in event:
+        return get_sorted_products_by_pgid(event, pgid)
+
+    scope = (GROUP_SCOPE, pgid)
+    limit, cursor, error = read_page(event, scope)
+    if error:
+        return send_response(400, error)
+
+    return cached_response(scope + (limit, event.get('cursor')), lambda: load_products_by_pgid(pgid, limit, cursor))
+
+def get_sorted_products_by_pgid(event, pgid):
+    # e.g. {"sort": "price", "quantity": 208, "order": "asc", "limit": 50}
+    sort = event['sort']
+    if sort not in SORT_FIELDS:
+        return send_response(400, 'Invalid sort in request')
+    order = event.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        return send_response(400, 'Invalid order in request')
+
+    quantity = None
+    if sort == 'price':
+        quantity = event.get('quantity', 1)
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return send_response(400, 'Invalid quantity in request')
+
+    scope = sorted_group_scope(pgid, sort, order == 'desc', quantity)
+    limit, cursor, error = read_page(event, scope)
+    if error:
+        return send_response(400, error)
+
+    return cached_response(
+        scope + (limit, event.get('cursor')),
+        lambda: load_sorted_product_group(table, catalog, pgid, sort, order == 'desc', quantity, limit, cursor)
     )
 
-    items = response.get('Items', [])
-    print('items:', items)
-
-    if not len(items):
-        print('PGID not found')
-        return send_response(404, "PGID not found")
-    
-    attributes = items[0]
-
-    if 'Category' not in attributes:
-        print('Category not found in attributes')
-        return send_response(400, 'Category not found in attributes')
-    
-    category = attributes['Category']
-
-    del attributes['ItemType']
-    del attributes['UniqueId']
-    del attributes['Category']
-    del attributes['Heading']
-    del attributes['Subheading']
-
-    filter_expression = None
-    for key, value in attributes.items():
-        if filter_expression is None:
-            filter_expression = Attr(key).eq(value)
-        else:
-            filter_expression = filter_expression & Attr(key).eq(value)
-
-    response = table.query(
-        IndexName='Category',
-        KeyConditionExpression='ItemType = :itemType AND Category = :category',
-        ExpressionAttributeValues={
-            ':itemType': 'P',
-            ':category': category
-        },
-        FilterExpression=filter_expression
+def load_products_by_pgid(pgid, limit=None, cursor=None):
+    return load_product_group(table, catalog, pgid, limit, cursor)
+
+
+def filter_products(event):
+    # e.g. {"pgid": ..., "filters": {"Species": ["Southern Yellow Pine"], "Length": [96, 120]}}, with
+    # optional ranges, e.g. "ranges": {"Length": {"min": 120, "max": 192}, "Price": {"max": 40, "quantity": 1}}
+    print('filterProducts')
+    pgid = event.get('pgid')
+    category = event.get('category')
+    if not pgid and not category:
+        return send_response(400, 'Missing pgid or category in request')
+    if pgid:
+        category = None
+    elif category not in PUBLIC_ATTRIBUTES:
+        return send_response(400, 'Invalid category in request')
+
+    filters = normalize_filters(event.get('filters', {}))
+    if filters is None:
+        return send_response(400, 'Invalid filters in request')
+    ranges = normalize_ranges(event.get('ranges', {}))
+    if ranges is None:
+        return send_response(400, 'Invalid ranges in request')
+
+    scope = filter_scope(pgid, category, filters, ranges)
+    limit, cursor, error = read_page(event, scope)
+    if error:
+        return send_response(400, error)
+    if limit is None:
+        limit = DEFAULT_PAGE_SIZE
+
+    return cached_response(
+        scope + (limit, event.get('cursor')),
+        lambda: load_filtered_products(table, catalog, pgid, category, filters, limit, cursor, ranges)
     )
 
-    items = response.get('Items', [])
 
-    res = {}
-    res["Products"] = {}
-    for item in items:
-        if 'Costs' in item:
-            del item['Costs']
-        hashed_id = item.get('SKU')
+def get_offers(event):
+    # every supplier's offer for a product, by its CanonicalKey; with a quantity, only the offers
+    # that can supply it, cheapest first, and the cheapest as Best
+    print('getOffers')
+    key = event.get('key')
+    if not isinstance(key, str) or not key:
+        return send_response(400, 'Missing key in request')
+
+    quantity = None
+    if 'quantity' in event:
+        quantity = event['quantity']
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return send_response(400, 'Invalid quantity in request')
 
-        if hashed_id not in res["Products"]:
-            res["Products"][hashed_id] = [item]
+    return cached_response(('getOffers', key, quantity), lambda: load_offers(key, quantity))
+
+def load_offers(key, quantity):
+    catalog.check()
+    offers = query_offers(table, key, catalog.upload_cutoffs)
+    if not offers:
+        return 404, encode_body('No offers found')
+
+    if quantity is None:
+        offers = sorted((public_offer(offer) for offer in offers), key=lambda offer: offer['FacilityId'])
+        return 200, encode_body({'CanonicalKey': key, 'Offers': offers, 'Best': None})
+
+    ranked = rank_offers(offers, quantity)
+    return 200, encode_body({'CanonicalKey': key, 'Quantity': quantity, 'Offers': ranked, 'Best': ranked[0] if ranked else None})
+
+
+def read_cart_lines(lines):
+    # [(sku, quantity)] from [{"id": sku, "quantity": quantity}], or None if any line is invalid
+    if not isinstance(lines, list) or not lines:
+        return None
+    cart = []
+    for line in lines:
+        if not isinstance(line, dict):
+            return None
+        sku, quantity = line.get('id'), line.get('quantity')
+        if not isinstance(sku, str) or not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return None
+        cart.append((sku, quantity))
+    return cart
+
+def quote_cart_lines(event):
+    print('quoteCart')
+    cart = read_cart_lines(event.get('lines'))
+    if cart is None:
+        return send_response(400, 'Missing or invalid lines in request')
+    if len(cart) > MAX_CART_LINES:
+        return send_response(400, f'At most {MAX_CART_LINES} lines per request')
+
+    return send_response(200, quote_cart(cart, cart_tier_tables(cart)))
+
+def cart_tier_tables(cart):
+    # {sku: compiled price tiers of its products} for the SKUs of (sku, quantity) lines
+    catalog.check()
+    tier_tables.sync(catalog.catalog_version)
+
+    tables_by_sku = {}
+    missing = []
+    for sku in dict.fromkeys(sku for sku, _ in cart):
+        tables = tier_tables.get(sku)
+        if tables is MISSING:
+            missing.append(sku)
         else:
-            res["Products"][hashed_id].append(item)
-    
-    res["Id"] = pgid
+            tables_by_sku[sku] = tables
+
+    # SKUs that are not memoized yet are read together, from the snapshot or in parallel from the table
+    if missing:
+        for sku, products in load_products_by_skus(table, catalog, missing).items():
+            tables = [compiled for compiled in map(compile_tiers, products) if compiled is not None]
+            tier_tables.put(sku, tables, 256 * len(tables) + 64)
+            tables_by_sku[sku] = tables
+    return tables_by_sku
+
+
+def plan_cart_loads(event):
+    # e.g. {"lines": [{"id": sku, "quantity": 416}]}, the same lines as quoteCart
+    print('planLoads')
+    cart = read_cart_lines(event.get('lines'))
+    if cart is None:
+        return send_response(400, 'Missing or invalid lines in request')
+    if len(cart) > MAX_CART_LINES:
+        return send_response(400, f'At most {MAX_CART_LINES} lines per request')
+
+    # repeated quotes of the same cart are planned once per catalog version
+    return cached_response(('planLoads', cart_key(cart)), lambda: (200, encode_body(plan_loads(cart, cart_tier_tables(cart)))))
+
+
+def optimize_cut_list_request(event):
+    # e.g. {"pieces": [{"profile": "2x4", "length": 92.625, "quantity": 14}], "kerf": 0.125,
+    # "filters": {"Grade": ["#2"], "Species": ["Southern Yellow Pine"]}}, lengths in inches
+    print('optimizeCutList')
+    normalized = normalize_cut_list(event.get('pieces'), event.get('kerf', DEFAULT_KERF))
+    if normalized is None:
+        return send_response(400, 'Invalid pieces or kerf in request')
+    cut_list, kerf = normalized
+    filters = normalize_filters(event.get('filters', {}))
+    if filters is None:
+        return send_response(400, 'Invalid filters in request')
+
+    # the same cut list, however it is listed, is planned once per catalog version
+    return cached_response(
+        ('optimizeCutList', cut_list_key(cut_list, kerf, filters)),
+        lambda: load_cut_list_plan(cut_list, kerf, filters)
+    )
 
-    return send_response(200, res)
+def load_cut_list_plan(cut_list, kerf, filters):
+    products = load_lumber_stock(table, catalog, list(cut_list), filters)
+    return 200, encode_body(optimize_cut_list(cut_list, kerf, products))
+
+
+def search_products(event):
+    print('searchProducts')
+    query = event.get('query')
+    if not isinstance(query, str) or not query.strip():
+        return send_response(400, 'Missing query in request')
+    if len(query) > MAX_QUERY_LENGTH:
+        return send_response(400, f'Query is longer than {MAX_QUERY_LENGTH} characters')
+
+    limit = page_limit(event.get('limit', DEFAULT_SEARCH_RESULTS))
+    if limit is None:
+        return send_response(400, 'Invalid limit in request')
+    limit = min(limit, MAX_SEARCH_RESULTS)
+
+    # queries that normalize alike, e.g. "2x4 8 ft" and "2X4 8ft", share a cache entry
+    tokens = normalize_tokens(query)
+    return cached_response(('searchProducts', ' '.join(tokens), limit), lambda: load_search_results(query, limit))
+
+def load_search_results(query, limit):
+    # The index is part of the catalog snapshot, so search never reads the table. While a newer
+    # catalog is waiting to be published the last snapshot is searched, since results only link
+    # to products and their current prices are read when they are opened.
+    snapshot = catalog.latest()
+    if snapshot is None:
+        return 503, encode_body('Search is not available until the catalog is published')
+    return 200, encode_body({'Results': search_cards(snapshot.search(query, limit))})
+
+def suggest_headings(event):
+    print('suggest')
+    prefix = event.get('prefix')
+    if not isinstance(prefix, str):
+        return send_response(400, 'Missing prefix in request')
+    if len(prefix) > MAX_QUERY_LENGTH:
+        return send_response(400, f'Prefix is longer than {MAX_QUERY_LENGTH} characters')
+
+    limit = page_limit(event.get('limit', DEFAULT_SUGGESTIONS))
+    if limit is None:
+        return send_response(400, 'Invalid limit in request')
+    limit = min(limit, MAX_SUGGESTIONS)
+
+    # e.g. "2x6x12'" and "2X6X12 ft" are the same keystroke
+    tokens = suggest_tokens(prefix)
+    if not tokens:
+        return send_response(200, {'Suggestions': []})
+    return cached_response(('suggest', ' '.join(tokens), limit), lambda: load_suggestions(prefix, limit))
+
+def load_suggestions(prefix, limit):
+    # like search, typeahead reads the last published snapshot and never the table
+    snapshot = catalog.latest()
+    if snapshot is None:
+        return 503, encode_body('Suggestions are not available until the catalog is published')
+    suggestions = [{'heading': heading, 'products': count} for heading, count in snapshot.suggest(prefix, limit)]
+    return 200, encode_body({'Suggestions': suggestions})
+
+def locate_caller(event, body):
+    # (latitude, longitude, region) of the caller, or None: a location the client sends, e.g. from the
+    # browser's geolocation, or else the one its IP address resolves to
+    location = body.get('location')
+    if isinstance(location, dict):
+        latitude, longitude = location.get('latitude'), location.get('longitude')
+        if all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in (latitude, longitude)):
+            if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+                return latitude, longitude, None
+    regions = ip_regions.get()
+    if regions is None:
+        return None
+    return regions.locate(event['requestContext']['identity'].get('sourceIp') or '')
+
+def get_nearest_facilities(event, body):
+    # facilities nearest to the caller first, with their distance in miles, so clients can rank and
+    # filter products by FacilityId (e.g. the FacilityId facet of filterProducts)
+    print('getNearestFacilities')
+    limit = page_limit(body.get('limit', DEFAULT_NEAREST_FACILITIES))
+    if limit is None:
+        return send_response(400, 'Invalid limit in request')
+    limit = min(limit, MAX_NEAREST_FACILITIES)
+
+    caller = locate_caller(event, body)
+    print("caller region:", caller[2] if caller else None)
+    if caller is None:
+        return send_response(200, {'Region': None, 'Facilities': []})
+
+    catalog.check()
+    facility_indexes.sync(catalog.catalog_version)
+    index = facility_indexes.get('facilities')
+    if index is MISSING:
+        index = load_facility_index(table, catalog)
+        facility_indexes.put('facilities', index, 256 * index.size + 64)
+
+    latitude, longitude, region = caller
+    return send_response(200, {
+        'Region': region,
+        'Facilities': [
+            {'FacilityId': facility_id, 'Distance': miles}
+            for facility_id, miles in index.nearest(latitude, longitude, limit)
+        ],
+    })
 
 
 def handler(event, context):
     print('received event:')
     print(event)
 
-    # TODO: get approx location
-    print("detected user ip:", event['requestContext']['identity'].get('sourceIp'))
-
-    body = json.loads(event['body'])
+    body = read_body(event)
 
     if 'action' not in body:
         print('Missing action in request')
         return send_response(400, 'Missing action in request')
 
     if body['action'] == 'getProductById':
-        return get_products_by_id(body)
-    if body['action'] == 'getProductsByPGID':
-        return get_products_by_pgid(body)
-    
-    return send_response(400, 'Invalid action in request')
+        response = get_products_by_id(body)
+    elif body['action'] == 'getProductsByIds':
+        response = get_products_by_ids(body)
+    elif body['action'] == 'getProductsByPGID':
+        response = get_products_by_pgid(body)
+    elif body['action'] == 'filterProducts':
+        response = filter_products(body)
+    elif body['action'] == 'getOffers':
+        response = get_offers(body)
+    elif body['action'] == 'quoteCart':
+        response = quote_cart_lines(body)
+    elif body['action'] == 'planLoads':
+        response = plan_cart_loads(body)
+    elif body['action'] == 'optimizeCutList':
+        response = optimize_cut_list_request(body)
+    elif body['action'] == 'getNearestFacilities':
+        response = get_nearest_facilities(event, body)
+    elif body['action'] == 'searchProducts':
+        response = search_products(body)
+    elif body['action'] == 'suggest':
+        response = suggest_headings(body)
+    else:
+        return send_response(400, 'Invalid action in request')
+
+    print('response cache:', response_cache.stats(), 'tier tables:', tier_tables.stats(), 'shared loads:', flights.shared)
+    return negotiate_response(event, response)
@@ -1,13 +1,20 @@
 import json
-import boto3
 import csv
 import hashlib
 import re
 import os
 from decimal import Decimal
 import math
-
-dynamodb = boto3.resource('dynamodb')
+from tezbuild.aws import dynamodb_resource, lambda_client, s3_client
+from tezbuild.bundles import BUNDLE_SIZES
+from tezbuild.catalog import new_upload_id, record_upload, request_publish
+from tezbuild.history import HISTORY_ATTRIBUTES, price_changed, record_price_history
+from tezbuild.keys import facility_sort_key
+from tezbuild.offers import OFFER_ATTRIBUTES, canonical_key, offer_changed, record_offers
+from tezbuild.repository import BatchGetError, batch_get_items, batch_write_items
+from tezbuild.static import withdraw_static_catalog
+
+dynamodb = dynamodb_resource()
 table = dynamodb.Table(os.environ['STORAGE_TEZBUILDDATA_NAME'])
 
 # Nominal to actual size chart
@@ -37,29 +44,10 @@ LUMBER_NOMINAL_ACTUAL = {
     '6x6': (5.50, 5.50)
 }
 
-BUNDLE_SIZES = {
-    "lumber": {
-        "Southern Yellow Pine": { # https://interfor.com/products/dimension-lumber/southern-yellow-pine/
-            "2x4": 208,
-            "2x6": 128, 
-            "2x8": 96,
-            "2x10": 80,
-            "2x12": 64,
-            "4x4": 52 # this one specifically seems to differ - GS has 104 for example
-        },
-        "European Spruce": { # https://interfor.com/products/dimension-lumber/spruce-pine-fir/
-            "2x4": 294,
-            "2x6": 189, 
-            "2x8": 147,
-            "2x10": 105,
-            "2x12": 84
-        }
-    },
-    "sheet_good": {
-        0.5: 66,
-        0.75: 44
-    }
-}
+CATEGORIES = ['lumber', 'sheet_good']
+
+# the attributes that price history and offers compare to tell whether an upload changed a product
+CHANGE_ATTRIBUTES = ('ItemType', 'UniqueId', 'CanonicalKey') + HISTORY_ATTRIBUTES + OFFER_ATTRIBUTES
 
 # TODO: find some widely accepted standard to use for these
 # values are in lb/cubic ft
@@ -125,49 +113,20 @@ def board_feet_softwood(length, profile):
     thickness, width = map(int, profile.split('x'))
     return width * thickness * length / 144
 
-def clear_supplier(category, facility_id):
-    print(f"Clearing {category} items for facility {facility_id}")
-
-    # Define the partition key and sort key values to filter the items
-    item_type = 'P'
-
-    if category == "all":
-        # Query for all items in the facility
-        response = table.query(
-            IndexName='FacilityId',
-            KeyConditionExpression='ItemType = :item_type AND FacilityId = :facility_id',
-            ExpressionAttributeValues={
-                ':item_type': item_type,
-                ':facility_id': facility_id
-            }
-        )
-    else:
-        # Query for all items of a specific category in the facility
-        response = table.query(
-            IndexName='FacilityId',
-            KeyConditionExpression='ItemType = :item_type AND FacilityId = :facility_id',
-            FilterExpression='Category = :category',
-            ExpressionAttributeValues={
-                ':item_type': item_type,
-                ':facility_id': facility_id,
-                ':category': category
-            }
-        )
-    
-    items = response.get('Items', [])
-
-    print(f"Deleting {len(items)} items")
-    
-    # Loop through the items and delete each one
-    with table.batch_writer() as batch:
-        for item in items:
-            batch.delete_item(
-                Key={
-                    'ItemType': item['ItemType'],
-                    'UniqueId': item['UniqueId']
-                }
-            )
-
+def load_previous_products(items):
+    # {UniqueId: product} of the products as they were before this upload; products it cannot read
+    # are left out, so they count as changed and are written
+    keys = [{'ItemType': item['ItemType'], 'UniqueId': item['UniqueId']} for item in items]
+    projection = {
+        'ProjectionExpression': ', '.join(f'#a{i}' for i in range(len(CHANGE_ATTRIBUTES))),
+        'ExpressionAttributeNames': {f'#a{i}': attribute for i, attribute in enumerate(CHANGE_ATTRIBUTES)},
+    }
+    try:
+        previous = batch_get_items(table, keys, **projection)
+    except BatchGetError as e:
+        print(f"Could not read every previous product: {e}")
+        previous = e.items
+    return {item['UniqueId']: item for item in previous}
 
 def parse_lumber(row, supplier_id):
     try:
@@ -541,7 +500,7 @@ def handler(event, context):
     key = 'admin/productupload/' + event['key'] + '.csv'
     print(f"Processing file: {key}")
     
-    s3 = boto3.client('s3')
+    s3 = s3_client()
     response = s3.get_object(Bucket=os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME'], Key=key)
     lines = response['Body'].read().decode('utf-8').splitlines()
     
@@ -558,7 +517,7 @@ def handler(event, context):
         }
 
     category = event.get('category')
-    if category and category not in ['lumber', 'sheet_good']:
+    if category and category not in CATEGORIES:
         return {
             'statusCode': 400,
             'body': json.dumps({
@@ -566,41 +525,65 @@ def handler(event, context):
             })
         }
     
-    # If this flag is set, clear all existing product data for that supplier and category
+    # If this flag is set, products of that supplier and category that are not in this file are retired
     # Example usage: RRT's inventory does not include certain products every month, so we want to remove them
-    # In the future we can get more sophisticated and move them somewhere or set a flag preventing them from being shown
-    clearCategory = event.get('clearCategory', False)
-    if clearCategory:
-        clear_supplier(category, supplier_id)
+    # Nothing is deleted here: once the upload completes, its id becomes the cutoff for the category, which
+    # hides the products it did not refresh from public reads. archiveStaleItems removes them later.
+    cleared_categories = []
+    if event.get('clearCategory', False) and category:
+        cleared_categories = [category]
+    if event.get('clearSupplier', False):
+        cleared_categories = CATEGORIES
 
-    clearSupplier = event.get('clearSupplier', False)
-    if clearSupplier:
-        clear_supplier("all", supplier_id)
+    upload_id = new_upload_id()
 
     rejected_items = []
-    with table.batch_writer() as batch:
-        for row in reader:
-            print(row)
-            if 'category' in row:
-                category = row.get('category')
-
-            if category == 'lumber':
-                item = parse_lumber(row, supplier_id)
-            elif category == 'sheet_good':
-                item = parse_sheet_good(row, supplier_id)
-            else:
-                row['error'] = 'Invalid row category'
-                item = row
-
-            if item is None:
-                row['error'] = 'Parser returned None'
-                item = row
-                
-            if 'error' in item:
-                rejected_items.append(row)
-                continue
-
-            batch.put_item(Item=item)
+    accepted_items = []
+    for row in reader:
+        print(row)
+        if 'category' in row:
+            category = row.get('category')
+
+        if category == 'lumber':
+            item = parse_lumber(row, supplier_id)
+        elif category == 'sheet_good':
+            item = parse_sheet_good(row, supplier_id)
+        else:
+            row['error'] = 'Invalid row category'
+            item = row
+
+        if item is None:
+            row['error'] = 'Parser returned None'
+            item = row
+            
+        if 'error' in item:
+            rejected_items.append(row)
+            continue
+
+        item['FacilitySortKey'] = facility_sort_key(item)
+        item['CanonicalKey'] = canonical_key(item)
+        item['LastSeenUploadId'] = upload_id
+        accepted_items.append(item)
+
+    # Every product is written, since its LastSeenUploadId is what keeps it current, but price history
+    # and offers are only written for the products this upload changed
+    previous = load_previous_products(accepted_items)
+    batch_write_items(table, puts=accepted_items)
+    record_price_history(table, [
+        item for item in accepted_items if price_changed(item, previous.get(item['UniqueId']))
+    ])
+    record_offers(table, [
+        item for item in accepted_items
+        if item['Category'] in cleared_categories or offer_changed(item, previous.get(item['UniqueId']))
+    ])
+
+    # public functions fall back to DynamoDB, and the storefront to them, until the catalog is published again
+    version = record_upload(table, supplier_id, cleared_categories, upload_id)
+    withdraw_static_catalog(s3, os.environ['STORAGE_TEZBUILDDATABUCKET_BUCKETNAME'], version)
+    try:
+        request_publish(lambda_client(), os.environ['FUNCTION_CONTENTMANAGEMENT_NAME'])
+    except Exception as e:
+        print(f"Could not request a catalog publish: {e}")
     
     print(f"Rejected items: {rejected_items}")
     return {
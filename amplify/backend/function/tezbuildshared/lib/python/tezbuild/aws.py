@@ -0,0 +1,52 @@
+import boto3
+from botocore.config import Config
+
+# One tuned botocore configuration for every function. The default pool of 10 connections is too
+# small once requests fan out over threads, legacy retries give up after a few quick attempts, and
+# keep-alive saves a TLS handshake on every call from a warm container.
+MAX_POOL_CONNECTIONS = 50
+
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    tcp_keepalive=True,
+    connect_timeout=2,
+    read_timeout=10,
+    retries={
+        'max_attempts': 8,
+        'mode': 'adaptive'
+    }
+)
+
+# resources and clients are created once per container and shared by the handler and the layer
+_dynamodb = None
+_s3 = None
+_secrets = None
+_lambda = None
+
+
+def dynamodb_resource():
+    global _dynamodb
+    if _dynamodb is None:
+        _dynamodb = boto3.resource('dynamodb', config=CLIENT_CONFIG)
+    return _dynamodb
+
+
+def s3_client():
+    global _s3
+    if _s3 is None:
+        _s3 = boto3.client('s3', config=CLIENT_CONFIG)
+    return _s3
+
+
+def secrets_client():
+    global _secrets
+    if _secrets is None:
+        _secrets = boto3.client('secretsmanager', config=CLIENT_CONFIG)
+    return _secrets
+
+
+def lambda_client():
+    global _lambda
+    if _lambda is None:
+        _lambda = boto3.client('lambda', config=CLIENT_CONFIG)
+    return _lambda
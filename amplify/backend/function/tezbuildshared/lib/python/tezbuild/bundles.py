@@ -0,0 +1,47 @@
+# Pieces per mill bundle, by category: lumber by species and profile, sheet goods by thickness.
+# Uploads use these as the pack size of a product's largest price break when the supplier's file
+# does not give one, and load planning splits lines into bundles of them.
+BUNDLE_SIZES = {
+    "lumber": {
+        "Southern Yellow Pine": { # https://interfor.com/products/dimension-lumber/southern-yellow-pine/
+            "2x4": 208,
+            "2x6": 128, 
+            "2x8": 96,
+            "2x10": 80,
+            "2x12": 64,
+            "4x4": 52 # this one specifically seems to differ - GS has 104 for example
+        },
+        "European Spruce": { # https://interfor.com/products/dimension-lumber/spruce-pine-fir/
+            "2x4": 294,
+            "2x6": 189, 
+            "2x8": 147,
+            "2x10": 105,
+            "2x12": 84
+        }
+    },
+    "sheet_good": {
+        0.5: 66,
+        0.75: 44
+    }
+}
+
+# for products of a size the chart does not list: the smallest bundle of the category, so such a
+# product is never planned into less deck space than it takes
+DEFAULT_BUNDLE_SIZES = {
+    'lumber': 52,
+    'sheet_good': 44,
+}
+
+
+def bundle_size(product):
+    # pieces per bundle of a product, or None if its category has no bundles
+    category = product.get('Category')
+    sizes = BUNDLE_SIZES.get(category)
+    if sizes is None:
+        return None
+    if category == 'lumber':
+        size = sizes.get(product.get('Species'), {}).get(product.get('Profile'))
+    else:
+        thickness = product.get('Thickness')
+        size = None if thickness is None else sizes.get(float(thickness))
+    return size or DEFAULT_BUNDLE_SIZES[category]
@@ -0,0 +1,210 @@
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Attr
+
+from tezbuild.snapshot import CatalogSnapshot
+
+# The catalog meta item tracks the version of the catalog data in the table. Every write to
+# public catalog data (uploads, content edits) bumps Version; publishing a snapshot records
+# the Version it was built from in SnapshotVersion, along with where it was written.
+#
+# UploadCutoffs maps 'FacilityId#Category' to the id of the latest upload that replaced that
+# supplier's category. Products whose LastSeenUploadId sorts before the cutoff were left out of
+# that upload: they are hidden from public reads straight away and archived later.
+#
+# Facilities is the set of FacilityIds that have uploaded products, so that a read can cover every
+# supplier's slice of a category through the FacilitySortKey index instead of the whole category.
+CATALOG_META_KEY = {'ItemType': 'META', 'UniqueId': 'catalog'}
+
+SNAPSHOT_PREFIX = 'public/catalog/'
+SNAPSHOT_DIR = '/tmp'
+
+# how often a warm container re-reads the catalog meta item, in seconds
+VERSION_CHECK_INTERVAL = 5
+
+
+def bump_catalog_version(table):
+    response = table.update_item(
+        Key=CATALOG_META_KEY,
+        UpdateExpression='ADD Version :one',
+        ExpressionAttributeValues={':one': 1},
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['Version'])
+
+
+def get_catalog_meta(table):
+    response = table.get_item(Key=CATALOG_META_KEY)
+    return response.get('Item', {})
+
+
+def new_upload_id():
+    # upload ids sort in upload order
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+
+
+def upload_cutoff_key(facility_id, category):
+    return f"{facility_id}#{category}"
+
+
+def record_upload(table, facility_id, categories, upload_id):
+    # records the uploading facility and, for each category the upload replaced, its cutoff; returns the
+    # new catalog version
+    update_kwargs = {'ExpressionAttributeValues': {':one': 1, ':facilities': {facility_id}}}
+    update = 'ADD Version :one, Facilities :facilities'
+    if categories:
+        # the map has to exist before keys can be set inside it
+        table.update_item(
+            Key=CATALOG_META_KEY,
+            UpdateExpression='SET UploadCutoffs = if_not_exists(UploadCutoffs, :empty)',
+            ExpressionAttributeValues={':empty': {}}
+        )
+        names = {}
+        assignments = []
+        for i, category in enumerate(categories):
+            names[f"#c{i}"] = upload_cutoff_key(facility_id, category)
+            assignments.append(f"UploadCutoffs.#c{i} = :upload_id")
+        update = 'SET ' + ', '.join(assignments) + ' ' + update
+        update_kwargs['ExpressionAttributeNames'] = names
+        update_kwargs['ExpressionAttributeValues'][':upload_id'] = upload_id
+    response = table.update_item(
+        Key=CATALOG_META_KEY,
+        UpdateExpression=update,
+        ReturnValues='UPDATED_NEW',
+        **update_kwargs
+    )
+    return int(response['Attributes']['Version'])
+
+
+def record_facilities(table, facility_ids):
+    # for products written before Facilities was recorded; does not change the catalog version
+    if facility_ids:
+        table.update_item(
+            Key=CATALOG_META_KEY,
+            UpdateExpression='ADD Facilities :facilities',
+            ExpressionAttributeValues={':facilities': set(facility_ids)}
+        )
+
+
+def is_current(item, upload_cutoffs):
+    # products left out of the latest replacing upload of their supplier category are stale
+    cutoff = upload_cutoffs.get(upload_cutoff_key(item.get('FacilityId'), item.get('Category')))
+    if cutoff is None:
+        return True
+    return item.get('LastSeenUploadId', '') >= cutoff
+
+
+def request_publish(lambda_client, function_name):
+    # Uploads make the snapshot stale, and public reads fall back to DynamoDB until it is published
+    # again. The publish runs as its own invocation so the upload does not wait for it; if the catalog
+    # changes meanwhile, that publish is refused and the next one requested catches up.
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'action': 'publishCatalog'}).encode('utf-8')
+    )
+
+
+def current_condition(upload_cutoffs, category=None):
+    # A FilterExpression condition that keeps the products is_current keeps, or None if every product
+    # is current. With a category, only that category's cutoffs are applied, e.g. to a Category query.
+    condition = None
+    for cutoff_key, cutoff in sorted(upload_cutoffs.items()):
+        facility_id, cutoff_category = cutoff_key.split('#', 1)
+        if category is not None and cutoff_category != category:
+            continue
+        part = Attr('FacilityId').ne(facility_id) | Attr('LastSeenUploadId').gte(cutoff)
+        if category is None:
+            part = part | Attr('Category').ne(cutoff_category)
+        condition = part if condition is None else condition & part
+    return condition
+
+
+def snapshot_key(version):
+    return f"{SNAPSHOT_PREFIX}snapshot-{version}.bin"
+
+
+def record_snapshot(table, version, key):
+    # only record the snapshot if nothing was written to the catalog while it was being built
+    table.update_item(
+        Key=CATALOG_META_KEY,
+        UpdateExpression='SET SnapshotVersion = :version, SnapshotKey = :key',
+        ConditionExpression='attribute_not_exists(Version) OR Version = :version',
+        ExpressionAttributeValues={':version': version, ':key': key}
+    )
+
+
+class SnapshotLoader:
+    # Keeps the catalog snapshot for a warm container. The snapshot is downloaded to /tmp once per
+    # version and mmapped; current() returns None whenever the snapshot does not match the catalog
+    # version, in which case callers read from DynamoDB instead and pass the products they read
+    # through current_items() to drop stale ones.
+
+    def __init__(self, table, s3, bucket):
+        self.table = table
+        self.s3 = s3
+        self.bucket = bucket
+        self.snapshot = None
+        self.catalog_version = None
+        self.upload_cutoffs = {}
+        self.facilities = []
+        self.checked_at = None
+
+    def refresh(self):
+        meta = get_catalog_meta(self.table)
+        self.catalog_version = int(meta.get('Version', 0))
+        self.upload_cutoffs = meta.get('UploadCutoffs', {})
+        self.facilities = sorted(meta.get('Facilities', ()))
+        snapshot_version = meta.get('SnapshotVersion')
+        key = meta.get('SnapshotKey')
+        if not key or snapshot_version is None or int(snapshot_version) != self.catalog_version:
+            return
+        if self.snapshot is not None and self.snapshot.version == self.catalog_version:
+            return
+
+        path = os.path.join(SNAPSHOT_DIR, os.path.basename(key))
+        if not os.path.exists(path):
+            print(f"Downloading catalog snapshot {key}")
+            self.s3.download_file(self.bucket, key, path + '.part')
+            os.replace(path + '.part', path)
+
+        # Requests on other threads may still be reading the previous snapshot, so it is not closed
+        # here: its mmap is released when the last of them drops it. Its file can go straight away,
+        # since a mapping outlives the file it was made from.
+        previous = self.snapshot
+        self.snapshot = CatalogSnapshot(path)
+        if previous is not None and previous.path != path:
+            os.remove(previous.path)
+
+    def check(self):
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= VERSION_CHECK_INTERVAL:
+            self.checked_at = now
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Could not refresh catalog snapshot: {e}")
+
+    def current_items(self, items):
+        # drop products hidden by a newer upload of their supplier category
+        self.check()
+        return [item for item in items if is_current(item, self.upload_cutoffs)]
+
+    def current_condition(self, category=None):
+        # for paged queries, where stale products have to be dropped before the page is counted
+        self.check()
+        return current_condition(self.upload_cutoffs, category)
+
+    def latest(self):
+        # the last snapshot loaded, even if the catalog has changed since, for reads that never go to the table
+        self.check()
+        return self.snapshot
+
+    def current(self):
+        self.check()
+        if self.snapshot is not None and self.snapshot.version == self.catalog_version:
+            return self.snapshot
+        return None
@@ -0,0 +1,334 @@
+import hashlib
+import json
+import math
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+from decimal import Decimal
+
+from tezbuild.quotes import compile_tiers, quote_cart, tier_total
+
+# Cut lists: the pieces a customer needs, e.g. 14 studs of 92-5/8in. and 6 headers of 38in. in 2x4,
+# are cut from the stock lengths the catalog carries at the least cost (the 1-D cutting stock problem).
+#
+# Every profile is solved on its own, in whole 1/32 inches. The saw kerf is added to every piece and
+# to every board, which accounts for a cut between pieces but none after the last one. Two plans are
+# made and the cheaper is kept:
+#
+#   decreasing   pieces longest first, each into the fullest board it fits, or else a new board
+#                of the stock length that is cheapest per inch
+#   columns      the linear relaxation solved by column generation, a revised simplex whose entering
+#                column is the best pattern for the current duals (a bounded knapsack per stock
+#                length), then rounded down, with the remaining pieces placed as above
+#
+# Column generation stops at the time budget; a plan is ready from the start, and LowerBound is
+# only given once the relaxation is solved. Each board of a plan is finally cut from the cheapest
+# stock length that holds it. Costs are the cheapest price per piece of each stock length; the
+# boards are then quoted like a cart (see quotes.py).
+
+UNITS_PER_INCH = 32
+
+DEFAULT_KERF = 0.125
+MAX_KERF = 1.0
+
+# pieces a single optimizeCutList request may have, and the time it may spend improving its plans
+MAX_CUT_PIECES = 10000
+CUT_LIST_TIME_BUDGET = 0.5
+
+MAX_PIVOTS = 1000
+MAX_KNAPSACK_NODES = 20000
+EPSILON = 1e-9
+
+StockOption = namedtuple('StockOption', ('length', 'capacity', 'cost', 'sku'))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def normalize_cut_list(pieces, kerf):
+    # ({profile: {length: quantity}}, kerf) from a request's pieces, or None if they are invalid;
+    # the same pieces listed in any order or split across entries normalize alike
+    if not isinstance(pieces, list) or not pieces or not _is_number(kerf) or not 0 <= kerf <= MAX_KERF:
+        return None
+    normalized = {}
+    total = 0
+    for piece in pieces:
+        if not isinstance(piece, dict):
+            return None
+        profile, length, quantity = piece.get('profile'), piece.get('length'), piece.get('quantity', 1)
+        if not isinstance(profile, str) or not _is_number(length) or length <= 0:
+            return None
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return None
+        lengths = normalized.setdefault(profile, {})
+        lengths[float(length)] = lengths.get(float(length), 0) + quantity
+        total += quantity
+    if total > MAX_CUT_PIECES:
+        return None
+    return {profile: dict(sorted(lengths.items())) for profile, lengths in sorted(normalized.items())}, float(kerf)
+
+
+def cut_list_key(cut_list, kerf, filters):
+    # a digest of a normalized cut list, which the response cache is keyed by
+    encoded = json.dumps([sorted((profile, sorted(lengths.items())) for profile, lengths in cut_list.items()), kerf, filters])
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _units(inches, kerf_units, round_up):
+    scaled = round(float(inches) * UNITS_PER_INCH, 6)
+    return (math.ceil(scaled) if round_up else math.floor(scaled)) + kerf_units
+
+
+def stock_options(products, kerf_units):
+    # {profile: [StockOption]} of the stock lengths of the products, each at its cheapest price per piece
+    cheapest = {}
+    for product in products:
+        table = compile_tiers(product)
+        if table is None or not _is_number(product.get('Length')) or not product.get('Profile'):
+            continue
+        smallest = table.pack_sizes[0]
+        total = tier_total(table, smallest)
+        if total is None:
+            continue
+        key = (product['Profile'], float(product['Length']))
+        option = (total / smallest, product.get('SKU', ''))
+        if key not in cheapest or option < cheapest[key]:
+            cheapest[key] = option
+    options = {}
+    for (profile, length), (cost, sku) in sorted(cheapest.items()):
+        options.setdefault(profile, []).append(StockOption(length, _units(length, kerf_units, False), cost, sku))
+    return options
+
+
+class _Stock:
+    # the stock options of a profile, sorted by capacity, with the cheapest option holding each length
+    def __init__(self, options):
+        self.options = sorted(options, key=lambda option: option.capacity)
+        self.capacities = [option.capacity for option in self.options]
+        self._cheapest_from = [0] * len(self.options)
+        for s in range(len(self.options) - 1, -1, -1):
+            following = self._cheapest_from[s + 1] if s + 1 < len(self.options) else s
+            self._cheapest_from[s] = s if self.options[s].cost <= self.options[following].cost else following
+
+    def cheapest_holding(self, used):
+        s = bisect_left(self.capacities, used)
+        return None if s == len(self.options) else self._cheapest_from[s]
+
+    def cheapest_per_inch(self, weight):
+        fitting = [s for s, option in enumerate(self.options) if option.capacity >= weight]
+        return min(fitting, key=lambda s: (self.options[s].cost / self.options[s].capacity, s))
+
+
+def _decreasing(demands, weights, stock):
+    # boards as [stock index, piece indices]; a board is opened at the stock length cheapest per inch
+    # for its first piece and shrunk to fit when the plan is costed
+    boards = []
+    free = []
+    opening = {}
+    for i in sorted(range(len(weights)), key=lambda i: -weights[i]):
+        for _ in range(demands[i]):
+            position = bisect_left(free, (weights[i], -1))
+            if position < len(free):
+                remaining, board = free.pop(position)
+                boards[board][1].append(i)
+                insort(free, (remaining - weights[i], board))
+            else:
+                if i not in opening:
+                    opening[i] = stock.cheapest_per_inch(weights[i])
+                boards.append([opening[i], [i]])
+                insort(free, (stock.options[opening[i]].capacity - weights[i], len(boards) - 1))
+    return boards
+
+
+def _knapsack(values, weights, limits, capacity, deadline):
+    # (value, counts) of the most valuable pattern of at most limits[i] pieces of weights[i] that fits
+    # capacity, by depth first branch and bound over the pieces in order of value per unit of length
+    items = sorted(
+        (i for i in range(len(values)) if values[i] > EPSILON and weights[i] <= capacity),
+        key=lambda i: -values[i] / weights[i]
+    )
+    best = [0.0, [0] * len(values)]
+    counts = [0] * len(values)
+    nodes = [0]
+
+    def search(k, remaining, value):
+        nodes[0] += 1
+        if value > best[0] + EPSILON:
+            best[0], best[1] = value, list(counts)
+        if k == len(items) or nodes[0] > MAX_KNAPSACK_NODES:
+            return
+        i = items[k]
+        if value + remaining * values[i] / weights[i] <= best[0] + EPSILON:
+            return
+        for count in range(min(limits[i], remaining // weights[i]), -1, -1):
+            counts[i] = count
+            search(k + 1, remaining - count * weights[i], value + count * values[i])
+            if nodes[0] % 1024 == 0 and time.monotonic() > deadline:
+                break
+        counts[i] = 0
+
+    search(0, capacity, 0.0)
+    return best[0], best[1]
+
+
+def _column_generation(demands, weights, stock, deadline):
+    # ([(stock index, pattern, boards)] of the basis, relaxation cost or None if it was not solved)
+    m = len(demands)
+    columns = []
+    for i in range(m):
+        # to start, one pattern per piece length with as many pieces as the cheapest stock per piece holds
+        start = min(
+            (stock.options[s].cost / min(option.capacity // weights[i], demands[i]), s)
+            for s, option in enumerate(stock.options) if option.capacity >= weights[i]
+        )[1]
+        pattern = [0] * m
+        pattern[i] = min(stock.options[start].capacity // weights[i], demands[i])
+        columns.append((start, pattern))
+    costs = [stock.options[s].cost for s, _ in columns]
+    inverse = [[1.0 / columns[r][1][r] if j == r else 0.0 for j in range(m)] for r in range(m)]
+    values = [demands[r] / columns[r][1][r] for r in range(m)]
+
+    solved = False
+    for _ in range(MAX_PIVOTS):
+        if time.monotonic() > deadline:
+            break
+        duals = [sum(costs[r] * inverse[r][j] for r in range(m)) for j in range(m)]
+        entering = None
+        for s, option in enumerate(stock.options):
+            value, pattern = _knapsack(duals, weights, demands, option.capacity, deadline)
+            reduced = value - option.cost
+            if reduced > EPSILON * max(option.cost, 1.0) and (entering is None or reduced > entering[0]):
+                entering = (reduced, s, pattern)
+        if entering is None:
+            solved = time.monotonic() <= deadline
+            break
+
+        _, s, pattern = entering
+        direction = [sum(row[j] * pattern[j] for j in range(m) if pattern[j]) for row in inverse]
+        leaving = None
+        for r in range(m):
+            if direction[r] > EPSILON:
+                ratio = values[r] / direction[r]
+                if leaving is None or ratio < leaving[0] - EPSILON:
+                    leaving = (ratio, r)
+        if leaving is None:
+            break
+        ratio, r = leaving
+        values = [value - ratio * step for value, step in zip(values, direction)]
+        values[r] = ratio
+        inverse[r] = [entry / direction[r] for entry in inverse[r]]
+        for k in range(m):
+            if k != r and direction[k]:
+                inverse[k] = [entry - direction[k] * pivot for entry, pivot in zip(inverse[k], inverse[r])]
+        columns[r] = (s, pattern)
+        costs[r] = stock.options[s].cost
+
+    relaxation = sum(cost * value for cost, value in zip(costs, values)) if solved else None
+    return [(s, pattern, values[r]) for r, (s, pattern) in enumerate(columns)], relaxation
+
+
+def _rounded(basis, demands, weights, stock):
+    # the basis rounded down to whole boards, with the pieces it leaves placed longest first
+    boards = []
+    remaining = list(demands)
+    for s, pattern, value in basis:
+        for _ in range(int(value + EPSILON)):
+            pieces = []
+            for i, count in enumerate(pattern):
+                taken = min(count, remaining[i])
+                remaining[i] -= taken
+                pieces += [i] * taken
+            if pieces:
+                boards.append([s, pieces])
+    return boards + _decreasing(remaining, weights, stock)
+
+
+def _costed(boards, weights, stock):
+    # the boards each cut from the cheapest stock length that holds them, and their total cost
+    shrunk = [[stock.cheapest_holding(sum(weights[i] for i in pieces)), pieces] for _, pieces in boards]
+    return shrunk, sum(stock.options[s].cost for s, _ in shrunk)
+
+
+def _layout(boards, lengths, stock, kerf):
+    # identical boards grouped, longest stock first
+    grouped = {}
+    for s, pieces in boards:
+        key = (s, tuple(sorted(pieces, key=lambda i: -lengths[i])))
+        grouped[key] = grouped.get(key, 0) + 1
+    layout = []
+    for (s, pieces), count in sorted(grouped.items(), key=lambda entry: (-stock.options[entry[0][0]].length, entry[0][1])):
+        option = stock.options[s]
+        cuts = [lengths[i] for i in pieces]
+        layout.append({
+            'Length': option.length,
+            'SKU': option.sku,
+            'Cuts': cuts,
+            'Offcut': round(max(0.0, option.length - sum(cuts) - kerf * len(cuts)), 4),
+            'Count': count,
+        })
+    return layout
+
+
+def optimize_profile(lengths, kerf, options, deadline):
+    # the plan for one profile's {length: quantity}, and the pieces of it no stock length holds
+    kerf_units = _units(kerf, 0, True)
+    stock = _Stock(options)
+    longest = stock.capacities[-1] if options else 0
+    pieces = [(length, quantity) for length, quantity in lengths.items() if _units(length, kerf_units, True) <= longest]
+    unplaced = [{'Length': length, 'Quantity': quantity} for length, quantity in lengths.items() if (length, quantity) not in pieces]
+    if not pieces:
+        return None, unplaced
+
+    piece_lengths = [length for length, _ in pieces]
+    weights = [_units(length, kerf_units, True) for length in piece_lengths]
+    demands = [quantity for _, quantity in pieces]
+
+    boards, cost = _costed(_decreasing(demands, weights, stock), weights, stock)
+    method = 'decreasing'
+    basis, relaxation = _column_generation(demands, weights, stock, deadline)
+    rounded, rounded_cost = _costed(_rounded(basis, demands, weights, stock), weights, stock)
+    if rounded_cost < cost - EPSILON:
+        boards, cost, method = rounded, rounded_cost, 'columns'
+
+    plan = {
+        'Boards': _layout(boards, piece_lengths, stock, kerf),
+        'Pieces': sum(demands),
+        'Cost': round(cost, 5),
+        'Method': method,
+    }
+    if relaxation is not None:
+        plan['LowerBound'] = round(relaxation, 5)
+    return plan, unplaced
+
+
+def optimize_cut_list(cut_list, kerf, products, time_budget=CUT_LIST_TIME_BUDGET):
+    # plans for the normalized cut list from the stock products, with a quote for the boards they use
+    options = stock_options(products, _units(kerf, 0, True))
+    started = time.monotonic()
+    plans = {}
+    unplaced = []
+    profiles = list(cut_list)
+    for number, profile in enumerate(profiles):
+        # what is left of the budget is shared by the profiles still to solve
+        remaining = time_budget - (time.monotonic() - started)
+        deadline = time.monotonic() + max(0.0, remaining) / (len(profiles) - number)
+        plan, profile_unplaced = optimize_profile(cut_list[profile], kerf, options.get(profile, []), deadline)
+        if plan:
+            plans[profile] = plan
+        unplaced += [dict(piece, Profile=profile) for piece in profile_unplaced]
+
+    boards = {}
+    for plan in plans.values():
+        for board in plan['Boards']:
+            boards[board['SKU']] = boards.get(board['SKU'], 0) + board['Count']
+    tables_by_sku = {}
+    for product in products:
+        table = compile_tiers(product)
+        if table is not None and product.get('SKU') in boards:
+            tables_by_sku.setdefault(product['SKU'], []).append(table)
+    return {
+        'Profiles': plans,
+        'Unplaced': unplaced,
+        'Quote': quote_cart(sorted(boards.items()), tables_by_sku),
+    }
@@ -0,0 +1,192 @@
+import struct
+from decimal import Decimal
+
+# Faceted filtering over a list of products. Every value of every facet attribute has a bitmap of
+# the products that have it, held as a Python int so that intersections and unions run in C over
+# machine words. Bit n stands for product n: the snapshot's product records when the index comes
+# from the snapshot, or the list it was built from otherwise.
+#
+# Values of one attribute are OR'ed and attributes are AND'ed, e.g. (Species is SYP or Spruce) and
+# (Length is 96 or 120). Each attribute's counts are taken with every filter but its own, so the
+# storefront can show what choosing another value of it would give.
+#
+# In the snapshot the bitmaps are stored in one section, sorted by attribute and value:
+#
+#   header   entry count
+#   entries  (attribute, value, first byte, data start, data length), strings as string table refs
+#   data     little-endian bitmap bytes from the first non-zero byte to the last one
+
+FACET_ATTRIBUTES = (
+    'Profile', 'Length', 'Grade', 'Species', 'Treatment', 'FingerJoint', 'Thickness', 'PanelType', 'FacilityId'
+)
+
+# indexed to scope a filter to a category, but not returned as a facet
+SCOPE_ATTRIBUTES = ('Category',)
+
+INDEXED_ATTRIBUTES = SCOPE_ATTRIBUTES + FACET_ATTRIBUTES
+
+FACETS_HEADER = struct.Struct('<I')
+FACET_ENTRY = struct.Struct('<IIIII')
+
+
+def facet_value(value):
+    # the string form of an attribute value, which is what filters name and counts are keyed by
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'Y' if value else 'N'
+    if isinstance(value, (int, float, Decimal)):
+        value = float(value)
+        if value == int(value):
+            return str(int(value))
+        return f"{value:g}"
+    return None
+
+
+def bitmap_of(numbers):
+    # set through a byte array, since OR'ing bits into an int one at a time copies it every time
+    numbers = list(numbers)
+    if not numbers:
+        return 0
+    data = bytearray(max(numbers) // 8 + 1)
+    for number in numbers:
+        data[number >> 3] |= 1 << (number & 7)
+    return int.from_bytes(data, 'little')
+
+
+def build_bitmaps(products):
+    # {attribute: {value: bitmap}} over the products, in list order
+    numbers = {attribute: {} for attribute in INDEXED_ATTRIBUTES}
+    for number, product in enumerate(products):
+        for attribute in INDEXED_ATTRIBUTES:
+            value = facet_value(product.get(attribute))
+            if value is not None:
+                numbers[attribute].setdefault(value, []).append(number)
+    return {
+        attribute: {value: bitmap_of(value_numbers) for value, value_numbers in values.items()}
+        for attribute, values in numbers.items()
+    }
+
+
+def encode_bitmaps(bitmaps, add_string):
+    # the snapshot section for build_bitmaps' result; add_string returns a string table ref
+    entries = bytearray()
+    data = bytearray()
+    count = 0
+    for attribute in sorted(bitmaps):
+        for value in sorted(bitmaps[attribute]):
+            bitmap = bitmaps[attribute][value]
+            raw = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+            first = len(raw) - len(raw.lstrip(b'\0'))
+            stored = raw[first:]
+            entries += FACET_ENTRY.pack(add_string(attribute), add_string(value), first, len(data), len(stored))
+            data += stored
+            count += 1
+    return FACETS_HEADER.pack(count) + bytes(entries) + bytes(data)
+
+
+def decode_bitmaps(buffer, offset, string):
+    # the inverse of encode_bitmaps; string resolves a string table ref
+    (count,) = FACETS_HEADER.unpack_from(buffer, offset)
+    entries_offset = offset + FACETS_HEADER.size
+    data_offset = entries_offset + count * FACET_ENTRY.size
+    bitmaps = {attribute: {} for attribute in INDEXED_ATTRIBUTES}
+    for attribute_ref, value_ref, first, start, length in FACET_ENTRY.iter_unpack(buffer[entries_offset:data_offset]):
+        stored = buffer[data_offset + start:data_offset + start + length]
+        bitmaps.setdefault(string(attribute_ref), {})[string(value_ref)] = int.from_bytes(stored, 'little') << (8 * first)
+    return bitmaps
+
+
+def bit_count(bitmap):
+    return bin(bitmap).count('1')
+
+
+def bit_numbers(bitmap, offset=0, limit=None):
+    # The numbers of the set bits in ascending order, skipping the first offset of them. Taking bits
+    # off the int one at a time copies it every time, so it is split into 64-bit words once: words
+    # before the offset are skipped by their bit count, and a page costs one pass over the words.
+    numbers = []
+    if not bitmap or limit == 0:
+        return numbers
+    size = (bitmap.bit_length() + 63) // 64
+    words = struct.unpack(f'<{size}Q', bitmap.to_bytes(size * 8, 'little'))
+    for index, word in enumerate(words):
+        if not word:
+            continue
+        if offset:
+            count = bin(word).count('1')
+            if count <= offset:
+                offset -= count
+                continue
+        base = index * 64
+        while word:
+            lowest = word & -word
+            word ^= lowest
+            if offset:
+                offset -= 1
+                continue
+            numbers.append(base + lowest.bit_length() - 1)
+            if limit is not None and len(numbers) == limit:
+                return numbers
+    return numbers
+
+
+def normalize_filters(filters):
+    # {attribute: sorted distinct values} from a request's filters, or None if they are invalid;
+    # a single value may be given instead of a list
+    if not isinstance(filters, dict):
+        return None
+    normalized = {}
+    for attribute, values in filters.items():
+        if attribute not in FACET_ATTRIBUTES:
+            return None
+        if not isinstance(values, list):
+            values = [values]
+        values = [facet_value(value) for value in values]
+        if not values or None in values:
+            return None
+        normalized[attribute] = sorted(set(values))
+    return dict(sorted(normalized.items()))
+
+
+class FacetIndex:
+    def __init__(self, bitmaps, size):
+        self.bitmaps = bitmaps
+        self.size = size
+        self.all = (1 << size) - 1
+
+    def scope(self, attribute, value):
+        return self.bitmaps.get(attribute, {}).get(facet_value(value), 0)
+
+    def _attribute_bitmap(self, attribute, values):
+        bitmap = 0
+        for value in values:
+            bitmap |= self.bitmaps.get(attribute, {}).get(value, 0)
+        return bitmap
+
+    def select(self, scope, filters):
+        # (bitmap of the products in scope matching every filter, {attribute: {value: count}})
+        filter_bitmaps = {attribute: self._attribute_bitmap(attribute, values) for attribute, values in filters.items()}
+
+        matches = scope
+        for bitmap in filter_bitmaps.values():
+            matches &= bitmap
+
+        facets = {}
+        for attribute in FACET_ATTRIBUTES:
+            if attribute in filter_bitmaps:
+                base = scope
+                for other, bitmap in filter_bitmaps.items():
+                    if other != attribute:
+                        base &= bitmap
+            else:
+                base = matches
+            counts = {}
+            if base:
+                for value, bitmap in self.bitmaps.get(attribute, {}).items():
+                    count = bit_count(base & bitmap)
+                    if count:
+                        counts[value] = count
+            if counts:
+                facets[attribute] = counts
+        return matches, facets
@@ -0,0 +1,294 @@
+import argparse
+import csv
+import heapq
+import ipaddress
+import math
+import mmap
+import os
+import struct
+import time
+
+from boto3.dynamodb.conditions import Key
+
+from tezbuild.repository import query_all
+
+# Caller locations and nearest facilities, resolved in process with no service calls.
+#
+# IP ranges come from an offline database (e.g. a GeoLite2 City blocks CSV) that is compiled into one
+# file offline, since a full database is millions of rows (see main). contentmanagement's
+# importIpRegions checks the compiled file and copies it into place. Public functions download it
+# once per container and mmap it; a lookup is
+# a binary search over the ranges of the address's family. Addresses are stored big-endian, so that
+# byte order is address order:
+#
+#   header          magic, format version, IPv4 range count, IPv6 range count, region count
+#   ipv4            (first, last, latitude, longitude, region) per range, sorted and not overlapping
+#   ipv6            the same with 16 byte addresses
+#   region_offsets  u32 offset of each region name in region_data, plus one trailing end offset
+#   region_data     utf-8 bytes of every region name
+#
+# Facilities are 'F' items keyed by FacilityId, with a Latitude and Longitude. They are kept in a k-d
+# tree of points on the unit sphere, where straight line distance orders points like great circle
+# distance does.
+
+FACILITY_ITEM_TYPE = 'F'
+
+IP_REGIONS_KEY = 'admin/geo/ip-regions.bin'
+IP_REGIONS_PATH = '/tmp/ip-regions.bin'
+
+# how long a container waits before trying again to download a database that was not there
+IP_REGIONS_RETRY_INTERVAL = 300
+
+GEO_MAGIC = b'TZIP'
+GEO_FORMAT_VERSION = 1
+GEO_HEADER = struct.Struct('<4sIIII')
+RANGES = {4: struct.Struct('<4s4sffI'), 6: struct.Struct('<16s16sffI')}
+U32 = struct.Struct('<I')
+
+EARTH_RADIUS_MILES = 3958.8
+
+DEFAULT_NEAREST_FACILITIES = 10
+MAX_NEAREST_FACILITIES = 100
+
+
+def read_ip_rows(lines):
+    # (first address, last address, latitude, longitude, region) for each row of a CSV with a header
+    # of either network (a CIDR block) or start and end, then latitude, longitude and optionally region;
+    # rows without a location are skipped
+    for row in csv.DictReader(lines):
+        try:
+            latitude, longitude = float(row['latitude']), float(row['longitude'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if row.get('network'):
+            network = ipaddress.ip_network(row['network'], strict=False)
+            first, last = network.network_address, network.broadcast_address
+        else:
+            first, last = ipaddress.ip_address(row['start']), ipaddress.ip_address(row['end'])
+        yield first, last, latitude, longitude, row.get('region') or ''
+
+
+def build_ip_regions(rows):
+    regions = {}
+    ranges = {4: [], 6: []}
+    for first, last, latitude, longitude, region in rows:
+        if first.version != last.version or first > last:
+            continue
+        ranges[first.version].append((first.packed, last.packed, latitude, longitude, regions.setdefault(region, len(regions))))
+
+    sections = []
+    counts = []
+    for version, entry in RANGES.items():
+        data = bytearray()
+        count = 0
+        end = None
+        for first, last, latitude, longitude, region in sorted(ranges[version]):
+            # a range that overlaps the one before it, e.g. a more specific block, is dropped
+            if end is not None and first <= end:
+                continue
+            data += entry.pack(first, last, latitude, longitude, region)
+            end = last
+            count += 1
+        sections.append(bytes(data))
+        counts.append(count)
+
+    offsets = bytearray()
+    names = bytearray()
+    for region in regions:
+        offsets += U32.pack(len(names))
+        names += region.encode('utf-8')
+    offsets += U32.pack(len(names))
+    header = GEO_HEADER.pack(GEO_MAGIC, GEO_FORMAT_VERSION, counts[0], counts[1], len(regions))
+    return header + b''.join(sections) + bytes(offsets) + bytes(names)
+
+
+def read_ip_regions_header(data):
+    # (IPv4 range count, IPv6 range count, region count) from the first bytes of a database
+    if len(data) < GEO_HEADER.size:
+        raise ValueError('Truncated IP regions header')
+    magic, version, ipv4_count, ipv6_count, region_count = GEO_HEADER.unpack_from(data, 0)
+    if magic != GEO_MAGIC or version != GEO_FORMAT_VERSION:
+        raise ValueError('Unsupported IP regions format')
+    return ipv4_count, ipv6_count, region_count
+
+
+class IpRegions:
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, ipv4_count, ipv6_count, self._region_count = GEO_HEADER.unpack_from(self._mm, 0)
+        if magic != GEO_MAGIC or version != GEO_FORMAT_VERSION:
+            self.close()
+            raise ValueError(f'Unsupported IP regions format in {path}')
+        offset = GEO_HEADER.size
+        self._sections = {}
+        for family, count in ((4, ipv4_count), (6, ipv6_count)):
+            self._sections[family] = (offset, count)
+            offset += count * RANGES[family].size
+        self._region_offsets = offset
+        self._region_data = offset + (self._region_count + 1) * U32.size
+
+    def close(self):
+        if getattr(self, '_mm', None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def _region(self, number):
+        start, end = struct.unpack_from('<II', self._mm, self._region_offsets + number * U32.size)
+        return bytes(self._mm[self._region_data + start:self._region_data + end]).decode('utf-8')
+
+    def locate(self, ip):
+        # (latitude, longitude, region) of an address, or None if it is not in any range
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        entry = RANGES[address.version]
+        offset, count = self._sections[address.version]
+        packed = address.packed
+
+        # the last range that starts at or before the address
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if self._mm[offset + middle * entry.size:offset + middle * entry.size + len(packed)] <= packed:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return None
+        _, last, latitude, longitude, region = entry.unpack_from(self._mm, offset + (low - 1) * entry.size)
+        if packed > last:
+            return None
+        return latitude, longitude, self._region(region)
+
+
+class IpRegionsLoader:
+    # Keeps the IP regions database for a warm container. It is downloaded once; until one has been
+    # imported, get() returns None and the download is tried again every IP_REGIONS_RETRY_INTERVAL.
+
+    def __init__(self, s3, bucket):
+        self.s3 = s3
+        self.bucket = bucket
+        self.regions = None
+        self.tried_at = None
+
+    def get(self):
+        if self.regions is not None:
+            return self.regions
+        now = time.monotonic()
+        if self.tried_at is not None and now - self.tried_at < IP_REGIONS_RETRY_INTERVAL:
+            return None
+        self.tried_at = now
+        try:
+            if not os.path.exists(IP_REGIONS_PATH):
+                print(f"Downloading IP regions {IP_REGIONS_KEY}")
+                self.s3.download_file(self.bucket, IP_REGIONS_KEY, IP_REGIONS_PATH + '.part')
+                os.replace(IP_REGIONS_PATH + '.part', IP_REGIONS_PATH)
+            self.regions = IpRegions(IP_REGIONS_PATH)
+        except Exception as e:
+            print(f"Could not load IP regions: {e}")
+        return self.regions
+
+
+def _unit_vector(latitude, longitude):
+    latitude, longitude = math.radians(latitude), math.radians(longitude)
+    return (math.cos(latitude) * math.cos(longitude), math.cos(latitude) * math.sin(longitude), math.sin(latitude))
+
+
+def _chord_miles(chord):
+    return EARTH_RADIUS_MILES * 2 * math.asin(min(1.0, chord / 2))
+
+
+def facility_locations(items):
+    # (FacilityId, latitude, longitude) of the facility items that have a valid location
+    locations = []
+    for item in items:
+        try:
+            latitude, longitude = float(item['Latitude']), float(item['Longitude'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if -90 <= latitude <= 90 and -180 <= longitude <= 180:
+            locations.append((item['UniqueId'], latitude, longitude))
+    return locations
+
+
+class FacilityIndex:
+    def __init__(self, locations):
+        self.size = len(locations)
+        self._root = self._build([(_unit_vector(latitude, longitude), id) for id, latitude, longitude in locations], 0)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        middle = len(points) // 2
+        return (
+            points[middle][0], points[middle][1], axis,
+            self._build(points[:middle], depth + 1), self._build(points[middle + 1:], depth + 1)
+        )
+
+    def nearest(self, latitude, longitude, count=DEFAULT_NEAREST_FACILITIES):
+        # [(FacilityId, miles)] of the count facilities nearest to a location, nearest first
+        target = _unit_vector(latitude, longitude)
+        # a max heap of (-squared distance, FacilityId) holding the nearest found so far
+        found = []
+
+        def search(node):
+            if node is None:
+                return
+            point, id, axis, left, right = node
+            distance = sum((a - b) ** 2 for a, b in zip(point, target))
+            if len(found) < count:
+                heapq.heappush(found, (-distance, id))
+            elif distance < -found[0][0]:
+                heapq.heapreplace(found, (-distance, id))
+            offset = target[axis] - point[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            search(near)
+            if len(found) < count or offset * offset < -found[0][0]:
+                search(far)
+
+        search(self._root)
+        return [(id, round(_chord_miles(math.sqrt(-distance)), 1)) for distance, id in sorted(found, reverse=True)]
+
+
+def load_facility_index(table, catalog):
+    # from the snapshot while it is current, otherwise from the table
+    snapshot = catalog.current()
+    if snapshot:
+        items = [snapshot.get_item(FACILITY_ITEM_TYPE, id) for id in snapshot.unique_ids(FACILITY_ITEM_TYPE)]
+    else:
+        items = query_all(table, KeyConditionExpression=Key('ItemType').eq(FACILITY_ITEM_TYPE))
+    return FacilityIndex(facility_locations(items))
+
+
+def main(argv=None):
+    # Compile IP location CSVs into a database, e.g. from amplify/backend/function/tezbuildshared/lib/python:
+    #
+    #   python -m tezbuild.geo GeoLite2-City-Blocks-IPv4.csv GeoLite2-City-Blocks-IPv6.csv ip-regions.bin
+    #
+    # then upload the output to the bucket and run importIpRegions with its key
+    parser = argparse.ArgumentParser(description='Compile IP location CSVs into an IP regions database')
+    parser.add_argument('csv', nargs='+', help='CSV files with a network or start and end column')
+    parser.add_argument('output', help='database file to write')
+    args = parser.parse_args(argv)
+
+    def rows():
+        for path in args.csv:
+            with open(path, newline='', encoding='utf-8') as lines:
+                yield from read_ip_rows(lines)
+
+    data = build_ip_regions(rows())
+    with open(args.output, 'wb') as output:
+        output.write(data)
+    ipv4_count, ipv6_count, region_count = read_ip_regions_header(data)
+    print(f"Wrote {len(data)} bytes to {args.output}: {ipv4_count} IPv4 and {ipv6_count} IPv6 ranges, {region_count} regions")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+import math
+import time
+from datetime import datetime, timezone
+
+from boto3.dynamodb.conditions import Key
+
+from tezbuild.keys import KEY_SEPARATOR, sortable_number
+from tezbuild.repository import batch_get_items, batch_write_items, query_all
+
+# Price history is kept in one item per product per year:
+#
+#   ItemType   'PH'
+#   UniqueId   Category#<series attributes>#Year#FacilityId#SKU
+#   SKU        the supplier independent product hash, so the SKU index returns every supplier's history
+#   Series     binary, one delta-encoded record per upload that changed the price (see encode_record)
+#
+# Ordering the key by the series attributes first lets one begins_with query return the history of
+# a product dimension across all suppliers, and the SKU index returns a product's history in one query.
+HISTORY_ITEM_TYPE = 'PH'
+
+SERIES_ATTRIBUTES = {
+    'lumber': ('Profile', 'Length', 'Species'),
+    'sheet_good': ('PanelType', 'Thickness', 'Species'),
+}
+
+# series attributes that products hold as numbers, so that a request's "96" keys like the product's 96
+NUMERIC_SERIES_ATTRIBUTES = ('Length', 'Thickness')
+
+# Costs and Prices are rounded to 5 decimal places when they are parsed
+PRICE_SCALE = 100000
+
+# the attributes a history record holds
+HISTORY_ATTRIBUTES = ('Costs', 'Prices')
+
+
+def _write_varint(out, value):
+    # zigzag, so small negative deltas stay small
+    value = (value << 1) ^ (value >> 63)
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (result >> 1) ^ -(result & 1), position
+
+
+def _scaled_tiers(tiers):
+    return [(int(round(float(price) * PRICE_SCALE)), int(quantity)) for price, quantity in tiers]
+
+
+def _write_tiers(out, tiers, previous):
+    _write_varint(out, len(tiers))
+    for i, (price, quantity) in enumerate(tiers):
+        previous_price, previous_quantity = previous[i] if i < len(previous) else (0, 0)
+        _write_varint(out, price - previous_price)
+        _write_varint(out, quantity - previous_quantity)
+
+
+def _read_tiers(data, position, previous):
+    count, position = _read_varint(data, position)
+    tiers = []
+    for i in range(count):
+        previous_price, previous_quantity = previous[i] if i < len(previous) else (0, 0)
+        price_delta, position = _read_varint(data, position)
+        quantity_delta, position = _read_varint(data, position)
+        tiers.append((previous_price + price_delta, previous_quantity + quantity_delta))
+    return tiers, position
+
+
+def year_start(year):
+    return int(datetime(year, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def _decode_scaled(data, year):
+    # returns (timestamp, costs, prices) records with prices still scaled to integers
+    records = []
+    timestamp = year_start(year)
+    costs, prices = [], []
+    position = 0
+    while position < len(data):
+        delta, position = _read_varint(data, position)
+        timestamp += delta
+        costs, position = _read_tiers(data, position, costs)
+        prices, position = _read_tiers(data, position, prices)
+        records.append((timestamp, costs, prices))
+    return records
+
+
+def encode_record(timestamp, costs, prices, previous):
+    # Each record stores its time and every tier's price and quantity as deltas from the previous
+    # record of the series, which are almost always zero or small, so a record is ~10 bytes.
+    # previous is the last (timestamp, costs, prices) of the series, or (year start, [], []).
+    out = bytearray()
+    previous_timestamp, previous_costs, previous_prices = previous
+    _write_varint(out, timestamp - previous_timestamp)
+    _write_tiers(out, _scaled_tiers(costs), previous_costs)
+    _write_tiers(out, _scaled_tiers(prices), previous_prices)
+    return bytes(out)
+
+
+def decode_series(data, year):
+    return [
+        {
+            'time': datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+            'costs': [[price / PRICE_SCALE, quantity] for price, quantity in costs],
+            'prices': [[price / PRICE_SCALE, quantity] for price, quantity in prices],
+        }
+        for timestamp, costs, prices in _decode_scaled(data, year)
+    ]
+
+
+def append_record(data, year, timestamp, costs, prices):
+    records = _decode_scaled(data, year)
+    previous = records[-1] if records else (year_start(year), [], [])
+    return bytes(data) + encode_record(timestamp, costs, prices, previous)
+
+
+def series_prefix(category, attributes):
+    # attributes are the category's SERIES_ATTRIBUTES values, in order; a shorter list selects a wider slice
+    parts = [category]
+    for value in attributes:
+        parts.append(value if isinstance(value, str) else sortable_number(value))
+    return KEY_SEPARATOR.join(parts) + KEY_SEPARATOR
+
+
+def series_values(category, values):
+    # The leading SERIES_ATTRIBUTES values of the category found in values, e.g. a request, in order,
+    # with numeric attributes coerced to numbers. Raises ValueError naming the first invalid one.
+    attributes = []
+    for attribute in SERIES_ATTRIBUTES[category]:
+        if attribute not in values:
+            break
+        value = values[attribute]
+        if attribute in NUMERIC_SERIES_ATTRIBUTES:
+            try:
+                if isinstance(value, bool):
+                    raise ValueError
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid {attribute} in request") from None
+            if not math.isfinite(value):
+                raise ValueError(f"Invalid {attribute} in request")
+        elif not isinstance(value, str):
+            raise ValueError(f"Invalid {attribute} in request")
+        attributes.append(value)
+    return attributes
+
+
+def history_key(product, year):
+    attributes = [product.get(attribute, '') for attribute in SERIES_ATTRIBUTES.get(product['Category'], ())]
+    return f"{series_prefix(product['Category'], attributes)}{year}{KEY_SEPARATOR}{product['FacilityId']}{KEY_SEPARATOR}{product['SKU']}"
+
+
+def _binary_value(value):
+    # boto3 returns Binary attributes wrapped in a Binary object
+    return getattr(value, 'value', value)
+
+
+def price_changed(product, previous):
+    # previous is the product as it was before an upload, or None if the upload added it
+    return previous is None or any(product.get(attribute) != previous.get(attribute) for attribute in HISTORY_ATTRIBUTES)
+
+
+def record_price_history(table, products, timestamp=None):
+    # Append one record per product to its history for the current year. Costs and Prices are
+    # overwritten in place by every upload, so this is the only record of previous prices. Uploads
+    # only pass the products whose price changed (see price_changed), since a record per upload of
+    # an unchanged price would cost a read and a write per product and say nothing new.
+    if timestamp is None:
+        timestamp = int(time.time())
+    year = datetime.fromtimestamp(timestamp, timezone.utc).year
+
+    products_by_key = {}
+    for product in products:
+        products_by_key[history_key(product, year)] = product
+
+    existing = {}
+    keys = [{'ItemType': HISTORY_ITEM_TYPE, 'UniqueId': key} for key in products_by_key]
+    for item in batch_get_items(table, keys, ProjectionExpression='ItemType, UniqueId, Series'):
+        existing[item['UniqueId']] = _binary_value(item['Series'])
+
+    history_items = []
+    for key, product in products_by_key.items():
+        history_items.append({
+            'ItemType': HISTORY_ITEM_TYPE,
+            'UniqueId': key,
+            'SKU': product['SKU'],
+            'FacilityId': product['FacilityId'],
+            'ProductId': product['UniqueId'],
+            'Year': year,
+            'Series': append_record(existing.get(key, b''), year, timestamp, product.get('Costs', []), product.get('Prices', [])),
+        })
+    batch_write_items(table, puts=history_items)
+
+
+def _series_response(items):
+    series = []
+    for item in sorted(items, key=lambda item: (item['FacilityId'], item['SKU'], item['Year'])):
+        series.append({
+            'FacilityId': item['FacilityId'],
+            'SKU': item['SKU'],
+            'ProductId': item['ProductId'],
+            'Year': int(item['Year']),
+            'Records': decode_series(_binary_value(item['Series']), int(item['Year'])),
+        })
+    return series
+
+
+def get_sku_history(table, sku):
+    # every year and supplier for one product, in a single query
+    items = query_all(
+        table,
+        IndexName='SKU',
+        KeyConditionExpression=Key('ItemType').eq(HISTORY_ITEM_TYPE) & Key('SKU').eq(sku)
+    )
+    return _series_response(items)
+
+
+def get_series_history(table, category, attributes, year):
+    # every supplier's products for a category slice (e.g. 2x4, 96in., Southern Yellow Pine) in one year
+    prefix = series_prefix(category, attributes)
+    if len(attributes) == len(SERIES_ATTRIBUTES.get(category, ())):
+        prefix += f"{year}{KEY_SEPARATOR}"
+    items = query_all(
+        table,
+        KeyConditionExpression=Key('ItemType').eq(HISTORY_ITEM_TYPE) & Key('UniqueId').begins_with(prefix)
+    )
+    items = [item for item in items if int(item['Year']) == year]
+    return _series_response(items)
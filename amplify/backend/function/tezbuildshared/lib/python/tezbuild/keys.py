@@ -0,0 +1,67 @@
+from boto3.dynamodb.conditions import Key
+
+from tezbuild.repository import query_all
+
+# Composite sort key for supplier/category/dimension slices, indexed by the FacilitySortKey GSI:
+#
+#   lumber      FacilityId#lumber#Profile#Length
+#   sheet_good  FacilityId#sheet_good#PanelType#Thickness
+#
+# Numbers are zero padded so that lexicographic order matches numeric order, which lets
+# begins_with select a slice and between select a dimension range within it.
+FACILITY_SORT_KEY_INDEX = 'FacilitySortKey'
+KEY_SEPARATOR = '#'
+
+# attributes that make up the slice after FacilityId and Category, by category
+SLICE_ATTRIBUTES = {
+    'lumber': ('Profile', 'Length'),
+    'sheet_good': ('PanelType', 'Thickness'),
+}
+
+
+def sortable_number(value):
+    # fixed width, so '0096.0000' < '0120.0000'; dimensions are inches and never reach 10000
+    return f"{float(value):09.4f}"
+
+
+def _key_part(value):
+    if isinstance(value, str):
+        return value
+    return sortable_number(value)
+
+
+def facility_sort_key(item):
+    parts = [item['FacilityId'], item['Category']]
+    for attribute in SLICE_ATTRIBUTES.get(item['Category'], ()):
+        parts.append(_key_part(item.get(attribute, '')))
+    return KEY_SEPARATOR.join(parts)
+
+
+def facility_key_prefix(facility_id, category=None, group=None):
+    # the prefix ends with a separator so that e.g. 'RRT' does not also match 'RRT2'
+    parts = [facility_id]
+    if category:
+        parts.append(category)
+        if group:
+            parts.append(group)
+    return KEY_SEPARATOR.join(parts) + KEY_SEPARATOR
+
+
+def facility_key_condition(facility_id, category=None, group=None, dimension_range=None):
+    # dimension_range is an inclusive (low, high) on the last slice attribute, and needs a group
+    condition = Key('ItemType').eq('P')
+    prefix = facility_key_prefix(facility_id, category, group)
+    if dimension_range is not None and category and group:
+        low, high = dimension_range
+        return condition & Key(FACILITY_SORT_KEY_INDEX).between(prefix + sortable_number(low), prefix + sortable_number(high))
+    return condition & Key(FACILITY_SORT_KEY_INDEX).begins_with(prefix)
+
+
+def query_facility_items(table, facility_id, category=None, group=None, dimension_range=None, **kwargs):
+    # read cost is proportional to the slice, not to the supplier's whole catalog
+    return query_all(
+        table,
+        IndexName=FACILITY_SORT_KEY_INDEX,
+        KeyConditionExpression=facility_key_condition(facility_id, category, group, dimension_range),
+        **kwargs
+    )
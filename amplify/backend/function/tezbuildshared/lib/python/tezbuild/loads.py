@@ -0,0 +1,132 @@
+import hashlib
+import json
+import math
+from collections import namedtuple
+
+from tezbuild.quotes import best_tier_total
+
+# Delivery loads for a cart. Every line ships from the supplier that quotes it cheapest (see
+# quotes.py), so loads are planned for each facility on its own. A line is split into full bundles
+# of the product's bundle size (see bundles.py), and one partial bundle of whatever is left over.
+#
+# Trucks are flatbeds with a payload limit and a deck that takes bundles in lanes, stacked a few
+# tiers high. A full bundle takes its length of one lane on one tier, and a partial bundle its share
+# of that. Bundles are packed first fit decreasing against both limits, largest share of either first.
+
+MAX_LOAD_WEIGHT = 45000.0
+DECK_LENGTH = 576.0
+DECK_LANES = 2
+STACK_TIERS = 3
+
+# the deck space of a truck, in inches of bundle length
+DECK_SPACE = DECK_LENGTH * DECK_LANES * STACK_TIERS
+
+Bundle = namedtuple('Bundle', ('sku', 'product_id', 'facility_id', 'pieces', 'partial', 'weight', 'length', 'space'))
+
+
+def merge_lines(cart):
+    # the pieces of a SKU ship together however many lines they are on
+    merged = {}
+    for sku, quantity in cart:
+        merged[sku] = merged.get(sku, 0) + quantity
+    return sorted(merged.items())
+
+
+def cart_key(cart):
+    # a digest of a cart's merged lines, which the response cache is keyed by
+    return hashlib.sha256(json.dumps(merge_lines(cart)).encode('utf-8')).hexdigest()
+
+
+def line_bundles(sku, quantity, table):
+    # the full bundles and the partial bundle that quantity pieces ship in
+    bundle_size = table.bundle_size
+    per_piece = table.measures.get('Weight', 0.0)
+    full, left_over = divmod(quantity, bundle_size)
+    bundles = [
+        Bundle(sku, table.product_id, table.facility_id, bundle_size, False, per_piece * bundle_size, table.length, table.length)
+    ] * full
+    if left_over:
+        bundles.append(Bundle(
+            sku, table.product_id, table.facility_id, left_over, True, per_piece * left_over, table.length,
+            table.length * left_over / bundle_size
+        ))
+    return bundles
+
+
+def _size(bundle):
+    return max(bundle.weight / MAX_LOAD_WEIGHT, bundle.space / DECK_SPACE)
+
+
+def pack_bundles(bundles):
+    # [[weight, space, bundles]] of trucks, first fit decreasing
+    trucks = []
+    for bundle in sorted(bundles, key=lambda bundle: (-_size(bundle), bundle.sku)):
+        for truck in trucks:
+            if truck[0] + bundle.weight <= MAX_LOAD_WEIGHT and truck[1] + bundle.space <= DECK_SPACE:
+                break
+        else:
+            truck = [0.0, 0.0, []]
+            trucks.append(truck)
+        truck[0] += bundle.weight
+        truck[1] += bundle.space
+        truck[2].append(bundle)
+    return trucks
+
+
+def _manifest(facility_id, truck):
+    weight, space, bundles = truck
+    items = {}
+    for bundle in bundles:
+        key = (bundle.sku, bundle.product_id, bundle.pieces, bundle.partial)
+        items[key] = items.get(key, 0) + 1
+    return {
+        'FacilityId': facility_id,
+        'Weight': round(weight, 3),
+        'DeckUsed': round(space / DECK_SPACE, 4),
+        'Items': [
+            {'SKU': sku, 'ProductId': product_id, 'Pieces': pieces, 'Partial': partial, 'Bundles': count}
+            for (sku, product_id, pieces, partial), count in sorted(items.items(), key=lambda item: (item[0][0], item[0][3]))
+        ],
+    }
+
+
+def plan_loads(cart, tables_by_sku):
+    # Trucks and their manifests for (sku, quantity) lines. Lines that no supplier can fill, that
+    # have no length or bundle size, or with a bundle over a truck's limits are returned as Unplaced.
+    bundles_by_facility = {}
+    unplaced = []
+    for sku, quantity in merge_lines(cart):
+        best = best_tier_total(tables_by_sku.get(sku, ()), quantity)
+        if best is None:
+            unplaced.append({'SKU': sku, 'Quantity': quantity, 'Reason': 'unavailable'})
+            continue
+        table = best[1]
+        if table.length is None:
+            unplaced.append({'SKU': sku, 'Quantity': quantity, 'Reason': 'no length'})
+            continue
+        if table.bundle_size is None:
+            unplaced.append({'SKU': sku, 'Quantity': quantity, 'Reason': 'no bundle size'})
+            continue
+        bundles = line_bundles(sku, quantity, table)
+        if table.length > DECK_LENGTH or bundles[0].weight > MAX_LOAD_WEIGHT:
+            unplaced.append({'SKU': sku, 'Quantity': quantity, 'Reason': 'oversize'})
+            continue
+        bundles_by_facility.setdefault(table.facility_id, []).extend(bundles)
+
+    loads = []
+    for facility_id in sorted(bundles_by_facility):
+        loads += [_manifest(facility_id, truck) for truck in pack_bundles(bundles_by_facility[facility_id])]
+    return {
+        'Trucks': len(loads),
+        'Loads': loads,
+        'Weight': round(sum(load['Weight'] for load in loads), 3),
+        # trucks a facility needs at least, by weight or by deck space, for judging the plan
+        'MinTrucks': sum(
+            max(
+                math.ceil(sum(bundle.weight for bundle in bundles) / MAX_LOAD_WEIGHT - 1e-9),
+                math.ceil(sum(bundle.space for bundle in bundles) / DECK_SPACE - 1e-9),
+            )
+            for bundles in bundles_by_facility.values()
+        ),
+        'Unplaced': unplaced,
+    }
@@ -0,0 +1,42 @@
+# Attributes of a product that public reads return, by category. Public queries project exactly
+# these, so internal attributes (Costs, FacilitySortKey) are never read from the table,
+# billed or deserialized on a public path. An attribute missing here is not served publicly, so
+# new product attributes have to be added when the storefront starts using them.
+#
+# The keys are included because paging needs them.
+COMMON_PUBLIC_ATTRIBUTES = (
+    'ItemType', 'UniqueId', 'Category', 'SKU', 'FacilityId',
+    'Length', 'Width', 'Thickness', 'Weight', 'Grade', 'Species', 'Treatment', 'Brand', 'Inventory',
+    'Prices', 'PriceType', 'MinPackSize', 'Unit', 'Heading', 'Subheading', 'Description', 'Image', 'CanonicalKey',
+)
+
+PUBLIC_ATTRIBUTES = {
+    'lumber': COMMON_PUBLIC_ATTRIBUTES + ('Profile', 'FingerJoint', 'Precision', 'BDFT'),
+    'sheet_good': COMMON_PUBLIC_ATTRIBUTES + ('PanelType', 'SQFT', 'Edge', 'Finish', 'Origin', 'Metric'),
+}
+
+# read with the public attributes for the stale item filter, but not served: they change on every
+# upload even when nothing a shopper sees does
+FILTER_ATTRIBUTES = ('LastSeenUploadId',)
+
+# for reads that do not know the category up front, e.g. by SKU
+ALL_PUBLIC_ATTRIBUTES = tuple(sorted({attribute for attributes in PUBLIC_ATTRIBUTES.values() for attribute in attributes}))
+
+
+def public_attributes(category=None):
+    return PUBLIC_ATTRIBUTES.get(category, ALL_PUBLIC_ATTRIBUTES)
+
+
+def public_projection(category=None):
+    # query/get keyword arguments; names go through placeholders since some may be reserved words
+    attributes = public_attributes(category) + FILTER_ATTRIBUTES
+    return {
+        'ProjectionExpression': ', '.join(f'#p{i}' for i in range(len(attributes))),
+        'ExpressionAttributeNames': {f'#p{i}': attribute for i, attribute in enumerate(attributes)},
+    }
+
+
+def public_item(item):
+    # the public attributes of an item, e.g. one read in full by a catalog export
+    attributes = public_attributes(item.get('Category'))
+    return {key: value for key, value in item.items() if key in attributes}
@@ -0,0 +1,147 @@
+import re
+
+from boto3.dynamodb.conditions import Key
+
+from tezbuild.catalog import is_current
+from tezbuild.keys import KEY_SEPARATOR, sortable_number
+from tezbuild.quotes import compile_tiers, tier_total
+from tezbuild.repository import batch_get_items, batch_write_items, query_all
+
+# The same physical product is a separate item for every supplier that carries it. Products are
+# stamped at upload with a supplier independent CanonicalKey, and every product also writes an
+# offer item, so that one query on the key returns every supplier's price tiers and inventory:
+#
+#   ItemType   'O'
+#   UniqueId   CanonicalKey#FacilityId
+#
+# Unlike the SKU, which hashes the attributes exactly as each supplier's file spells them, the
+# canonical key is built from normalized attributes (case, spacing, "#2" / "No. 2", "SYP" / "Southern
+# Yellow Pine"), and it is readable, so begins_with on a leading part of it lists a dimension.
+# Brand stays in the key, since a branded product is not a commodity.
+OFFER_ITEM_TYPE = 'O'
+
+CANONICAL_ATTRIBUTES = {
+    'lumber': ('Profile', 'Length', 'Grade', 'Species', 'Treatment', 'FingerJoint', 'Precision', 'Brand'),
+    'sheet_good': (
+        'PanelType', 'Thickness', 'Width', 'Length', 'Grade', 'Species', 'Treatment', 'Edge', 'Finish', 'Brand',
+        'Origin', 'Metric'
+    ),
+}
+
+SPECIES_ALIASES = {
+    'syp': 'southern yellow pine',
+    'spf': 'spruce pine fir',
+    'df': 'douglas fir',
+}
+
+# attributes of a product that its offer carries, and those of them that public reads return
+OFFER_ATTRIBUTES = ('SKU', 'FacilityId', 'Category', 'Prices', 'PriceType', 'MinPackSize', 'Inventory', 'LastSeenUploadId')
+PUBLIC_OFFER_ATTRIBUTES = ('CanonicalKey', 'ProductId', 'SKU', 'FacilityId', 'Prices', 'PriceType', 'MinPackSize', 'Inventory')
+
+
+def _canonical_text(attribute, value):
+    text = re.sub(r'\s+', ' ', str(value)).strip().lower()
+    if attribute == 'Grade':
+        text = re.sub(r'^(no\.?|#)\s*', '', text)
+    elif attribute == 'Species':
+        text = SPECIES_ALIASES.get(text, text)
+    elif attribute == 'Treatment' and text == 'none':
+        text = ''
+    return text.replace(KEY_SEPARATOR, '')
+
+
+def canonical_key(product):
+    # e.g. 'lumber#2x4#0096.0000#2#southern yellow pine###N#N#' for a 96in. #2 SYP 2x4
+    category = product['Category']
+    parts = [category]
+    for attribute in CANONICAL_ATTRIBUTES.get(category, ()):
+        value = product.get(attribute, '')
+        if isinstance(value, str):
+            parts.append(_canonical_text(attribute, value))
+        else:
+            parts.append(sortable_number(value))
+    return KEY_SEPARATOR.join(parts)
+
+
+def offer_key(key, facility_id):
+    return f"{key}{KEY_SEPARATOR}{facility_id}"
+
+
+def offer_item(product):
+    item = {
+        'ItemType': OFFER_ITEM_TYPE,
+        'UniqueId': offer_key(product['CanonicalKey'], product['FacilityId']),
+        'CanonicalKey': product['CanonicalKey'],
+        'ProductId': product['UniqueId'],
+    }
+    for attribute in OFFER_ATTRIBUTES:
+        if attribute in product:
+            item[attribute] = product[attribute]
+    return item
+
+
+def offer_changed(product, previous):
+    # previous is the product as it was before an upload, or None if the upload added it. The offer's
+    # LastSeenUploadId only matters once an upload sets a cutoff, so it does not count as a change.
+    if previous is None:
+        return True
+    return any(
+        product.get(attribute) != previous.get(attribute)
+        for attribute in ('CanonicalKey',) + OFFER_ATTRIBUTES if attribute != 'LastSeenUploadId'
+    )
+
+
+def record_offers(table, products):
+    # Upsert the offer of each product, which keeps the index current one upload at a time. Products
+    # must already carry their CanonicalKey. Uploads pass the products whose offer changed (see
+    # offer_changed), and every product of a category they set a cutoff for, so that its offer's
+    # LastSeenUploadId is not older than the cutoff. An offer that a supplier stops sending goes stale
+    # with its product (see catalog.is_current) and is deleted with it (see delete_offers).
+    batch_write_items(table, puts=[offer_item(product) for product in products])
+
+
+def delete_offers(table, products):
+    # Delete the offers of products that are being deleted; returns how many were. An offer is only
+    # deleted while it is still the product's own, since a newer product of the same supplier with the
+    # same canonical key (e.g. a SKU spelled "No. 2" instead of "#2") overwrites it.
+    keys = [
+        {'ItemType': OFFER_ITEM_TYPE, 'UniqueId': offer_key(product['CanonicalKey'], product['FacilityId'])}
+        for product in products if 'CanonicalKey' in product and 'FacilityId' in product
+    ]
+    product_ids = {product['UniqueId'] for product in products}
+    offers = batch_get_items(table, keys, ProjectionExpression='ItemType, UniqueId, ProductId')
+    owned = [offer for offer in offers if offer.get('ProductId') in product_ids]
+    batch_write_items(table, deletes=owned)
+    return len(owned)
+
+
+def query_offers(table, key, upload_cutoffs):
+    # every supplier's current offer for a canonical key
+    items = query_all(
+        table,
+        KeyConditionExpression=Key('ItemType').eq(OFFER_ITEM_TYPE) & Key('UniqueId').begins_with(key + KEY_SEPARATOR)
+    )
+    return [item for item in items if is_current(item, upload_cutoffs)]
+
+
+def offer_total(offer, quantity):
+    # the price of quantity pieces from one offer, or None if it cannot supply them (see quotes.py)
+    table = compile_tiers(offer)
+    if table is None:
+        return None
+    return tier_total(table, quantity)
+
+
+def public_offer(offer):
+    return {key: value for key, value in offer.items() if key in PUBLIC_OFFER_ATTRIBUTES}
+
+
+def rank_offers(offers, quantity):
+    # the public attributes of the offers able to supply quantity, cheapest first, with their Total
+    ranked = []
+    for offer in offers:
+        total = offer_total(offer, quantity)
+        if total is not None:
+            ranked.append(dict(public_offer(offer), Total=total))
+    ranked.sort(key=lambda offer: (offer['Total'], offer['FacilityId']))
+    return ranked
@@ -0,0 +1,75 @@
+import heapq
+import math
+import struct
+
+from tezbuild.quotes import compile_tiers, tier_total
+
+# Server side ordering of a product group's products. The snapshot stores a fixed width sort entry
+# per product record, so ordering a group reads a few numbers per product instead of decoding it:
+#
+#   sort_keys   (Length, Weight, Inventory, first tier, tier count, price type) per product record,
+#               NaN for a missing number; the tiers are the product's Prices in the tiers section
+#
+# Only the first offset + limit products of an ordering are selected, with a heap, so a page costs
+# O(n log k) rather than a full sort. Products without a value (no inventory reported, or a price
+# that cannot supply the quantity) come last in either direction.
+
+SORT_FIELDS = ('price', 'length', 'weight', 'inventory')
+
+SORT_ENTRY = struct.Struct('<dddIIB')
+
+PRICE_TYPES = ('a', 'b')
+
+
+def _number_or_nan(value):
+    return math.nan if value is None else float(value)
+
+
+def encode_sort_entry(product, tier_start, tier_count):
+    return SORT_ENTRY.pack(
+        _number_or_nan(product.get('Length')),
+        _number_or_nan(product.get('Weight')),
+        _number_or_nan(product.get('Inventory')),
+        tier_start,
+        tier_count,
+        PRICE_TYPES.index(product.get('PriceType')) if product.get('PriceType') in PRICE_TYPES else 0,
+    )
+
+
+def _price_value(prices, price_type, inventory, quantity):
+    table = compile_tiers({'Prices': prices, 'PriceType': price_type, 'Inventory': inventory})
+    if table is None:
+        return None
+    return tier_total(table, quantity)
+
+
+def entry_sort_value(entry, tiers, field, quantity):
+    # the sort value of a snapshot sort entry; tiers returns the (price, pack size) tiers at (start, count)
+    length, weight, inventory, tier_start, tier_count, price_type = entry
+    if field == 'price':
+        return _price_value(
+            tiers(tier_start, tier_count), PRICE_TYPES[price_type], None if math.isnan(inventory) else inventory, quantity
+        )
+    value = {'length': length, 'weight': weight, 'inventory': inventory}[field]
+    return None if math.isnan(value) else value
+
+
+def product_sort_value(product, field, quantity):
+    # the same value as entry_sort_value, for a product read from the table
+    if field == 'price':
+        return _price_value(product.get('Prices') or [], product.get('PriceType', 'a'), product.get('Inventory'), quantity)
+    value = product.get(field.capitalize())
+    return None if value is None else float(value)
+
+
+def top_k(entries, count, descending=False):
+    # the first count (value, tiebreak, payload) entries in order, or all of them if count is None
+    def key(entry):
+        value, tiebreak, _ = entry
+        if value is None:
+            return (1, 0.0, tiebreak)
+        return (0, -value if descending else value, tiebreak)
+
+    if count is None:
+        return sorted(entries, key=key)
+    return heapq.nsmallest(count, entries, key=key)
@@ -0,0 +1,72 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+
+from tezbuild.aws import secrets_client
+from tezbuild.responses import decimal_default
+
+# Paginated reads return at most `limit` items and an opaque cursor for the next page. The cursor
+# is the page state (what was queried, where to continue and which source it came from) signed
+# with a per-deployment secret, so clients cannot forge a position or reuse a cursor for a
+# different query. A cursor is not a contract: its contents may change between deployments.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+SIGNATURE_BYTES = 16
+
+_signing_key = None
+
+
+def signing_key():
+    global _signing_key
+    if _signing_key is None:
+        response = secrets_client().get_secret_value(SecretId=os.environ['CURSOR_SECRET_ID'])
+        _signing_key = response['SecretString'].encode('utf-8')
+    return _signing_key
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _signature(payload):
+    return hmac.new(signing_key(), payload, hashlib.sha256).digest()[:SIGNATURE_BYTES]
+
+
+def page_limit(value):
+    # the requested page size capped at MAX_PAGE_SIZE, or None if it is not a positive integer
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        return None
+    return min(value, MAX_PAGE_SIZE)
+
+
+def encode_cursor(scope, state):
+    # scope identifies the query (e.g. ['getProductsByPGID', pgid]) and state is where the next page starts
+    payload = json.dumps({'q': list(scope), 's': state}, separators=(',', ':'), default=decimal_default).encode('utf-8')
+    return f"{_b64encode(payload)}.{_b64encode(_signature(payload))}"
+
+
+def decode_cursor(cursor, scope):
+    # returns the state of a cursor issued for scope, or None if it is malformed, forged or for another query
+    if not isinstance(cursor, str) or cursor.count('.') != 1:
+        return None
+    payload_text, signature_text = cursor.split('.')
+    try:
+        payload = _b64decode(payload_text)
+        signature = _b64decode(signature_text)
+    except (ValueError, binascii.Error):
+        return None
+    if not hmac.compare_digest(signature, _signature(payload)):
+        return None
+    decoded = json.loads(payload)
+    if decoded.get('q') != list(scope):
+        return None
+    return decoded['s']
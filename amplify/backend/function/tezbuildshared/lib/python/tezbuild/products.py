@@ -0,0 +1,308 @@
+import json
+
+from boto3.dynamodb.conditions import Attr
+
+from tezbuild.facets import FacetIndex, bit_count, bit_numbers, build_bitmaps
+from tezbuild.keys import SLICE_ATTRIBUTES, query_facility_items
+from tezbuild.manifest import public_item, public_projection
+from tezbuild.ordering import product_sort_value, top_k
+from tezbuild.pagination import encode_cursor
+from tezbuild.ranges import RangeIndex, build_ranges
+from tezbuild.render import encode_product_page
+from tezbuild.repository import (
+    get_item, query_products_by_category, query_products_by_category_page, query_products_by_sku,
+    query_products_by_sku_page, query_products_by_skus
+)
+from tezbuild.responses import encode_body
+from tezbuild.snapshot import PG_NON_FILTER_ATTRIBUTES
+
+# Public product reads, shared by the productspublic actions and the navpublic page bundle. Each
+# read is served from the catalog snapshot while it is current and from the table otherwise, and
+# returns (statusCode, encoded_body). Cursors are scoped to the action that continues them, so a
+# page started here can be continued through productspublic.
+PRODUCT_SCOPE = 'getProductById'
+GROUP_SCOPE = 'getProductsByPGID'
+FILTER_SCOPE = 'filterProducts'
+
+
+def current_public_items(catalog, items):
+    # drops stale products, then the attributes that were only read to tell which are stale
+    return [public_item(item) for item in catalog.current_items(items)]
+
+
+def with_current_filter(catalog, query_kwargs, category=None):
+    # Pages read from the table drop stale products in the query's FilterExpression, so that a page is
+    # only cut once it holds limit current products: a page that came back short would read as the
+    # last one. current_public_items still runs on the page to drop the attributes read for this.
+    condition = catalog.current_condition(category)
+    if condition is not None:
+        if 'FilterExpression' in query_kwargs:
+            condition = query_kwargs['FilterExpression'] & condition
+        query_kwargs['FilterExpression'] = condition
+    return query_kwargs
+
+
+def next_page(scope, limit, items, state):
+    # snapshot reads fetch one item more than the page, to tell whether there is a next page
+    if len(items) > limit:
+        del items[limit:]
+        return encode_cursor(scope, state)
+    return None
+
+
+def load_products_by_sku(table, catalog, id, limit=None, cursor=None):
+    # without a limit the response is every product of the SKU, with one it is a page and its NextCursor
+    scope = (PRODUCT_SCOPE, id)
+    snapshot = catalog.current()
+    if snapshot and (cursor is None or cursor['source'] == 'snapshot'):
+        if cursor and cursor['version'] != snapshot.version:
+            return 409, encode_body('Cursor expired')
+        if limit is None:
+            return 200, encode_body(snapshot.get_products_by_sku(id))
+
+        offset = cursor['offset'] if cursor else 0
+        items = snapshot.get_products_by_sku(id, offset, limit + 1)
+        next_cursor = next_page(scope, limit, items, {'source': 'snapshot', 'version': snapshot.version, 'offset': offset + limit})
+        return 200, encode_body({'Items': items, 'NextCursor': next_cursor})
+
+    if cursor and cursor['source'] == 'snapshot':
+        return 409, encode_body('Cursor expired')
+
+    if limit is None:
+        return 200, encode_body(current_public_items(catalog, query_products_by_sku(table, id, **public_projection())))
+
+    query_kwargs = with_current_filter(catalog, public_projection())
+    items, start_key = query_products_by_sku_page(table, id, limit, cursor['key'] if cursor else None, **query_kwargs)
+    next_cursor = encode_cursor(scope, {'source': 'table', 'key': start_key}) if start_key else None
+    return 200, encode_body({'Items': current_public_items(catalog, items), 'NextCursor': next_cursor})
+
+
+def load_products_by_skus(table, catalog, ids):
+    # {sku: products} with every requested SKU present, not encoded
+    snapshot = catalog.current()
+    if snapshot:
+        return {id: snapshot.get_products_by_sku(id) for id in ids}
+    return {
+        id: current_public_items(catalog, items)
+        for id, items in query_products_by_skus(table, ids, **public_projection()).items()
+    }
+
+
+def group_attributes(table, pgid):
+    # (product group item, None), or (None, error response) if it is missing or has no Category
+    attributes = get_item(table, 'PG', pgid)
+    if attributes is None:
+        print('PGID not found')
+        return None, (404, encode_body("PGID not found"))
+    if 'Category' not in attributes:
+        print('Category not found in attributes')
+        return None, (400, encode_body('Category not found in attributes'))
+    return attributes, None
+
+
+def group_query_kwargs(attributes):
+    # Category index query arguments for the products of a product group item: the group's
+    # attributes as a filter, and public attributes only, so supplier costs never leave the table
+    filter_expression = None
+    for key, value in attributes.items():
+        if key in PG_NON_FILTER_ATTRIBUTES:
+            continue
+        if filter_expression is None:
+            filter_expression = Attr(key).eq(value)
+        else:
+            filter_expression = filter_expression & Attr(key).eq(value)
+
+    query_kwargs = public_projection(attributes['Category'])
+    if filter_expression is not None:
+        query_kwargs['FilterExpression'] = filter_expression
+    return query_kwargs
+
+
+def query_group_products(table, catalog, attributes):
+    # Every product of a product group item, for reads that index or sort the whole group. A group that
+    # fixes the first slice attribute of its category (e.g. Profile for lumber) is read as one
+    # FacilitySortKey slice per supplier, so the read is bounded by the group rather than its category.
+    category = attributes['Category']
+    query_kwargs = group_query_kwargs(attributes)
+    slice_attributes = SLICE_ATTRIBUTES.get(category, ())
+    if not slice_attributes or slice_attributes[0] not in attributes or not catalog.facilities:
+        return query_products_by_category(table, category, **query_kwargs)
+    products = []
+    for facility_id in catalog.facilities:
+        products.extend(query_facility_items(table, facility_id, category, attributes[slice_attributes[0]], **query_kwargs))
+    return products
+
+
+def load_product_group(table, catalog, pgid, limit=None, cursor=None):
+    # without a limit the response is the whole group, with one it is a page and its NextCursor
+    scope = (GROUP_SCOPE, pgid)
+    snapshot = catalog.current()
+    if snapshot and (cursor is None or cursor['source'] == 'snapshot'):
+        if cursor and cursor['version'] != snapshot.version:
+            return 409, encode_body('Cursor expired')
+
+        offset = cursor['offset'] if cursor else 0
+        group = snapshot.get_product_group(pgid, offset, None if limit is None else limit + 1)
+        if group is None:
+            print('PGID not found')
+            return 404, encode_body("PGID not found")
+        attributes, items = group
+        if 'Category' not in attributes:
+            print('Category not found in attributes')
+            return 400, encode_body('Category not found in attributes')
+
+        next_cursor = None
+        if limit is not None:
+            next_cursor = next_page(scope, limit, items, {'source': 'snapshot', 'version': snapshot.version, 'offset': offset + limit})
+        return 200, encode_product_page(pgid, items, next_cursor)
+
+    if cursor and cursor['source'] == 'snapshot':
+        return 409, encode_body('Cursor expired')
+
+    attributes = get_item(table, 'PG', pgid)
+    print('attributes:', attributes)
+
+    if attributes is None:
+        print('PGID not found')
+        return 404, encode_body("PGID not found")
+
+    if 'Category' not in attributes:
+        print('Category not found in attributes')
+        return 400, encode_body('Category not found in attributes')
+
+    category = attributes['Category']
+    query_kwargs = group_query_kwargs(attributes)
+
+    if limit is None:
+        items = current_public_items(catalog, query_products_by_category(table, category, **query_kwargs))
+        return 200, encode_product_page(pgid, items)
+
+    query_kwargs = with_current_filter(catalog, query_kwargs, category)
+    items, start_key = query_products_by_category_page(table, category, limit, cursor['key'] if cursor else None, **query_kwargs)
+    next_cursor = encode_cursor(scope, {'source': 'table', 'key': start_key}) if start_key else None
+    return 200, encode_product_page(pgid, current_public_items(catalog, items), next_cursor)
+
+
+def sorted_group_scope(pgid, sort, descending, quantity):
+    return (GROUP_SCOPE, pgid, sort, 'desc' if descending else 'asc', quantity)
+
+
+def load_sorted_product_group(table, catalog, pgid, sort, descending=False, quantity=None, limit=None, cursor=None):
+    # A product group ordered by one of ordering.SORT_FIELDS (price is the price of quantity pieces),
+    # ties in SKU order. Only the products up to the end of the page are selected, so the first
+    # page of a large group costs a heap of limit products. The cursor holds the catalog version and
+    # an offset, so it expires when the catalog changes. SKUs appear in the order of their first product.
+    scope = sorted_group_scope(pgid, sort, descending, quantity)
+    offset = cursor['offset'] if cursor else 0
+    if cursor and cursor['version'] != catalog.catalog_version:
+        return 409, encode_body('Cursor expired')
+
+    count = None if limit is None else offset + limit + 1
+    snapshot = catalog.current()
+    if snapshot:
+        group = snapshot.product_group_members(pgid)
+        if group is None:
+            print('PGID not found')
+            return 404, encode_body("PGID not found")
+        if 'Category' not in group[0]:
+            print('Category not found in attributes')
+            return 400, encode_body('Category not found in attributes')
+        numbers = group[1]
+        selected = top_k(zip(snapshot.sort_values(numbers, sort, quantity), numbers, numbers), count, descending)
+        items = snapshot.products_at([number for _, _, number in selected[offset:]])
+    else:
+        attributes, error = group_attributes(table, pgid)
+        if error:
+            return error
+        products = current_public_items(catalog, query_group_products(table, catalog, attributes))
+        products.sort(key=lambda item: (item.get('SKU', ''), item['UniqueId']))
+        entries = ((product_sort_value(product, sort, quantity), number, product) for number, product in enumerate(products))
+        items = [product for _, _, product in top_k(entries, count, descending)[offset:]]
+
+    next_cursor = None
+    if limit is not None:
+        next_cursor = next_page(scope, limit, items, {'version': catalog.catalog_version, 'offset': offset + limit})
+    return 200, encode_product_page(pgid, items, next_cursor)
+
+
+def filter_scope(pgid, category, filters, ranges=None):
+    # filters and ranges are normalized (see facets.normalize_filters and ranges.normalize_ranges), so
+    # equal filters give equal scopes
+    return (FILTER_SCOPE, pgid or '', category or '', json.dumps(filters, sort_keys=True), json.dumps(ranges or {}, sort_keys=True))
+
+
+def load_filtered_products(table, catalog, pgid, category, filters, limit, cursor=None, ranges=None):
+    # A page of the products of a product group or category that match filters and fall within
+    # ranges, with the number of them and the facet counts. Ranges narrow the scope the facets are
+    # counted in. Pages are in SKU order; the cursor holds the catalog version and an offset, so it
+    # expires when the catalog changes.
+    scope = filter_scope(pgid, category, filters, ranges)
+    offset = cursor['offset'] if cursor else 0
+    snapshot = catalog.current()
+    if cursor and cursor['version'] != catalog.catalog_version:
+        return 409, encode_body('Cursor expired')
+
+    if snapshot:
+        index = snapshot.facet_index()
+        if pgid:
+            group = snapshot.product_group_bitmap(pgid)
+            if group is None:
+                print('PGID not found')
+                return 404, encode_body("PGID not found")
+            if 'Category' not in group[0]:
+                print('Category not found in attributes')
+                return 400, encode_body('Category not found in attributes')
+            products = group[1]
+        else:
+            products = index.scope('Category', category)
+        if ranges:
+            products = snapshot.range_index().select(
+                products, ranges, lambda numbers, quantity: snapshot.sort_values(numbers, 'price', quantity)
+            )
+        matches, facets = index.select(products, filters)
+        items = snapshot.products_at(bit_numbers(matches, offset, limit + 1))
+    else:
+        if pgid:
+            attributes, error = group_attributes(table, pgid)
+            if error:
+                return error
+            products = query_group_products(table, catalog, attributes)
+        else:
+            products = query_products_by_category(table, category, **public_projection(category))
+
+        # the same index the snapshot holds, built over the products just read, in the snapshot's order
+        products = current_public_items(catalog, products)
+        products.sort(key=lambda item: (item.get('SKU', ''), item['UniqueId']))
+        index = FacetIndex(build_bitmaps(products), len(products))
+        in_scope = index.all
+        if ranges:
+            in_scope = RangeIndex(build_ranges(products)).select(
+                in_scope, ranges,
+                lambda numbers, quantity: [product_sort_value(products[number], 'price', quantity) for number in numbers]
+            )
+        matches, facets = index.select(in_scope, filters)
+        items = [products[number] for number in bit_numbers(matches, offset, limit + 1)]
+
+    state = {'version': catalog.catalog_version, 'offset': offset + limit}
+    next_cursor = next_page(scope, limit, items, state)
+    return 200, encode_product_page(pgid or category, items, next_cursor, {'Total': bit_count(matches), 'Facets': facets})
+
+
+def load_lumber_stock(table, catalog, profiles, filters):
+    # the current public lumber products of the profiles that match filters, e.g. the stock a cut list
+    # can be cut from
+    snapshot = catalog.current()
+    if snapshot:
+        index = snapshot.facet_index()
+        scope = 0
+        for profile in profiles:
+            scope |= index.scope('Profile', profile)
+        matches, _ = index.select(scope & index.scope('Category', 'lumber'), filters)
+        return snapshot.products_at(bit_numbers(matches))
+
+    query_kwargs = public_projection('lumber')
+    query_kwargs['FilterExpression'] = Attr('Profile').is_in(list(profiles))
+    products = current_public_items(catalog, query_products_by_category(table, 'lumber', **query_kwargs))
+    index = FacetIndex(build_bitmaps(products), len(products))
+    matches, _ = index.select(index.all, filters)
+    return [products[number] for number in bit_numbers(matches)]
@@ -0,0 +1,124 @@
+from bisect import bisect_right
+from collections import namedtuple
+
+from tezbuild.bundles import bundle_size
+
+# Pricing of quantities against a product's Prices, a list of (price per piece, pack size) tiers.
+#
+#   'a' (adder)   the quantity is filled with the largest packs first, each pack at its own price, the
+#                 way the storefront prices a quantity
+#   'b' (break)   every piece is charged at the price of the largest pack size the quantity reaches
+#
+# Quantities come in multiples of the smallest pack size, and no more than the inventory when the
+# supplier reports one. A product's tiers are compiled once into sorted arrays, so pricing a quantity
+# is a binary search for the largest pack size it reaches plus, for adder pricing, a walk down from there.
+
+TierTable = namedtuple(
+    'TierTable',
+    ('product_id', 'facility_id', 'price_type', 'pack_sizes', 'prices', 'inventory', 'measures', 'length', 'bundle_size')
+)
+
+# per piece measures that a quote adds up, by category
+QUOTE_MEASURES = {
+    'lumber': ('Weight', 'BDFT'),
+    'sheet_good': ('Weight', 'SQFT'),
+}
+ALL_QUOTE_MEASURES = ('Weight', 'BDFT', 'SQFT')
+
+# lines a single quoteCart request may have
+MAX_CART_LINES = 1000
+
+
+def compile_tiers(product):
+    # a TierTable for the product, or None if it has no prices
+    tiers = sorted(((int(pack_size), float(price)) for price, pack_size in product.get('Prices') or []))
+    if not tiers:
+        return None
+    inventory = product.get('Inventory')
+    length = product.get('Length')
+    measures = {
+        measure: float(product[measure])
+        for measure in QUOTE_MEASURES.get(product.get('Category'), ())
+        if product.get(measure) is not None
+    }
+    return TierTable(
+        product.get('UniqueId'),
+        product.get('FacilityId'),
+        product.get('PriceType', 'a'),
+        [pack_size for pack_size, _ in tiers],
+        [price for _, price in tiers],
+        None if inventory is None else int(inventory),
+        measures,
+        None if length is None else float(length),
+        bundle_size(product),
+    )
+
+
+def tier_total(table, quantity):
+    # the price of quantity pieces, or None if the product cannot supply it
+    if quantity < 1 or quantity % table.pack_sizes[0] != 0:
+        return None
+    if table.inventory is not None and table.inventory < quantity:
+        return None
+
+    # the largest pack size the quantity reaches
+    tier = bisect_right(table.pack_sizes, quantity) - 1
+    if table.price_type == 'b':
+        return round(table.prices[tier] * quantity, 5)
+
+    remainder = quantity
+    total = 0.0
+    while remainder and tier >= 0:
+        pack_size = table.pack_sizes[tier]
+        total += (remainder // pack_size) * table.prices[tier] * pack_size
+        remainder %= pack_size
+        tier -= 1
+    return round(total, 5)
+
+
+def best_tier_total(tables, quantity):
+    # (total, table) of the cheapest product able to supply quantity, or None
+    best = None
+    for table in tables:
+        total = tier_total(table, quantity)
+        if total is not None and (best is None or total < best[0] or (total == best[0] and table.facility_id < best[1].facility_id)):
+            best = (total, table)
+    return best
+
+
+def quote_cart(lines, tables_by_sku):
+    # Quote (sku, quantity) lines against the tier tables of every product of each SKU. Each line is
+    # priced at its cheapest supplier; a line that no supplier can fill is returned with Available
+    # false and left out of the order totals.
+    quoted = []
+    totals = {'Total': 0.0}
+    for measure in ALL_QUOTE_MEASURES:
+        totals[measure] = 0.0
+    unavailable = 0
+    for sku, quantity in lines:
+        best = best_tier_total(tables_by_sku.get(sku, ()), quantity)
+        if best is None:
+            quoted.append({'SKU': sku, 'Quantity': quantity, 'Available': False})
+            unavailable += 1
+            continue
+
+        total, table = best
+        line = {
+            'SKU': sku,
+            'Quantity': quantity,
+            'Available': True,
+            'ProductId': table.product_id,
+            'FacilityId': table.facility_id,
+            'UnitPrice': round(total / quantity, 5),
+            'Total': total,
+        }
+        for measure, per_piece in table.measures.items():
+            line[measure] = round(per_piece * quantity, 3)
+            totals[measure] += per_piece * quantity
+        totals['Total'] += total
+        quoted.append(line)
+
+    order = {key: round(value, 5 if key == 'Total' else 3) for key, value in totals.items()}
+    order['Lines'] = len(quoted)
+    order['Unavailable'] = unavailable
+    return {'Lines': quoted, 'Order': order}
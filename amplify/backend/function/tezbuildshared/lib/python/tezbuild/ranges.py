@@ -0,0 +1,132 @@
+import struct
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+
+from tezbuild.facets import bit_numbers, bitmap_of
+
+# Numeric range filters, e.g. lumber from 120 to 192 inches long for under $40 a piece. Every range
+# attribute has its products' values sorted, so a range is two bisects and its products are the
+# contiguous run between them, turned into a bitmap (see facets.py) in time proportional to the run.
+#
+# In the snapshot the sorted arrays are stored in one section, attribute by attribute:
+#
+#   header   attribute count
+#   entries  (attribute, first value, value count), the attribute as a string table ref
+#   values   f64 values of every attribute, ascending within each attribute
+#   numbers  u32 product record number of each value
+#
+# A price depends on the quantity, so it cannot be sorted ahead of time. It is priced (see
+# ordering.py) only for the products already in scope and within every other range.
+
+RANGE_ATTRIBUTES = ('Length', 'Width', 'Thickness')
+
+# the total price of a quantity, e.g. {"Price": {"max": 500, "quantity": 52}}
+PRICE_RANGE = 'Price'
+
+RANGES_HEADER = struct.Struct('<I')
+RANGE_ENTRY = struct.Struct('<III')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def build_ranges(products):
+    # {attribute: (sorted values, product numbers)} over the products, numbered in list order
+    ranges = {}
+    for attribute in RANGE_ATTRIBUTES:
+        pairs = sorted(
+            (float(product[attribute]), number)
+            for number, product in enumerate(products)
+            if _is_number(product.get(attribute))
+        )
+        ranges[attribute] = (tuple(value for value, _ in pairs), tuple(number for _, number in pairs))
+    return ranges
+
+
+def encode_ranges(ranges, add_string):
+    # the snapshot section for build_ranges' result; add_string returns a string table ref
+    entries = bytearray()
+    values = bytearray()
+    numbers = bytearray()
+    start = 0
+    for attribute in sorted(ranges):
+        attribute_values, attribute_numbers = ranges[attribute]
+        entries += RANGE_ENTRY.pack(add_string(attribute), start, len(attribute_values))
+        values += struct.pack(f'<{len(attribute_values)}d', *attribute_values)
+        numbers += struct.pack(f'<{len(attribute_numbers)}I', *attribute_numbers)
+        start += len(attribute_values)
+    return RANGES_HEADER.pack(len(ranges)) + bytes(entries) + bytes(values) + bytes(numbers)
+
+
+def decode_ranges(buffer, offset, string):
+    # the inverse of encode_ranges; string resolves a string table ref
+    (count,) = RANGES_HEADER.unpack_from(buffer, offset)
+    entries_offset = offset + RANGES_HEADER.size
+    values_offset = entries_offset + count * RANGE_ENTRY.size
+    entries = list(RANGE_ENTRY.iter_unpack(buffer[entries_offset:values_offset]))
+    total = sum(value_count for _, _, value_count in entries)
+    numbers_offset = values_offset + total * 8
+    ranges = {}
+    for attribute_ref, start, value_count in entries:
+        ranges[string(attribute_ref)] = (
+            struct.unpack_from(f'<{value_count}d', buffer, values_offset + start * 8),
+            struct.unpack_from(f'<{value_count}I', buffer, numbers_offset + start * 4),
+        )
+    return ranges
+
+
+def normalize_ranges(ranges):
+    # {attribute: [min, max]} from a request's ranges, with [min, max, quantity] for the price, or
+    # None if they are invalid. Either bound may be left out; both are inclusive.
+    if not isinstance(ranges, dict):
+        return None
+    normalized = {}
+    for attribute, bounds in ranges.items():
+        if attribute not in RANGE_ATTRIBUTES + (PRICE_RANGE,) or not isinstance(bounds, dict):
+            return None
+        low, high = bounds.get('min'), bounds.get('max')
+        if low is None and high is None:
+            return None
+        if any(bound is not None and not _is_number(bound) for bound in (low, high)):
+            return None
+        if low is not None and high is not None and low > high:
+            return None
+        normalized[attribute] = [low, high]
+        if attribute == PRICE_RANGE:
+            quantity = bounds.get('quantity', 1)
+            if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+                return None
+            normalized[attribute].append(quantity)
+    return dict(sorted(normalized.items()))
+
+
+def _within(value, low, high):
+    return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+
+class RangeIndex:
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def bitmap(self, attribute, low, high):
+        # the products whose value of attribute is from low to high, either of which may be None
+        values, numbers = self.ranges.get(attribute, ((), ()))
+        start = 0 if low is None else bisect_left(values, low)
+        stop = len(values) if high is None else bisect_right(values, high)
+        return bitmap_of(numbers[start:stop])
+
+    def select(self, scope, ranges, price_values):
+        # the products in scope within every range; price_values(numbers, quantity) returns the
+        # price of each product (see ordering.py), or None where it cannot supply the quantity
+        matches = scope
+        for attribute, bounds in ranges.items():
+            if attribute != PRICE_RANGE:
+                matches &= self.bitmap(attribute, bounds[0], bounds[1])
+        if PRICE_RANGE in ranges and matches:
+            low, high, quantity = ranges[PRICE_RANGE]
+            numbers = bit_numbers(matches)
+            matches = bitmap_of(
+                number for number, value in zip(numbers, price_values(numbers, quantity)) if _within(value, low, high)
+            )
+        return matches
@@ -0,0 +1,84 @@
+import json
+
+from tezbuild.responses import decimal_default
+
+# Response bodies of the public read actions. The public functions and the static catalog publisher
+# both render through these, so a static object and the API response for it are identical.
+
+
+def page_items_from_snapshot(snapshot, id):
+    # (navigation item, group items, product items) of a nav page, or None if it does not exist
+    navigation_item = snapshot.get_item('N', id)
+    if navigation_item is None:
+        return None
+
+    pg_items = []
+    for pgid in navigation_item.get('PGIDs', []):
+        item = snapshot.get_item('PG', pgid)
+        if item is not None:
+            pg_items.append(item)
+
+    pid_items = []
+    for pid in navigation_item.get('PIDs', []):
+        items = snapshot.get_products_by_sku(pid)
+        if items:
+            pid_items.append(items[0])  # Assuming we take the first match
+
+    return navigation_item, pg_items, pid_items
+
+
+def page_cards(navigation_item, pg_items, pid_items):
+    title = navigation_item.get('Title', 'No Title')
+
+    # Construct the cards list
+    cards = []
+    for item in pg_items:
+        cards.append({
+            'heading': item.get('Heading', ''),
+            'subheading': item.get('Subheading', ''),
+            'id': item['UniqueId'],
+            'image': item.get('Image', ''),
+            'type': 'group'
+        })
+    for item in pid_items:
+        cards.append({
+            'heading': item.get('Heading', ''),
+            'subheading': item.get('Subheading', ''),
+            'id': item['SKU'],
+            'image': item.get('Image', ''),
+            'type': 'product'
+        })
+
+    return {
+        'title': title,
+        'cards': cards
+    }
+
+
+def search_cards(results):
+    # product cards for (sku, score, product) search results, in the shape of page_cards
+    return [
+        {
+            'heading': product.get('Heading', ''),
+            'subheading': product.get('Subheading', ''),
+            'id': sku,
+            'image': product.get('Image', ''),
+            'type': 'product',
+            'score': round(score, 4)
+        }
+        for sku, score, product in results
+    ]
+
+
+def encode_product_page(pgid, items, next_cursor=None, extra=None):
+    # Each item is encoded as it is read and only the encoded fragments are grouped by SKU, so a
+    # page is assembled without building one large response object and encoding it again at the end.
+    # A SKU can continue on the next page, in which case the client appends to it. extra holds
+    # further top level fields, e.g. the facet counts of a filtered page.
+    fragments = {}
+    for item in items:
+        fragments.setdefault(item.get('SKU') or '', []).append(json.dumps(item, default=decimal_default))
+
+    products = ', '.join(f'{json.dumps(sku)}: [{", ".join(encoded)}]' for sku, encoded in fragments.items())
+    fields = ''.join(f', {json.dumps(key)}: {json.dumps(value, default=decimal_default)}' for key, value in (extra or {}).items())
+    return f'{{"Products": {{{products}}}, "Id": {json.dumps(pgid)}, "NextCursor": {json.dumps(next_cursor)}{fields}}}'
@@ -0,0 +1,184 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.dynamodb.conditions import Key
+
+from tezbuild.aws import dynamodb_resource
+
+# Access patterns of the TezBuildData table. Every read that can span pages follows
+# LastEvaluatedKey, and batch reads are chunked to the BatchGetItem limit with unprocessed
+# keys retried, so callers never silently get a partial result.
+BATCH_GET_LIMIT = 100
+BATCH_GET_ATTEMPTS = 8
+BACKOFF_BASE = 0.05
+BACKOFF_CAP = 2
+
+# concurrent queries per fan-out, well within the client's connection pool
+QUERY_WORKERS = 16
+
+
+def backoff(attempt):
+    # full jitter, so retries from concurrent containers do not line up
+    time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)))
+
+
+def query_all(table, **kwargs):
+    query_kwargs = dict(kwargs)
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def query_page(table, limit, key_attributes, start_key=None, **kwargs):
+    # Returns up to limit items and the key to continue from, or None after the last page.
+    # DynamoDB applies its own Limit before any FilterExpression, so a page is collected over as
+    # many reads as it takes. When a read overshoots, the page is cut and continues after its last
+    # item: the item's table and index key attributes (key_attributes) are a valid ExclusiveStartKey.
+    query_kwargs = dict(kwargs)
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    items = []
+    while True:
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        if len(items) > limit:
+            items = items[:limit]
+            return items, {name: items[-1][name] for name in key_attributes}
+        if 'LastEvaluatedKey' not in response:
+            return items, None
+        if len(items) == limit:
+            return items, response['LastEvaluatedKey']
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def scan_all(table, **kwargs):
+    scan_kwargs = dict(kwargs)
+    items = []
+    while True:
+        response = table.scan(**scan_kwargs)
+        items.extend(response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            return items
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def get_item(table, item_type, unique_id, **kwargs):
+    response = table.get_item(Key={'ItemType': item_type, 'UniqueId': unique_id}, **kwargs)
+    return response.get('Item')
+
+
+def query_products_by_sku(table, sku, **kwargs):
+    return query_all(
+        table,
+        IndexName='SKU',
+        KeyConditionExpression=Key('ItemType').eq('P') & Key('SKU').eq(sku),
+        **kwargs
+    )
+
+
+def query_products_by_sku_page(table, sku, limit, start_key=None, **kwargs):
+    return query_page(
+        table, limit, ('ItemType', 'UniqueId', 'SKU'), start_key,
+        IndexName='SKU',
+        KeyConditionExpression=Key('ItemType').eq('P') & Key('SKU').eq(sku),
+        **kwargs
+    )
+
+
+def query_products_by_skus(table, skus, **kwargs):
+    # one SKU index query per distinct SKU, run concurrently; returns {sku: items} with every sku
+    # present. Table actions only call the shared client, which is thread safe.
+    skus = list(dict.fromkeys(skus))
+    if not skus:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(QUERY_WORKERS, len(skus))) as executor:
+        return dict(zip(skus, executor.map(lambda sku: query_products_by_sku(table, sku, **kwargs), skus)))
+
+
+def query_products_by_category(table, category, **kwargs):
+    return query_all(
+        table,
+        IndexName='Category',
+        KeyConditionExpression=Key('ItemType').eq('P') & Key('Category').eq(category),
+        **kwargs
+    )
+
+
+def query_products_by_category_page(table, category, limit, start_key=None, **kwargs):
+    return query_page(
+        table, limit, ('ItemType', 'UniqueId', 'Category'), start_key,
+        IndexName='Category',
+        KeyConditionExpression=Key('ItemType').eq('P') & Key('Category').eq(category),
+        **kwargs
+    )
+
+
+class BatchGetError(RuntimeError):
+    # keys were still unprocessed after every retry; items holds what was read, in request order
+    def __init__(self, items, unprocessed_keys):
+        super().__init__(f"{len(unprocessed_keys)} keys still unprocessed after {BATCH_GET_ATTEMPTS} attempts")
+        self.items = items
+        self.unprocessed_keys = unprocessed_keys
+
+
+def _batch_get_chunk(table, keys, kwargs):
+    # returns (items, keys still unprocessed after every retry)
+    request = {table.name: dict(kwargs, Keys=keys)}
+    items = []
+    attempt = 0
+    while True:
+        response = dynamodb_resource().batch_get_item(RequestItems=request)
+        items.extend(response['Responses'].get(table.name, []))
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return items, []
+        attempt += 1
+        if attempt >= BATCH_GET_ATTEMPTS:
+            return items, request[table.name]['Keys']
+        backoff(attempt)
+
+
+def batch_get_items(table, keys, **kwargs):
+    # Reads keys in chunks of BATCH_GET_LIMIT, concurrently, and retries unprocessed keys with backoff.
+    # Items are returned in the order of keys, without duplicates; keys that do not exist are left out.
+    # kwargs (e.g. ProjectionExpression) apply to every chunk, and a projection must keep the key
+    # attributes so items can be matched to their keys. Raises BatchGetError if any key is still
+    # unprocessed after every retry, rather than returning a partial result as if it were complete.
+    if not keys:
+        return []
+    key_names = tuple(keys[0])
+    unique_keys = list({tuple(key[name] for name in key_names): key for key in keys}.values())
+    chunks = [unique_keys[i:i + BATCH_GET_LIMIT] for i in range(0, len(unique_keys), BATCH_GET_LIMIT)]
+
+    with ThreadPoolExecutor(max_workers=min(QUERY_WORKERS, len(chunks))) as executor:
+        results = list(executor.map(lambda chunk: _batch_get_chunk(table, chunk, kwargs), chunks))
+
+    found = {}
+    unprocessed_keys = []
+    for items, unprocessed in results:
+        for item in items:
+            found[tuple(item.get(name) for name in key_names)] = item
+        unprocessed_keys.extend(unprocessed)
+
+    items = []
+    for key in unique_keys:
+        item = found.get(tuple(key[name] for name in key_names))
+        if item is not None:
+            items.append(item)
+    if unprocessed_keys:
+        raise BatchGetError(items, unprocessed_keys)
+    return items
+
+
+def batch_write_items(table, puts=(), deletes=()):
+    # the batch writer sends 25 requests at a time and resends unprocessed items
+    with table.batch_writer(overwrite_by_pkeys=['ItemType', 'UniqueId']) as batch:
+        for item in puts:
+            batch.put_item(Item=item)
+        for key in deletes:
+            batch.delete_item(Key={'ItemType': key['ItemType'], 'UniqueId': key['UniqueId']})
@@ -0,0 +1,84 @@
+import base64
+import gzip
+import json
+from decimal import Decimal
+
+HEADERS = {
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'OPTIONS,POST,GET',
+    'Access-Control-Expose-Headers': 'X-Cache',
+    'Content-Type': 'application/json'
+}
+
+# smaller bodies are not worth compressing; level 5 is most of level 9's ratio at a fraction of the cost
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL = 5
+
+
+def decimal_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def encode_body(body):
+    # Costs are internal and dropped from lists of items, bare or as the Items of a page
+    items = body.get('Items') if isinstance(body, dict) else body
+    if isinstance(items, list):
+        for item in items:
+            if isinstance(item, dict) and 'Costs' in item:
+                del item['Costs']
+    return json.dumps(body, default=decimal_default)
+
+
+def send_encoded_response(statusCode, encoded_body, headers=None):
+    # for bodies that were encoded earlier, e.g. ones held in a response cache
+    response_headers = dict(HEADERS)
+    if headers:
+        response_headers.update(headers)
+    return {
+        'statusCode': statusCode,
+        'headers': response_headers,
+        'body': encoded_body
+    }
+
+
+def send_response(statusCode, body):
+    return send_encoded_response(statusCode, encode_body(body))
+
+
+def request_header(event, name):
+    # API Gateway passes headers as sent, so look them up case-insensitively
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def read_body(event):
+    # application/json is a binary media type so that compressed responses reach clients as binary,
+    # which makes JSON request bodies arrive base64 encoded
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+    return json.loads(body)
+
+
+def negotiate_response(event, response):
+    # Gzips larger successful bodies for clients that accept it. The API returns isBase64Encoded
+    # bodies as binary. There are no conditional responses, since every action is a POST and only a
+    # conditional GET is answered with 304.
+    if response['statusCode'] != 200:
+        return response
+
+    headers = response['headers']
+    headers['Vary'] = 'Accept-Encoding'
+    accept_encoding = (request_header(event, 'Accept-Encoding') or '').lower()
+    if len(response['body']) >= GZIP_MIN_BYTES and 'gzip' in accept_encoding:
+        compressed = gzip.compress(response['body'].encode('utf-8'), compresslevel=GZIP_LEVEL)
+        headers['Content-Encoding'] = 'gzip'
+        response['body'] = base64.b64encode(compressed).decode('ascii')
+        response['isBase64Encoded'] = True
+    return response
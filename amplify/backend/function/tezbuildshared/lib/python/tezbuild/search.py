@@ -0,0 +1,294 @@
+import heapq
+import math
+import re
+import struct
+from bisect import bisect_left
+from decimal import Decimal
+
+# Full text product search. The index is built at publish time as one section of the catalog
+# snapshot (see snapshot.py) and read in place from the mmapped file, so a query never touches
+# DynamoDB. Documents are SKUs, numbered in the order of the snapshot's SKU index.
+#
+#   header        term count, doc count, posting count, average doc length
+#   term_offsets  u32 offset of each term in term_data, plus one trailing end offset
+#   term_data     utf-8 bytes of every term, sorted
+#   terms         (postings_start, postings_count) for each term, in term order
+#   postings      (doc, term frequency), sorted by doc within each term
+#   doc_lengths   u16 token count of each doc
+#
+# Queries are ranked with BM25. The last query term also matches terms it is a prefix of, so
+# results keep up with typing, and a term that is not in the index matches terms one edit away
+# (an insertion, deletion, substitution or transposition of adjacent characters).
+
+SEARCH_HEADER = struct.Struct('<IIId')
+U32 = struct.Struct('<I')
+TERM = struct.Struct('<II')
+POSTING = struct.Struct('<IH')
+DOC_LENGTH = struct.Struct('<H')
+
+# attributes whose words are searchable, besides the dimension tokens of dimension_terms
+TEXT_ATTRIBUTES = ('Heading', 'Subheading', 'Species', 'Grade', 'Brand', 'PanelType')
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# expanded terms count for less than the term that was typed
+PREFIX_WEIGHT = 0.8
+TYPO_WEIGHT = 0.6
+
+# a short prefix would expand to most of the vocabulary, and short words have too many neighbours to correct
+MIN_PREFIX_LENGTH = 2
+MIN_TYPO_LENGTH = 4
+MAX_EXPANSIONS = 32
+
+DEFAULT_SEARCH_RESULTS = 20
+MAX_SEARCH_RESULTS = 100
+
+# words, numbers and dimensions like 2x4, 5/4x6 or 0.75 stay whole
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[./][0-9]+)*(?:x[0-9]+(?:[./][0-9]+)*)*[a-z]*")
+
+UNIT_ALIASES = {
+    'ft': 'ft', 'feet': 'ft', 'foot': 'ft', "'": 'ft',
+    'in': 'in', 'inch': 'in', 'inches': 'in', '"': 'in',
+    'mm': 'mm',
+}
+NUMBER_WITH_UNIT = re.compile(r"^([0-9]+(?:[./][0-9]+)?)(ft|feet|foot|in|inch|inches|mm)$")
+
+# thicknesses of sheet goods as shoppers write them
+INCH_FRACTIONS = {0.25: '1/4', 0.375: '3/8', 0.5: '1/2', 0.625: '5/8', 0.75: '3/4'}
+
+
+def _number(value):
+    # 96.0 -> '96', 0.75 -> '0.75'
+    value = float(value)
+    if value == int(value):
+        return str(int(value))
+    return f"{value:g}"
+
+
+def normalize_tokens(text):
+    # Lower case tokens with units folded into their numbers, so "8 ft", "8ft." and "8 feet" are all '8ft'
+    tokens = []
+    for match in re.finditer(TOKEN_PATTERN.pattern + r"|['\"]", text.lower()):
+        token = match.group(0)
+        unit = UNIT_ALIASES.get(token)
+        if unit and tokens and re.fullmatch(r"[0-9]+(?:[./][0-9]+)?", tokens[-1]):
+            tokens[-1] += unit
+            continue
+        if token in ("'", '"'):
+            continue
+        number_with_unit = NUMBER_WITH_UNIT.match(token)
+        if number_with_unit:
+            token = number_with_unit.group(1) + UNIT_ALIASES[number_with_unit.group(2)]
+        tokens.append(token)
+    return tokens
+
+
+def dimension_terms(product):
+    # the ways a shopper writes a product's size, e.g. 2x4, 8ft, 96in and 2x4x8 for a 96in. 2x4
+    terms = []
+    category = product.get('Category')
+    length = product.get('Length')
+    if category == 'lumber':
+        profile = product.get('Profile')
+        if profile:
+            terms.append(profile.lower())
+        if isinstance(length, (int, float, Decimal)):
+            terms.append(f"{_number(length)}in")
+            if length % 12 == 0:
+                feet = _number(length / 12)
+                terms.append(f"{feet}ft")
+                if profile:
+                    terms.append(f"{profile.lower()}x{feet}")
+    elif category == 'sheet_good':
+        width = product.get('Width')
+        if isinstance(width, (int, float, Decimal)) and isinstance(length, (int, float, Decimal)):
+            if width % 12 == 0 and length % 12 == 0:
+                terms.append(f"{_number(width / 12)}x{_number(length / 12)}")
+            terms.append(f"{_number(width)}x{_number(length)}")
+        thickness = product.get('Thickness')
+        if isinstance(thickness, (int, float, Decimal)):
+            if product.get('Metric') == 'Y':
+                terms.append(f"{_number(thickness)}mm")
+            else:
+                terms.append(_number(thickness))
+                terms.append(f"{_number(thickness)}in")
+                fraction = INCH_FRACTIONS.get(float(thickness))
+                if fraction:
+                    terms.append(fraction)
+                    terms.append(f"{fraction}in")
+    return terms
+
+
+def product_terms(product):
+    terms = []
+    for attribute in TEXT_ATTRIBUTES:
+        value = product.get(attribute)
+        if isinstance(value, str):
+            terms += normalize_tokens(value)
+    return terms + dimension_terms(product)
+
+
+def build_search_index(docs):
+    # docs is the list of term lists, one per SKU in SKU index order; returns the section bytes
+    postings_by_term = {}
+    doc_lengths = bytearray()
+    total_length = 0
+    for doc, terms in enumerate(docs):
+        counts = {}
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            postings_by_term.setdefault(term, []).append((doc, min(count, 0xffff)))
+        length = min(len(terms), 0xffff)
+        doc_lengths += DOC_LENGTH.pack(length)
+        total_length += length
+
+    term_offsets = bytearray()
+    term_data = bytearray()
+    term_entries = bytearray()
+    postings = bytearray()
+    posting_count = 0
+    # utf-8 preserves code point order, so the terms are sorted alike as str and as bytes
+    for term in sorted(postings_by_term):
+        term_offsets += U32.pack(len(term_data))
+        term_data += term.encode('utf-8')
+        term_entries += TERM.pack(posting_count, len(postings_by_term[term]))
+        for doc, count in postings_by_term[term]:
+            postings += POSTING.pack(doc, count)
+        posting_count += len(postings_by_term[term])
+    term_offsets += U32.pack(len(term_data))
+
+    average_length = total_length / len(docs) if docs else 0.0
+    header = SEARCH_HEADER.pack(len(postings_by_term), len(docs), posting_count, average_length)
+    return header + bytes(term_offsets) + bytes(term_data) + bytes(term_entries) + bytes(postings) + bytes(doc_lengths)
+
+
+def _deletes(term):
+    return {term[:i] + term[i + 1:] for i in range(len(term))}
+
+
+def _edit_distance(a, b):
+    # optimal string alignment distance: insertions, deletions, substitutions and transpositions of
+    # adjacent characters count one edit each
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], before_previous[j - 2] + 1)
+        before_previous, previous = previous, current
+    return previous[-1]
+
+
+class SearchIndex:
+    # Reads a search section in place. The terms are decoded once when the index is opened, which
+    # keeps prefix lookups to a bisect; postings and doc lengths are read per query.
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        term_count, self.doc_count, posting_count, self.average_length = SEARCH_HEADER.unpack_from(buffer, offset)
+        offset += SEARCH_HEADER.size
+        term_offsets = [start for (start,) in U32.iter_unpack(buffer[offset:offset + (term_count + 1) * U32.size])]
+        offset += (term_count + 1) * U32.size
+        term_data = bytes(buffer[offset:offset + term_offsets[-1]])
+        offset += term_offsets[-1]
+        self.terms = [term_data[term_offsets[i]:term_offsets[i + 1]].decode('utf-8') for i in range(term_count)]
+        self._terms_offset = offset
+        offset += term_count * TERM.size
+        self._postings_offset = offset
+        offset += posting_count * POSTING.size
+        self._doc_lengths_offset = offset
+        # typo lookups are built the first time a query needs one
+        self._typo_lookup = None
+
+    def _term_number(self, term):
+        number = bisect_left(self.terms, term)
+        if number < len(self.terms) and self.terms[number] == term:
+            return number
+        return None
+
+    def _postings(self, number):
+        start, count = TERM.unpack_from(self._buffer, self._terms_offset + number * TERM.size)
+        offset = self._postings_offset + start * POSTING.size
+        return POSTING.iter_unpack(self._buffer[offset:offset + count * POSTING.size]), count
+
+    def _doc_length(self, doc):
+        return DOC_LENGTH.unpack_from(self._buffer, self._doc_lengths_offset + doc * DOC_LENGTH.size)[0]
+
+    def _prefix_terms(self, prefix):
+        # the terms that start with prefix are one sorted run from where prefix would be inserted
+        numbers = []
+        number = bisect_left(self.terms, prefix)
+        while number < len(self.terms) and self.terms[number].startswith(prefix) and len(numbers) < MAX_EXPANSIONS:
+            if self.terms[number] != prefix:
+                numbers.append(number)
+            number += 1
+        return numbers
+
+    def _typo_terms(self, term):
+        # Terms one insertion, deletion, substitution or transposition away. Candidates come from
+        # shared single-character deletions, so that the vocabulary is never scanned; that also finds
+        # some terms two edits away (e.g. abc and cab both give ab), which the distance check drops.
+        if self._typo_lookup is None:
+            lookup = {}
+            for number, candidate in enumerate(self.terms):
+                if len(candidate) >= MIN_TYPO_LENGTH - 1:
+                    for key in _deletes(candidate) | {candidate}:
+                        lookup.setdefault(key, []).append(number)
+            self._typo_lookup = lookup
+        candidates = set()
+        for key in _deletes(term) | {term}:
+            candidates.update(self._typo_lookup.get(key, ()))
+        distances = ((_edit_distance(term, self.terms[number]), number) for number in candidates)
+        return [number for distance, number in sorted(distances) if distance <= 1][:MAX_EXPANSIONS]
+
+    def _expansions(self, token, last):
+        # (term number, weight) pairs that a query token matches
+        expansions = []
+        number = self._term_number(token)
+        if number is not None:
+            expansions.append((number, 1.0))
+        if last and len(token) >= MIN_PREFIX_LENGTH:
+            expansions += [(prefixed, PREFIX_WEIGHT) for prefixed in self._prefix_terms(token)]
+        if number is None and len(token) >= MIN_TYPO_LENGTH:
+            matched = {expanded for expanded, _ in expansions}
+            expansions += [(typo, TYPO_WEIGHT) for typo in self._typo_terms(token) if typo not in matched]
+        return expansions
+
+    def _token_scores(self, expansions):
+        # BM25 of one query token for every doc it matches, taking its best expansion per doc
+        scores = {}
+        for number, weight in expansions:
+            postings, count = self._postings(number)
+            idf = math.log(1 + (self.doc_count - count + 0.5) / (count + 0.5))
+            for doc, frequency in postings:
+                length_norm = 1 - BM25_B + BM25_B * self._doc_length(doc) / (self.average_length or 1)
+                score = weight * idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+                if score > scores.get(doc, 0.0):
+                    scores[doc] = score
+        return scores
+
+    def search(self, query, limit=DEFAULT_SEARCH_RESULTS):
+        # (doc, score) of the best matches, best first. Every query token has to match; when no doc
+        # matches them all, docs matching any of them are ranked instead.
+        tokens = list(dict.fromkeys(normalize_tokens(query)))
+        if not tokens:
+            return []
+
+        token_scores = [
+            self._token_scores(self._expansions(token, i == len(tokens) - 1))
+            for i, token in enumerate(tokens)
+        ]
+        matched = [scores for scores in token_scores if scores]
+        if not matched:
+            return []
+
+        docs = set.intersection(*(set(scores) for scores in token_scores))
+        if not docs:
+            docs = set().union(*(set(scores) for scores in matched))
+
+        totals = ((doc, sum(scores.get(doc, 0.0) for scores in matched)) for doc in docs)
+        return heapq.nsmallest(limit, totals, key=lambda result: (-result[1], result[0]))
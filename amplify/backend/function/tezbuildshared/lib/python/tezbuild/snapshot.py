@@ -0,0 +1,415 @@
+import json
+import mmap
+import struct
+from decimal import Decimal
+
+from tezbuild.facets import FacetIndex, bitmap_of, build_bitmaps, decode_bitmaps, encode_bitmaps
+from tezbuild.manifest import public_item
+from tezbuild.ordering import SORT_ENTRY, encode_sort_entry, entry_sort_value
+from tezbuild.ranges import RangeIndex, build_ranges, decode_ranges, encode_ranges
+from tezbuild.search import SearchIndex, build_search_index, product_terms
+from tezbuild.suggest import SuggestIndex, build_suggest_index
+
+# Catalog snapshot file layout. Everything is little-endian and fixed-width so the file can be
+# mmapped and read in place without parsing it up front.
+#
+#   header          magic, format version, catalog version, then (offset, count) for every section
+#   string_offsets  u32 offset of each string in string_data, plus one trailing end offset
+#   string_data     utf-8 bytes of every distinct string (attribute names and values)
+#   records         (attrs_start, attrs_count) for each item
+#   attrs           (name, kind, ref, number) for each attribute of each item
+#   tiers           (price, quantity) for each price tier
+#   sku_index       (sku, first_record, record_count), sorted by sku
+#   key_index       (item_type, unique_id, record, members_start, members_count), sorted by key
+#   members         record numbers of the products that belong to each product group
+#   search          full text index over the SKUs, in sku_index order (see search.py)
+#   facets          a bitmap of the products with each facet attribute value (see facets.py)
+#   sort_keys       the numbers products are ordered by, per product record (see ordering.py)
+#   suggest         typeahead keys of the product headings (see suggest.py)
+#   ranges          the products sorted by each numeric range attribute (see ranges.py)
+#
+# Products are written first and sorted by SKU, so all the records of a SKU are contiguous. Only
+# their public attributes (see manifest.py) are written.
+
+MAGIC = b'TZCS'
+FORMAT_VERSION = 6
+
+SECTIONS = ('string_offsets', 'string_data', 'records', 'attrs', 'tiers', 'sku_index', 'key_index', 'members', 'search', 'facets', 'sort_keys', 'suggest', 'ranges')
+
+HEADER = struct.Struct('<4sIQ' + 'II' * len(SECTIONS))
+U32 = struct.Struct('<I')
+STRING_SPAN = struct.Struct('<II')
+RECORD = struct.Struct('<II')
+ATTR = struct.Struct('<IIId')
+TIER = struct.Struct('<dd')
+SKU_ENTRY = struct.Struct('<III')
+KEY_ENTRY = struct.Struct('<IIIII')
+
+# attribute kinds - ref is a string number for KIND_STR/KIND_JSON and the first tier for KIND_TIERS,
+# number holds the value for KIND_NUM/KIND_BOOL and the tier count for KIND_TIERS
+KIND_STR = 0
+KIND_NUM = 1
+KIND_BOOL = 2
+KIND_TIERS = 3
+KIND_JSON = 4
+
+# attributes of a product group item that describe the group rather than filter its products
+PG_NON_FILTER_ATTRIBUTES = ('ItemType', 'UniqueId', 'Category', 'Heading', 'Subheading')
+
+# attributes of other item types that are internal and never written to the snapshot
+EXCLUDED_ATTRIBUTES = ('Costs',)
+
+
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, set):
+        return sorted(obj)
+    raise TypeError
+
+
+def _is_tiers(value):
+    # Prices are stored as a list of (price, min quantity) pairs
+    return isinstance(value, list) and len(value) > 0 and all(
+        isinstance(tier, (list, tuple)) and len(tier) == 2 and
+        all(isinstance(x, (int, float, Decimal)) and not isinstance(x, bool) for x in tier)
+        for tier in value
+    )
+
+
+def pg_filter_attributes(pg):
+    # the attribute values a product must match to belong to the product group
+    return {key: value for key, value in pg.items() if key not in PG_NON_FILTER_ATTRIBUTES}
+
+
+def pg_matches(filter_attributes, product):
+    for key, value in filter_attributes.items():
+        if key not in product or product[key] != value:
+            return False
+    return True
+
+
+class _StringTable:
+    def __init__(self):
+        self.index = {}
+        self.data = bytearray()
+        self.offsets = []
+
+    def add(self, value):
+        number = self.index.get(value)
+        if number is None:
+            number = len(self.offsets)
+            self.index[value] = number
+            self.offsets.append(len(self.data))
+            self.data += value.encode('utf-8')
+        return number
+
+
+def build_snapshot(items, version):
+    strings = _StringTable()
+    products = sorted(
+        (public_item(item) for item in items if item.get('ItemType') == 'P'),
+        key=lambda item: (item.get('SKU', ''), item['UniqueId'])
+    )
+    others = sorted(
+        (item for item in items if item.get('ItemType') != 'P'),
+        key=lambda item: (item['ItemType'], item['UniqueId'])
+    )
+    ordered = products + others
+
+    records = bytearray()
+    attrs = bytearray()
+    tiers = bytearray()
+    attr_count = 0
+    tier_count = 0
+    sort_keys = bytearray()
+    for number, item in enumerate(ordered):
+        start = attr_count
+        prices_start, prices_count = tier_count, 0
+        for name, value in item.items():
+            if name in EXCLUDED_ATTRIBUTES or value is None:
+                continue
+            name_ref = strings.add(name)
+            if isinstance(value, str):
+                attrs += ATTR.pack(name_ref, KIND_STR, strings.add(value), 0.0)
+            elif isinstance(value, bool):
+                attrs += ATTR.pack(name_ref, KIND_BOOL, 0, 1.0 if value else 0.0)
+            elif isinstance(value, (int, float, Decimal)):
+                attrs += ATTR.pack(name_ref, KIND_NUM, 0, float(value))
+            elif _is_tiers(value):
+                if name == 'Prices':
+                    prices_start, prices_count = tier_count, len(value)
+                attrs += ATTR.pack(name_ref, KIND_TIERS, tier_count, float(len(value)))
+                for price, quantity in value:
+                    tiers += TIER.pack(float(price), float(quantity))
+                tier_count += len(value)
+            else:
+                attrs += ATTR.pack(name_ref, KIND_JSON, strings.add(json.dumps(value, default=_json_default)), 0.0)
+            attr_count += 1
+        records += RECORD.pack(start, attr_count - start)
+        if number < len(products):
+            sort_keys += encode_sort_entry(item, prices_start, prices_count)
+
+    # SKU index: products are already sorted by SKU, so each SKU is one contiguous run
+    sku_index = bytearray()
+    sku_count = 0
+    search_docs = []
+    run_start = 0
+    for i in range(1, len(products) + 1):
+        if i == len(products) or products[i].get('SKU') != products[run_start].get('SKU'):
+            sku = products[run_start].get('SKU')
+            if sku is not None:
+                sku_index += SKU_ENTRY.pack(strings.add(sku), run_start, i - run_start)
+                sku_count += 1
+                # the products of a SKU describe the same item, so the first one stands for all of them
+                search_docs.append(product_terms(products[run_start]))
+            run_start = i
+
+    # resolve product group membership once at publish time instead of on every request
+    products_by_category = {}
+    for number, product in enumerate(products):
+        products_by_category.setdefault(product.get('Category'), []).append(number)
+
+    keyed = sorted(
+        range(len(ordered)),
+        key=lambda number: (ordered[number]['ItemType'].encode('utf-8'), ordered[number]['UniqueId'].encode('utf-8'))
+    )
+    key_index = bytearray()
+    members = bytearray()
+    member_count = 0
+    for number in keyed:
+        item = ordered[number]
+        members_start = member_count
+        if item['ItemType'] == 'PG' and 'Category' in item:
+            filter_attributes = pg_filter_attributes(item)
+            for product_number in products_by_category.get(item['Category'], []):
+                if pg_matches(filter_attributes, products[product_number]):
+                    members += U32.pack(product_number)
+                    member_count += 1
+        key_index += KEY_ENTRY.pack(
+            strings.add(item['ItemType']), strings.add(item['UniqueId']),
+            number, members_start, member_count - members_start
+        )
+
+    suggest = build_suggest_index(products)
+
+    # facet values and range attributes go into the string table, so this has to come before the table is written out
+    facets = encode_bitmaps(build_bitmaps(products), strings.add)
+    ranges = encode_ranges(build_ranges(products), strings.add)
+
+    string_offsets = bytearray()
+    for offset in strings.offsets:
+        string_offsets += U32.pack(offset)
+    string_offsets += U32.pack(len(strings.data))
+
+    sections = [
+        (string_offsets, len(strings.offsets)),
+        (strings.data, len(strings.data)),
+        (records, len(ordered)),
+        (attrs, attr_count),
+        (tiers, tier_count),
+        (sku_index, sku_count),
+        (key_index, len(ordered)),
+        (members, member_count),
+        (build_search_index(search_docs), sku_count),
+        (facets, len(products)),
+        (sort_keys, len(products)),
+        (suggest, len(suggest)),
+        (ranges, len(products)),
+    ]
+
+    header_fields = [MAGIC, FORMAT_VERSION, int(version)]
+    body = bytearray()
+    offset = HEADER.size
+    for data, count in sections:
+        header_fields += [offset + len(body), count]
+        body += data
+    return HEADER.pack(*header_fields) + bytes(body)
+
+
+class CatalogSnapshot:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self._mm, 0)
+        if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+            self.close()
+            raise ValueError(f'Unsupported catalog snapshot format in {path}')
+        self.version = header[2]
+        self._sections = {}
+        for i, name in enumerate(SECTIONS):
+            self._sections[name] = (header[3 + 2 * i], header[4 + 2 * i])
+        # attribute names repeat on every item, so decode each of them only once
+        self._names = {}
+        self._search_index = None
+        self._suggest_index = None
+        self._facet_index = None
+        self._range_index = None
+
+    def close(self):
+        if getattr(self, '_mm', None) is not None:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+    def _string_bytes(self, number):
+        start, end = STRING_SPAN.unpack_from(self._mm, self._sections['string_offsets'][0] + number * U32.size)
+        data_offset = self._sections['string_data'][0]
+        return self._mm[data_offset + start:data_offset + end]
+
+    def _string(self, number):
+        return self._string_bytes(number).decode('utf-8')
+
+    def _name(self, number):
+        name = self._names.get(number)
+        if name is None:
+            name = self._names[number] = self._string(number)
+        return name
+
+    def _record(self, number):
+        attrs_start, attrs_count = RECORD.unpack_from(self._mm, self._sections['records'][0] + number * RECORD.size)
+        attrs_offset = self._sections['attrs'][0] + attrs_start * ATTR.size
+        item = {}
+        for name_ref, kind, ref, number_value in ATTR.iter_unpack(self._mm[attrs_offset:attrs_offset + attrs_count * ATTR.size]):
+            if kind == KIND_STR:
+                value = self._string(ref)
+            elif kind == KIND_NUM:
+                value = number_value
+            elif kind == KIND_BOOL:
+                value = number_value != 0
+            elif kind == KIND_TIERS:
+                tiers_offset = self._sections['tiers'][0] + ref * TIER.size
+                value = [list(tier) for tier in TIER.iter_unpack(self._mm[tiers_offset:tiers_offset + int(number_value) * TIER.size])]
+            else:
+                value = json.loads(self._string(ref))
+            item[self._name(name_ref)] = value
+        return item
+
+    def _search(self, section, entry, probe):
+        # binary search over a sorted index section; probe is compared against the entry's key strings as bytes
+        offset, count = self._sections[section]
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            fields = entry.unpack_from(self._mm, offset + middle * entry.size)
+            key = tuple(self._string_bytes(ref) for ref in fields[:len(probe)])
+            if key < probe:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count:
+            fields = entry.unpack_from(self._mm, offset + low * entry.size)
+            if tuple(self._string_bytes(ref) for ref in fields[:len(probe)]) == probe:
+                return fields
+        return None
+
+    def _key_entry(self, item_type, unique_id):
+        return self._search('key_index', KEY_ENTRY, (item_type.encode('utf-8'), unique_id.encode('utf-8')))
+
+    def get_item(self, item_type, unique_id):
+        entry = self._key_entry(item_type, unique_id)
+        if entry is None:
+            return None
+        return self._record(entry[2])
+
+    def _page(self, count, offset, limit):
+        # the (start, stop) of a page within count entries
+        stop = count if limit is None else min(count, offset + limit)
+        return min(offset, stop), stop
+
+    def get_products_by_sku(self, sku, offset=0, limit=None):
+        entry = self._search('sku_index', SKU_ENTRY, (sku.encode('utf-8'),))
+        if entry is None:
+            return []
+        start, stop = self._page(entry[2], offset, limit)
+        return [self._record(entry[1] + number) for number in range(start, stop)]
+
+    def get_product_group(self, pgid, offset=0, limit=None):
+        # returns the product group item and its products, or None if the group does not exist;
+        # products are in SKU order, so offset and limit select a stable page of them
+        entry = self._key_entry('PG', pgid)
+        if entry is None:
+            return None
+        start, stop = self._page(entry[4], offset, limit)
+        members_offset = self._sections['members'][0] + (entry[3] + start) * U32.size
+        products = [
+            self._record(number)
+            for (number,) in U32.iter_unpack(self._mm[members_offset:members_offset + (stop - start) * U32.size])
+        ]
+        return self._record(entry[2]), products
+
+    def facet_index(self):
+        # bit n of its bitmaps is product record n
+        if self._facet_index is None:
+            self._facet_index = FacetIndex(
+                decode_bitmaps(self._mm, self._sections['facets'][0], self._string), self._sections['facets'][1]
+            )
+        return self._facet_index
+
+    def range_index(self):
+        # its product numbers are product record numbers, like the facet index's bits
+        if self._range_index is None:
+            self._range_index = RangeIndex(decode_ranges(self._mm, self._sections['ranges'][0], self._string))
+        return self._range_index
+
+    def product_group_members(self, pgid):
+        # the product group item and the record numbers of its products, or None if it does not exist
+        entry = self._key_entry('PG', pgid)
+        if entry is None:
+            return None
+        members_offset = self._sections['members'][0] + entry[3] * U32.size
+        members = U32.iter_unpack(self._mm[members_offset:members_offset + entry[4] * U32.size])
+        return self._record(entry[2]), [number for (number,) in members]
+
+    def product_group_bitmap(self, pgid):
+        # the product group item and a bitmap of its product records, or None if it does not exist
+        group = self.product_group_members(pgid)
+        if group is None:
+            return None
+        return group[0], bitmap_of(group[1])
+
+    def _tiers(self, start, count):
+        offset = self._sections['tiers'][0] + start * TIER.size
+        return [list(tier) for tier in TIER.iter_unpack(self._mm[offset:offset + count * TIER.size])]
+
+    def sort_values(self, numbers, field, quantity=None):
+        # the value each product record is ordered by (see ordering.py), None where it has none
+        offset = self._sections['sort_keys'][0]
+        return [
+            entry_sort_value(SORT_ENTRY.unpack_from(self._mm, offset + number * SORT_ENTRY.size), self._tiers, field, quantity)
+            for number in numbers
+        ]
+
+    def products_at(self, numbers):
+        return [self._record(number) for number in numbers]
+
+    def unique_ids(self, item_type):
+        # every UniqueId of an item type, in key order
+        offset, count = self._sections['key_index']
+        item_type = item_type.encode('utf-8')
+        for fields in KEY_ENTRY.iter_unpack(self._mm[offset:offset + count * KEY_ENTRY.size]):
+            if self._string_bytes(fields[0]) == item_type:
+                yield self._string(fields[1])
+
+    def skus(self):
+        offset, count = self._sections['sku_index']
+        for fields in SKU_ENTRY.iter_unpack(self._mm[offset:offset + count * SKU_ENTRY.size]):
+            yield self._string(fields[0])
+
+    def search(self, query, limit):
+        # (sku, score, first product) of the best matches for a full text query, best first
+        if self._search_index is None:
+            self._search_index = SearchIndex(self._mm, self._sections['search'][0])
+        offset = self._sections['sku_index'][0]
+        results = []
+        for doc, score in self._search_index.search(query, limit):
+            sku_ref, first_record, _ = SKU_ENTRY.unpack_from(self._mm, offset + doc * SKU_ENTRY.size)
+            results.append((self._string(sku_ref), score, self._record(first_record)))
+        return results
+
+    def suggest(self, prefix, limit):
+        # (heading, product count) of the best typeahead completions of prefix, best first
+        if self._suggest_index is None:
+            self._suggest_index = SuggestIndex(self._mm, self._sections['suggest'][0])
+        return self._suggest_index.suggest(prefix, limit)
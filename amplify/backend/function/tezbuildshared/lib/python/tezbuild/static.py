@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from tezbuild.render import encode_product_page, page_cards, page_items_from_snapshot
+from tezbuild.repository import QUERY_WORKERS
+from tezbuild.responses import encode_body
+
+# Static copy of the public catalog, for storefront reads that need no function or table at all.
+# Every nav page, product group and product is rendered to the body its public action returns:
+#
+#   public/static/nav/<id>/<digest>.json        getPageCardsByNavID
+#   public/static/groups/<pgid>/<digest>.json   getProductsByPGID (the whole group)
+#   public/static/products/<sku>/<digest>.json  getProductById
+#
+# Object keys are content addressed, so they never change once written and can be cached forever.
+# A publish only uploads objects whose digest is not in the previous manifest. The manifest of each
+# catalog version maps every object name (e.g. 'groups/<pgid>') to its digest, and current.json,
+# the only mutable object, names the latest manifest.
+#
+# Every write to the catalog withdraws the static copy, by setting current.json's manifest to null,
+# until the next publish: the storefront reads from the API meanwhile, so it never serves a price or
+# product that the table has already replaced. Publishing deletes the objects that only manifests
+# older than the previous one name, leaving clients that still hold the previous manifest its objects.
+STATIC_PREFIX = 'public/static/'
+CURRENT_KEY = STATIC_PREFIX + 'current.json'
+MANIFEST_PREFIX = STATIC_PREFIX + 'manifest-'
+
+# S3 deletes at most this many keys per request
+DELETE_BATCH = 1000
+
+# characters encodeURIComponent leaves as they are, so the storefront builds the same keys
+URI_COMPONENT_SAFE = "!'()*"
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CURRENT_CACHE_CONTROL = 'public, max-age=60'
+
+
+def manifest_key(version):
+    return f"{MANIFEST_PREFIX}{version}.json"
+
+
+def manifest_keys(s3, bucket):
+    # the keys of every published manifest, oldest first
+    keys = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=MANIFEST_PREFIX):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return sorted(keys, key=lambda key: int(key[len(MANIFEST_PREFIX):-len('.json')]))
+
+
+def object_key(name, digest):
+    kind, id = name.split('/', 1)
+    return f"{STATIC_PREFIX}{kind}/{quote(id, safe=URI_COMPONENT_SAFE)}/{digest}.json"
+
+
+def body_digest(encoded_body):
+    return hashlib.sha256(encoded_body.encode('utf-8')).hexdigest()[:20]
+
+
+def render_static_objects(snapshot):
+    # yields (name, encoded body) for every public object of the catalog
+    for id in snapshot.unique_ids('N'):
+        yield f"nav/{id}", encode_body(page_cards(*page_items_from_snapshot(snapshot, id)))
+
+    for pgid in snapshot.unique_ids('PG'):
+        pg, items = snapshot.get_product_group(pgid)
+        if 'Category' in pg:
+            yield f"groups/{pgid}", encode_product_page(pgid, items)
+
+    for sku in snapshot.skus():
+        yield f"products/{sku}", encode_body(snapshot.get_products_by_sku(sku))
+
+
+def _get_json(s3, bucket, key):
+    return json.loads(gzip.decompress(s3.get_object(Bucket=bucket, Key=key)['Body'].read()))
+
+
+def _manifest_objects(s3, bucket, key):
+    return _get_json(s3, bucket, key)['objects']
+
+
+def _put_json(s3, bucket, key, encoded_body, cache_control):
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=gzip.compress(encoded_body.encode('utf-8')),
+        ContentType='application/json',
+        ContentEncoding='gzip',
+        CacheControl=cache_control
+    )
+
+
+def withdraw_static_catalog(s3, bucket, version):
+    # called after a write to the catalog, which made it version
+    _put_json(s3, bucket, CURRENT_KEY, json.dumps({'version': version, 'manifest': None}), CURRENT_CACHE_CONTROL)
+
+
+def _delete_keys(s3, bucket, keys):
+    for i in range(0, len(keys), DELETE_BATCH):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH]], 'Quiet': True}
+        )
+
+
+def prune_static_catalog(s3, bucket, manifests, objects):
+    # Deletes the older manifests and the objects none of the kept ones name. manifests are the keys
+    # of the older manifests, and objects are the object keys of the kept manifests.
+    stale = set()
+    for key in manifests:
+        stale.update(object_key(name, digest) for name, digest in _manifest_objects(s3, bucket, key).items())
+    stale -= objects
+    _delete_keys(s3, bucket, sorted(stale) + list(manifests))
+    return len(stale)
+
+
+def publish_static_catalog(s3, bucket, snapshot):
+    # returns the number of objects in the catalog, the number that had to be uploaded and the number
+    # of old ones deleted
+    key = manifest_key(snapshot.version)
+    manifests = manifest_keys(s3, bucket)
+    older = [manifest for manifest in manifests if manifest != key]
+    previous = _manifest_objects(s3, bucket, manifests[-1]) if manifests else {}
+
+    objects = {}
+    changed = []
+    for name, encoded_body in render_static_objects(snapshot):
+        digest = body_digest(encoded_body)
+        objects[name] = digest
+        if previous.get(name) != digest:
+            changed.append((object_key(name, digest), encoded_body))
+
+    with ThreadPoolExecutor(max_workers=QUERY_WORKERS) as executor:
+        list(executor.map(lambda upload: _put_json(s3, bucket, upload[0], upload[1], IMMUTABLE_CACHE_CONTROL), changed))
+
+    # the manifest goes up only after every object it names
+    _put_json(s3, bucket, key, json.dumps({'version': snapshot.version, 'objects': objects}), IMMUTABLE_CACHE_CONTROL)
+    _put_json(s3, bucket, CURRENT_KEY, json.dumps({'version': snapshot.version, 'manifest': key}), CURRENT_CACHE_CONTROL)
+
+    # the manifest before this one is kept for clients that read current.json before it changed
+    kept = set(object_key(name, digest) for name, digest in objects.items())
+    if older:
+        kept.update(object_key(name, digest) for name, digest in _manifest_objects(s3, bucket, older[-1]).items())
+    deleted = prune_static_catalog(s3, bucket, older[:-1], kept)
+    return len(objects), len(changed), deleted
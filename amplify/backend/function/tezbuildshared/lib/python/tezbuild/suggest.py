@@ -0,0 +1,127 @@
+import heapq
+import re
+import struct
+from bisect import bisect_left
+
+# Typeahead over product headings. Headings are normalized the way they are typed, e.g.
+# "2x6x12ft. #2 Southern Yellow Pine" becomes '2x6x12 #2 southern yellow pine' and
+# "4ft. x 8ft. x 3/4in. Plywood" becomes '4x8x3/4 plywood', and every heading is keyed by each of
+# its word suffixes, and by each part of its dimensions, so "3/4 ply" and "pine" complete it too.
+# A keystroke is two bisects for the run of sorted keys that start with the typed prefix.
+#
+# Headings are numbered best first: by how many products with stock have them, then alphabetically,
+# so the best completions of a prefix are simply the smallest heading numbers in its run.
+#
+#   header           key count, heading count
+#   key_offsets      u32 offset of each key in key_data, plus one trailing end offset
+#   key_data         utf-8 bytes of every key, sorted
+#   key_headings     u32 heading number of each key, in key order
+#   heading_offsets  u32 offset of each heading in heading_data, plus one trailing end offset
+#   heading_data     utf-8 bytes of every heading as the products spell it, best first
+#   heading_counts   u32 product count of each heading
+
+SUGGEST_HEADER = struct.Struct('<II')
+U32 = struct.Struct('<I')
+
+DEFAULT_SUGGESTIONS = 8
+MAX_SUGGESTIONS = 20
+
+# feet and inches are left out of the keys since a shopper may or may not type them; metric units stay
+UNIT_PATTERN = re.compile(r"(?<=[0-9])\s*(?:feet|foot|ft|inches|inch|in|'|\")\.?(?![a-z])")
+CROSS_PATTERN = re.compile(r"(?<=[0-9])\s*x\s*(?=[0-9])")
+
+LAST_CHARACTER = chr(0x10ffff)
+
+
+def suggest_tokens(text):
+    text = CROSS_PATTERN.sub('x', UNIT_PATTERN.sub('', text.lower()))
+    return [token for token in (word.strip('.,|') for word in text.split()) if token]
+
+
+def heading_keys(heading):
+    tokens = suggest_tokens(heading)
+    keys = set()
+    for i, token in enumerate(tokens):
+        rest = tokens[i + 1:]
+        keys.add(' '.join([token] + rest))
+        parts = token.split('x')
+        if len(parts) > 1 and all(parts):
+            for j in range(1, len(parts)):
+                keys.add(' '.join(['x'.join(parts[j:])] + rest))
+    return keys
+
+
+def _is_available(product):
+    inventory = product.get('Inventory')
+    return inventory is None or inventory > 0
+
+
+def _strings(values):
+    offsets = bytearray()
+    data = bytearray()
+    for value in values:
+        offsets += U32.pack(len(data))
+        data += value.encode('utf-8')
+    offsets += U32.pack(len(data))
+    return bytes(offsets) + bytes(data)
+
+
+def build_suggest_index(products):
+    # the section bytes for the headings of the products
+    counts = {}
+    for product in products:
+        heading = product.get('Heading')
+        if isinstance(heading, str) and heading.strip():
+            counts[heading] = counts.get(heading, 0) + (1 if _is_available(product) else 0)
+
+    headings = sorted(counts, key=lambda heading: (-counts[heading], heading))
+    keyed = sorted((key, number) for number, heading in enumerate(headings) for key in heading_keys(heading))
+
+    key_headings = struct.pack(f'<{len(keyed)}I', *(number for _, number in keyed))
+    heading_counts = struct.pack(f'<{len(headings)}I', *(counts[heading] for heading in headings))
+    # utf-8 preserves code point order, so the keys are sorted alike as str and as bytes
+    return (
+        SUGGEST_HEADER.pack(len(keyed), len(headings))
+        + _strings(key for key, _ in keyed) + key_headings
+        + _strings(headings) + heading_counts
+    )
+
+
+class SuggestIndex:
+    # Reads a suggest section in place. The keys are decoded once when the index is opened so that
+    # a prefix is a bisect; headings are decoded only when they are returned.
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        key_count, self.heading_count = SUGGEST_HEADER.unpack_from(buffer, offset)
+        offset += SUGGEST_HEADER.size
+        key_offsets = struct.unpack_from(f'<{key_count + 1}I', buffer, offset)
+        offset += (key_count + 1) * U32.size
+        key_data = bytes(buffer[offset:offset + key_offsets[-1]])
+        offset += key_offsets[-1]
+        self.keys = [key_data[key_offsets[i]:key_offsets[i + 1]].decode('utf-8') for i in range(key_count)]
+        self._key_headings_offset = offset
+        offset += key_count * U32.size
+        self._heading_offsets_offset = offset
+        (heading_data_length,) = U32.unpack_from(buffer, offset + self.heading_count * U32.size)
+        offset += (self.heading_count + 1) * U32.size
+        self._heading_data_offset = offset
+        self._heading_counts_offset = offset + heading_data_length
+
+    def _heading(self, number):
+        start, end = struct.unpack_from('<II', self._buffer, self._heading_offsets_offset + number * U32.size)
+        (count,) = U32.unpack_from(self._buffer, self._heading_counts_offset + number * U32.size)
+        return bytes(self._buffer[self._heading_data_offset + start:self._heading_data_offset + end]).decode('utf-8'), count
+
+    def suggest(self, prefix, limit=DEFAULT_SUGGESTIONS):
+        # (heading, product count) of the best headings with a key starting with the typed prefix
+        prefix = ' '.join(suggest_tokens(prefix))
+        if not prefix:
+            return []
+        # the keys starting with prefix are the sorted run up to the last string that could start with it
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + LAST_CHARACTER, start)
+        if start == end:
+            return []
+        numbers = struct.unpack_from(f'<{end - start}I', self._buffer, self._key_headings_offset + start * U32.size)
+        return [self._heading(number) for number in heapq.nsmallest(limit, set(numbers))]
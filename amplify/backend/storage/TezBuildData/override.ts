@@ -0,0 +1,11 @@
+import { AmplifyDDBResourceTemplate, AmplifyProjectInfo } from '@aws-amplify/cli-extensibility-helper';
+
+export function override(resources: AmplifyDDBResourceTemplate, amplifyProjectInfo: AmplifyProjectInfo) {
+  // Products are only retired by a newer upload's cutoff (see archiveStaleItems in contentmanagement),
+  // never by age. TTL is turned off explicitly because products uploaded while it was on still carry
+  // an ExpiresAt, and leaving it on would delete them.
+  resources.dynamoDBTable.timeToLiveSpecification = {
+    attributeName: 'ExpiresAt',
+    enabled: false
+  };
+}
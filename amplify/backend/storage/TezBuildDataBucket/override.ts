@@ -0,0 +1,31 @@
+import { AmplifyProjectInfo, AmplifyS3ResourceTemplate } from '@aws-amplify/cli-extensibility-helper';
+
+export function override(resources: AmplifyS3ResourceTemplate, amplifyProjectInfo: AmplifyProjectInfo) {
+  // The static catalog (public/static/, written by publishCatalog in contentmanagement) is read by the
+  // storefront straight from the bucket. Only that prefix is public; ACLs stay blocked.
+  resources.s3Bucket.publicAccessBlockConfiguration = {
+    blockPublicAcls: true,
+    ignorePublicAcls: true,
+    blockPublicPolicy: false,
+    restrictPublicBuckets: false
+  };
+
+  resources.addCfnResource({
+    type: 'AWS::S3::BucketPolicy',
+    properties: {
+      bucket: { Ref: 'S3Bucket' },
+      policyDocument: {
+        Version: '2012-10-17',
+        Statement: [
+          {
+            Sid: 'PublicStaticCatalogRead',
+            Effect: 'Allow',
+            Principal: '*',
+            Action: 's3:GetObject',
+            Resource: { 'Fn::Join': ['', ['arn:aws:s3:::', { Ref: 'S3Bucket' }, '/public/static/*']] }
+          }
+        ]
+      }
+    }
+  }, 'StaticCatalogReadPolicy');
+}
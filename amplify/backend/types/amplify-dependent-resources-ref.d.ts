@@ -45,6 +45,9 @@ export type AmplifyDependentResourcesAttributes = {
       "LambdaExecutionRoleArn": "string",
       "Name": "string",
       "Region": "string"
+    },
+    "tezbuildshared": {
+      "Arn": "string"
     }
   },
   "storage": {
@@ -72,16 +72,16 @@ export class ProductGroup {
     return this.products[id];
   }
 
-  // The following two methods are to be used later in lazy loading:
   // load a single SKU
   loadSingleSKU(key: string, products: Product[]) {
     this.products[key] = products;
   }
 
-  // load multiple SKUs
+  // load a further page of the group; a SKU can be split across pages, so its products are appended
   loadProducts(productRecord: Record<string, Product[]>) {
     for (const key in productRecord) {
-      this.loadSingleSKU(key, productRecord[key]);
+      this.loadSingleSKU(key, [...(this.products[key] || []), ...productRecord[key]]);
     }
+    this.parseAttributes();
   }
 }
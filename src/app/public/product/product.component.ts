@@ -68,13 +68,21 @@ export class ProductComponent implements OnInit {
       );
     } else if (this.pgid) {
       this.pgid = this.pgid.toLowerCase();
-      this.allProducts = await this.productService.getProductsByPGID(this.pgid);
+      // later pages add options to the selectors, keeping the current selections
+      this.allProducts = await this.productService.getProductsByPGID(this.pgid, () => this.setSelectors(this.currentChoices()));
     }
 
     console.log(this.allProducts);
 
     this.setSelectors({});
     this.isLoading = false;
+
+    // ties in price go to the nearest facility, which may only be known once the page is showing
+    this.productService.facilityRanksLoaded.then(() => {
+      if (this.product) {
+        this.setTotalPrice();
+      }
+    });
   }
 
   get packSizesString(): string {
@@ -171,6 +179,14 @@ export class ProductComponent implements OnInit {
     this.selectProduct(obj['id']);
   }
 
+  currentChoices(): Record<string, any> {
+    const choices = {};
+    for (const selector of this.selectors) {
+      choices[selector.attr] = selector.selection;
+    }
+    return choices;
+  }
+
   makeChoice(attr: string, values: any[]): any {
     // Placeholder for marketing logic. In the future, we can keep a mapping of attributes to values that we want to 
     // prioritize on the backend and import it with getProductsByPGID. Selects random for now.
@@ -215,8 +231,8 @@ export class ProductComponent implements OnInit {
     [this.totalPrice, this.product] = this.getTotalPrice(this.quantity);
   }
 
-  // return the total price for the quantity (across all suppliers) of the current product, and the product that gives that price
-  // price is infinity if the quantity is not allowable
+  // return the total price for the quantity (across all suppliers) of the current product, and the product that gives that price,
+  // from the facility nearest to the shopper when several give it; price is infinity if the quantity is not allowable
   // this is intentional, as the method is used to check allowable increments via the wrapper allowableQuantityIncrement
   getTotalPrice(quantity: number): [number, Product] {
     let minPrice = Infinity;
@@ -224,7 +240,9 @@ export class ProductComponent implements OnInit {
     for (const product of this.products) {
       if (quantity % product.prices[0].packSize == 0 && (product.inventory == null || product.inventory >= quantity)) {
         const price = this.getProductPrice(product, quantity);
-        if (price < minPrice) {
+        const nearer = price === minPrice
+          && this.productService.facilityRank(product.facilityId) < this.productService.facilityRank(selectedProduct.facilityId);
+        if (price < minPrice || nearer) {
           selectedProduct = product;
           minPrice = price;
         }
@@ -1,11 +1,15 @@
 import { Injectable } from '@angular/core';
 import { post } from 'aws-amplify/api';
 import { PageCard } from '../models/page-card.model';
+import { ProductService } from './product.service';
+import { StaticCatalogService } from './static-catalog.service';
 
 @Injectable({
   providedIn: 'root'
 })
 export class NavService {
+    constructor(private staticCatalog: StaticCatalogService, private productService: ProductService) { }
+
     private filterValueDictionary: {
         "all": {}
     };
@@ -48,20 +52,7 @@ export class NavService {
     async getCardsById(id: string): Promise<any> {
         try {
             console.log('Getting nav page:', id);
-            const { body } = await post({
-            apiName: 'tezbuildpublic',
-            path: `/nav`,
-            options: {
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: {
-                    "action": "getPageCardsByNavID",
-                    id
-                }
-            }
-            }).response;
-            const response = await body.json();
+            const response = await this.staticCatalog.get(`nav/${id}`) || await this.getPageBundle(id);
     
             // Ensure response is an object
             if (typeof response === 'object') {
@@ -80,4 +71,26 @@ export class NavService {
         }
         return null;
     }
+
+    // the page's cards, with the first page of each group and the products of each product card
+    // handed to ProductService, so opening a card does not wait for another request
+    private async getPageBundle(id: string): Promise<any> {
+        const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/nav`,
+        options: {
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: {
+                "action": "getPageBundle",
+                id,
+                "depth": 1
+            }
+        }
+        }).response;
+        const response: any = await body.json();
+        this.productService.primePageBundle(response);
+        return response['Page'];
+    }
 }
\ No newline at end of file
@@ -1,15 +1,110 @@
 import { Injectable } from '@angular/core';
 import { Product, LumberProduct, SheetGoodProduct } from '../models/product.model';
 import { ProductGroup } from '../models/product-group.model';
+import { PageCard } from '../models/page-card.model';
 import { post } from 'aws-amplify/api';
+import { StaticCatalogService } from './static-catalog.service';
 
 @Injectable({
   providedIn: 'root'
 })
 export class ProductService {
-  async getProductsByPGID(pgid: string): Promise<ProductGroup> {
+  static readonly PAGE_SIZE = 100;
+
+  // group pages and products that arrived with a page bundle, each used once by the card that opens it
+  private prefetched = new Map<string, any>();
+
+  // The rank of each facility by distance from the shopper, looked up once per session. The lookup starts
+  // with the service and nothing waits for it: until it resolves, every facility ranks the same.
+  private facilityRanks = new Map<string, number>();
+  readonly facilityRanksLoaded: Promise<void>;
+
+  constructor(private staticCatalog: StaticCatalogService) {
+    this.facilityRanksLoaded = this.getNearestFacilities().then(facilities => {
+      this.facilityRanks = new Map(facilities.map((facility, rank) => [facility.FacilityId, rank]));
+    });
+  }
+
+  primePageBundle(bundle: any) {
+    for (const pgid in bundle['Groups'] || {}) {
+      this.prefetched.set(`groups/${pgid}`, bundle['Groups'][pgid]);
+    }
+    for (const id in bundle['Products'] || {}) {
+      if (Array.isArray(bundle['Products'][id]) && bundle['Products'][id].length > 0) {
+        this.prefetched.set(`products/${id}`, bundle['Products'][id]);
+      }
+    }
+  }
+
+  private takePrefetched(name: string): any {
+    const response = this.prefetched.get(name);
+    this.prefetched.delete(name);
+    return response;
+  }
+
+  // Groups are read whole from the static catalog when it has them. Otherwise their first page comes from
+  // the page bundle that showed their card or from the API, and the rest is loaded into it in the background.
+  async getProductsByPGID(pgid: string, onPage?: (group: ProductGroup) => void): Promise<ProductGroup> {
     try {
       console.log('Getting product by card:', pgid);
+      const response = this.takePrefetched(`groups/${pgid}`)
+        || await this.staticCatalog.get(`groups/${pgid}`)
+        || await this.getProductsPage(pgid);
+
+      // Ensure response is an object
+      if (typeof response === 'object' && Object.keys(response).length > 0) {
+        const group = this.parseProductGroup(response);
+        if (response['NextCursor']) {
+          this.loadRemainingPages(group, response['NextCursor'], onPage);
+        }
+        return group;
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+    return null;
+  }
+
+  private async getProductsPage(pgid: string, cursor?: string): Promise<any> {
+    const { body } = await post({
+      apiName: 'tezbuildpublic',
+      path: `/products`,
+      options: {
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: {
+          "action": "getProductsByPGID",
+          "pgid": pgid,
+          "limit": ProductService.PAGE_SIZE,
+          ...(cursor ? { "cursor": cursor } : {})
+        }
+      }
+    }).response;
+    return await body.json();
+  }
+
+  private async loadRemainingPages(group: ProductGroup, cursor: string, onPage?: (group: ProductGroup) => void) {
+    try {
+      while (cursor) {
+        const response = await this.getProductsPage(group.id, cursor);
+        group.loadProducts(this.parseProductRecord(response));
+        onPage?.(group);
+        cursor = response['NextCursor'];
+      }
+    } catch (error) {
+      console.error('Error loading remaining products of group:', group.id, error);
+    }
+  }
+
+  // A page of a group's products ordered by the server, e.g. cheapest first for 208 pieces. Products with no
+  // value for the sort (no inventory reported, or unable to supply the quantity) come last either way.
+  async getSortedProducts(pgid: string, sort: 'price' | 'length' | 'weight' | 'inventory', options: { order?: 'asc' | 'desc', quantity?: number, cursor?: string } = {})
+    : Promise<{ products: Record<string, Product[]>, nextCursor: string }> {
+    try {
+      console.log('Getting sorted products of group:', pgid, sort, options);
       const { body } = await post({
         apiName: 'tezbuildpublic',
         path: `/products`,
@@ -19,27 +114,37 @@ export class ProductService {
           },
           body: {
             "action": "getProductsByPGID",
-            "pgid": pgid
+            "pgid": pgid,
+            "sort": sort,
+            "order": options.order || 'asc',
+            "limit": ProductService.PAGE_SIZE,
+            ...(sort === 'price' && options.quantity ? { "quantity": options.quantity } : {}),
+            ...(options.cursor ? { "cursor": options.cursor } : {})
           }
         }
       }).response;
       const response = await body.json();
 
-      // Ensure response is an object
-      if (typeof response === 'object' && Object.keys(response).length > 0) {
-        return this.parseProductGroup(response);
+      if (typeof response === 'object' && response['Products']) {
+        return { products: this.parseProductRecord(response), nextCursor: response['NextCursor'] || null };
       } else {
         console.error('Invalid response format or empty response:', response);
       }
     } catch (error) {
       console.error('Error invoking API:', error);
     }
-    return null;
+
+    return { products: {}, nextCursor: null };
   }
 
   async getProductById(id: string): Promise<Product[]> {
     try {
       console.log('Getting product by id:', id);
+      const published = this.takePrefetched(`products/${id}`) || await this.staticCatalog.get(`products/${id}`);
+      if (published) {
+        return this.parseProducts(published);
+      }
+
       const { body } = await post({
         apiName: 'tezbuildpublic',
         path: `/products`,
@@ -68,17 +173,297 @@ export class ProductService {
     return [];
   }
 
+  // Facilities nearest to the shopper first, with their distance in miles. The server locates the shopper
+  // from their IP address unless a location is given, e.g. from the browser's geolocation.
+  async getNearestFacilities(location?: { latitude: number, longitude: number }): Promise<{ FacilityId: string, Distance: number }[]> {
+    try {
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "getNearestFacilities",
+            ...(location ? { "location": location } : {})
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && Array.isArray(response['Facilities'])) {
+        return response['Facilities'];
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return [];
+  }
+
+  // a facility's distance rank from the shopper, nearest first; facilities with no known location rank last
+  facilityRank(facilityId: string): number {
+    return this.facilityRanks.has(facilityId) ? this.facilityRanks.get(facilityId) : this.facilityRanks.size;
+  }
+
+  // products of several SKUs in one request, e.g. for a cart or a comparison; SKUs without products are left out
+  async getProductsByIds(ids: string[]): Promise<Record<string, Product[]>> {
+    try {
+      console.log('Getting products by ids:', ids);
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "getProductsByIds",
+            "ids": ids
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && response['Products']) {
+        return this.parseProductRecord(response);
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return {};
+  }
+
+  // prices every line at its cheapest supplier, with line and order totals of price, weight and BDFT/SQFT;
+  // lines that no supplier can fill come back with Available false
+  async quoteCart(lines: { id: string, quantity: number }[]): Promise<any> {
+    try {
+      console.log('Quoting cart:', lines.length, 'lines');
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "quoteCart",
+            "lines": lines
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && response['Order']) {
+        return response;
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return null;
+  }
+
+  // delivery trucks for the same lines as quoteCart, each with a manifest of full and partial bundles, for freight quoting
+  async planLoads(lines: { id: string, quantity: number }[]): Promise<any> {
+    try {
+      console.log('Planning loads:', lines.length, 'lines');
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "planLoads",
+            "lines": lines
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && Array.isArray(response['Loads'])) {
+        return response;
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return null;
+  }
+
+  // Plans the boards to cut pieces from, per profile, at the least cost with the saw kerf, e.g.
+  // [{ profile: '2x4', length: 92.625, quantity: 14 }] in inches; filters such as { Grade: ['#2'] } choose the stock.
+  // The plan comes with a quote of its boards, and any pieces longer than every stock length are listed as Unplaced.
+  async optimizeCutList(pieces: { profile: string, length: number, quantity: number }[], kerf?: number, filters?: Record<string, any[]>): Promise<any> {
+    try {
+      console.log('Optimizing cut list:', pieces.length, 'lengths');
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "optimizeCutList",
+            "pieces": pieces,
+            ...(kerf !== undefined ? { "kerf": kerf } : {}),
+            ...(filters ? { "filters": filters } : {})
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && response['Profiles']) {
+        return response;
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return null;
+  }
+
+  // A page of the products of a group, or of a whole category, that match filters such as
+  // { Species: ['Southern Yellow Pine'], Length: [96, 120] }: values of one attribute are alternatives
+  // and every attribute has to match. Facets holds the count of each attribute value, taken with
+  // every filter but that attribute's own. Ranges bound Length, Width and Thickness in inches and the
+  // Price of a quantity, e.g. { Length: { min: 120, max: 192 }, Price: { max: 40, quantity: 1 } }, both ends inclusive.
+  async filterProducts(scope: { pgid?: string, category?: string }, filters: Record<string, any[]>, cursor?: string,
+    ranges?: Record<string, { min?: number, max?: number, quantity?: number }>)
+    : Promise<{ products: Record<string, Product[]>, total: number, facets: Record<string, Record<string, number>>, nextCursor: string }> {
+    try {
+      console.log('Filtering products:', scope, filters);
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "filterProducts",
+            ...scope,
+            "filters": filters,
+            ...(ranges ? { "ranges": ranges } : {}),
+            "limit": ProductService.PAGE_SIZE,
+            ...(cursor ? { "cursor": cursor } : {})
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && response['Products']) {
+        return {
+          products: this.parseProductRecord(response),
+          total: response['Total'],
+          facets: response['Facets'],
+          nextCursor: response['NextCursor']
+        };
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return null;
+  }
+
+  // best matches first, as product cards; the last word of the query also matches words it starts
+  async searchProducts(query: string, limit?: number): Promise<PageCard[]> {
+    try {
+      console.log('Searching products:', query);
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "searchProducts",
+            "query": query,
+            ...(limit ? { "limit": limit } : {})
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && Array.isArray(response['Results'])) {
+        return response['Results'].map((card: any) => {
+          return new PageCard(card.id, card.heading, card.type, card.subheading, card.image);
+        });
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return [];
+  }
+
+  // typeahead completions of what has been typed so far, e.g. "2x6x1" or "3/4 ply", most stocked first
+  async suggest(prefix: string, limit?: number): Promise<{ heading: string, products: number }[]> {
+    try {
+      const { body } = await post({
+        apiName: 'tezbuildpublic',
+        path: `/products`,
+        options: {
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: {
+            "action": "suggest",
+            "prefix": prefix,
+            ...(limit ? { "limit": limit } : {})
+          }
+        }
+      }).response;
+      const response = await body.json();
+
+      if (typeof response === 'object' && Array.isArray(response['Suggestions'])) {
+        return response['Suggestions'];
+      } else {
+        console.error('Invalid response format or empty response:', response);
+      }
+    } catch (error) {
+      console.error('Error invoking API:', error);
+    }
+
+    return [];
+  }
+
   parseProductGroup(response: any): ProductGroup {
+    return new ProductGroup(
+      response['Id'],
+      this.parseProductRecord(response)
+    );
+  }
+
+  parseProductRecord(response: any): Record<string, Product[]> {
     let products = {};
     for (const key in response['Products']) {
       if (Array.isArray(response['Products'][key]) && response['Products'][key].length > 0) {
         products[key] = this.parseProducts(response['Products'][key]);
       }
     }
-    return new ProductGroup(
-      response['Id'],
-      products
-    );
+    return products;
   }
 
   parseProducts(response: any): Product[] {
@@ -0,0 +1,71 @@
+import { Injectable } from '@angular/core';
+import amplifyConfig from '../../amplifyconfiguration.json';
+
+// Reads the static copy of the public catalog that publishCatalog writes to the bucket. Objects are
+// content addressed and cached by the browser indefinitely; only current.json, which names the latest
+// manifest, is fetched again, at most once a minute. Every write to the catalog names no manifest in
+// current.json until the next publish. A null result means the static copy is withdrawn, the object is
+// not published or it could not be fetched, and callers fall back to the API.
+@Injectable({
+  providedIn: 'root'
+})
+export class StaticCatalogService {
+  static readonly BUCKET_URL = `https://${amplifyConfig.aws_user_files_s3_bucket}.s3.${amplifyConfig.aws_user_files_s3_bucket_region}.amazonaws.com/`;
+  static readonly BASE_URL = `${StaticCatalogService.BUCKET_URL}public/static/`;
+  static readonly MANIFEST_TTL = 60 * 1000;
+
+  private manifest: Promise<Record<string, string>> = null;
+  private manifestLoadedAt = 0;
+
+  // name is the kind and id of an object, e.g. 'groups/<pgid>', 'products/<sku>' or 'nav/<id>'
+  async get(name: string): Promise<any> {
+    try {
+      const objects = await this.getManifest();
+      const digest = objects ? objects[name] : null;
+      if (!digest) {
+        return null;
+      }
+
+      const separator = name.indexOf('/');
+      const kind = name.slice(0, separator);
+      const id = name.slice(separator + 1);
+      const response = await fetch(`${StaticCatalogService.BASE_URL}${kind}/${encodeURIComponent(id)}/${digest}.json`);
+      if (!response.ok) {
+        return null;
+      }
+      return await response.json();
+    } catch (error) {
+      console.error('Error reading static catalog:', name, error);
+    }
+    return null;
+  }
+
+  private getManifest(): Promise<Record<string, string>> {
+    if (!this.manifest || Date.now() - this.manifestLoadedAt > StaticCatalogService.MANIFEST_TTL) {
+      this.manifestLoadedAt = Date.now();
+      this.manifest = this.loadManifest();
+    }
+    return this.manifest;
+  }
+
+  private async loadManifest(): Promise<Record<string, string>> {
+    try {
+      const current = await fetch(`${StaticCatalogService.BASE_URL}current.json`, { cache: 'no-cache' });
+      if (!current.ok) {
+        return null;
+      }
+      const { manifest } = await current.json();
+      if (!manifest) {
+        return null;
+      }
+      const response = await fetch(`${StaticCatalogService.BUCKET_URL}${manifest}`);
+      if (!response.ok) {
+        return null;
+      }
+      return (await response.json())['objects'];
+    } catch (error) {
+      console.error('Error reading static catalog manifest:', error);
+    }
+    return null;
+  }
+}
@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+FUNCTIONS = os.path.join(os.path.dirname(__file__), '..', 'amplify', 'backend', 'function')
+
+# the Lambda layer's modules, importable as they are in the functions
+sys.path.insert(0, os.path.join(FUNCTIONS, 'tezbuildshared', 'lib', 'python'))
+
+
+@pytest.fixture
+def load_function(monkeypatch):
+    # imports a function's handler module with the environment Amplify gives it; nothing here calls AWS
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('STORAGE_TEZBUILDDATA_NAME', 'TezBuildData')
+    monkeypatch.setenv('STORAGE_TEZBUILDDATABUCKET_BUCKETNAME', 'bucket')
+
+    def load(name):
+        spec = importlib.util.spec_from_file_location(name, os.path.join(FUNCTIONS, name, 'src', 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from tezbuild.history import history_key, series_prefix, series_values
+
+
+def test_series_values_coerces_numeric_attributes():
+    request = {'Profile': '2x4', 'Length': '96', 'Species': 'Southern Yellow Pine'}
+    product = {'Category': 'lumber', 'Profile': '2x4', 'Length': 96, 'Species': 'Southern Yellow Pine',
+               'FacilityId': 'RRT', 'SKU': 'abc'}
+
+    prefix = series_prefix('lumber', series_values('lumber', request))
+
+    assert series_values('lumber', request) == ['2x4', 96.0, 'Southern Yellow Pine']
+    assert history_key(product, 2024).startswith(prefix)
+
+
+def test_series_values_stops_at_first_missing_attribute():
+    assert series_values('sheet_good', {'PanelType': 'OSB', 'Species': 'Pine'}) == ['OSB']
+
+
+@pytest.mark.parametrize('values', [
+    {'Profile': '2x4', 'Length': '96in'},
+    {'Profile': '2x4', 'Length': True},
+    {'Profile': '2x4', 'Length': 'nan'},
+    {'Profile': 2},
+])
+def test_series_values_rejects_invalid_values(values):
+    with pytest.raises(ValueError):
+        series_values('lumber', values)
+
+
+@pytest.mark.parametrize('event, message', [
+    ({'Year': '2024a'}, 'Invalid year in request'),
+    ({'Year': None}, 'Invalid year in request'),
+    ({'Year': 2024, 'Profile': '2x4', 'Length': '96in'}, 'Invalid Length in request'),
+])
+def test_dimension_price_history_rejects_invalid_requests(load_function, event, message):
+    contentmanagement = load_function('contentmanagement')
+
+    response = contentmanagement.handler(dict(event, action='getDimensionPriceHistory', Category='lumber'), None)
+
+    assert response['statusCode'] == 400
+    assert json.loads(response['body']) == message
@@ -0,0 +1,28 @@
+from tezbuild.search import SearchIndex, build_search_index
+
+
+def index_of(*docs):
+    return SearchIndex(build_search_index([doc.split() for doc in docs]), 0)
+
+
+def test_typo_matches_terms_one_edit_away():
+    index = index_of('spruce', 'cedar', 'pine')
+
+    assert [doc for doc, _ in index.search('sprcue')] == [0]  # transposition
+    assert [doc for doc, _ in index.search('cedr')] == [1]  # deletion
+    assert [doc for doc, _ in index.search('cedarx')] == [1]  # insertion
+
+
+def test_typo_does_not_match_terms_two_edits_away():
+    # 'cabd' and 'abcd' share the deletion 'abd', but are two edits apart
+    index = index_of('cabd board')
+
+    assert index.search('abcd') == []
+
+
+def test_typo_expansions_are_capped_after_dropping_distant_terms(monkeypatch):
+    # 'aabc' sorts first and shares the deletion 'abc' with 'abcd', but is two edits from it
+    monkeypatch.setattr('tezbuild.search.MAX_EXPANSIONS', 1)
+    index = index_of('aabc', 'abcx')
+
+    assert [index.terms[number] for number in index._typo_terms('abcd')] == ['abcx']